@@ -43,6 +43,7 @@ from radl.radl import system, contextualize_item
 import IM.ServiceRequests as ServiceRequests
 
 from IM.config import Config
+from IM.events import publish
 
 
 class ConfManager(threading.Thread):
@@ -90,7 +91,7 @@ class ConfManager(threading.Thread):
                             "Inf ID: " + str(self.inf.id) + ": Configuration process in VM: " +
                             str(vm.im_id) + " finished.")
                         # Force to save the data to store the log data ()
-                        IM.InfrastructureList.InfrastructureList.save_data(self.inf.id)
+                        IM.InfrastructureList.InfrastructureList.save_data(self.inf.id, wait=False)
                 else:
                     # General Infrastructure tasks
                     if vm.is_ctxt_process_running():
@@ -108,7 +109,7 @@ class ConfManager(threading.Thread):
                             ConfManager.logger.debug(
                                 "Inf ID: " + str(self.inf.id) + ": Configuration process of master node failed.")
                         # Force to save the data to store the log data
-                        IM.InfrastructureList.InfrastructureList.save_data(self.inf.id)
+                        IM.InfrastructureList.InfrastructureList.save_data(self.inf.id, wait=False)
 
         return res
 
@@ -234,6 +235,7 @@ class ConfManager(threading.Thread):
                         ConfManager.logger.debug("Inf ID: " + str(self.inf.id) + ": Step " + str(
                             last_step) + " finished. Go to step: " + str(step))
                         last_step = step
+                        publish(self.inf.id, "ctxt_step", {'step': step})
             else:
                 if isinstance(vm, VirtualMachine):
                     if vm.destroy:
@@ -273,7 +275,7 @@ class ConfManager(threading.Thread):
                         # assigned
                         vm.ctxt_pid = VirtualMachine.WAIT_TO_PID
                         # Force to save the data to store the log data
-                        IM.InfrastructureList.InfrastructureList.save_data(self.inf.id)
+                        IM.InfrastructureList.InfrastructureList.save_data(self.inf.id, wait=False)
                 else:
                     # Launch the Infrastructure tasks
                     vm.configured = None
@@ -287,8 +289,10 @@ class ConfManager(threading.Thread):
                         vms_configuring[step] = []
                     vms_configuring[step].append(vm)
                     # Force to save the data to store the log data
-                    IM.InfrastructureList.InfrastructureList.save_data(self.inf.id)
+                    IM.InfrastructureList.InfrastructureList.save_data(self.inf.id, wait=False)
 
+                if step != last_step:
+                    publish(self.inf.id, "ctxt_step", {'step': step})
                 last_step = step
 
     def launch_ctxt_agent(self, vm, tasks):
@@ -818,7 +822,7 @@ class ConfManager(threading.Thread):
                 self.inf.ansible_configured = True
                 self.inf.set_configured(True)
                 # Force to save the data to store the log data
-                IM.InfrastructureList.InfrastructureList.save_data(self.inf.id)
+                IM.InfrastructureList.InfrastructureList.save_data(self.inf.id, wait=False)
             else:
                 self.inf.ansible_configured = False
                 self.inf.set_configured(False)
@@ -896,7 +900,7 @@ class ConfManager(threading.Thread):
                 self.change_master_credentials(ssh)
 
                 # Force to save the data to store the log data
-                IM.InfrastructureList.InfrastructureList.save_data(self.inf.id)
+                IM.InfrastructureList.InfrastructureList.save_data(self.inf.id, wait=False)
 
                 self.inf.set_configured(True)
             except:
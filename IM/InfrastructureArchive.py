@@ -0,0 +1,223 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from IM import codec
+from IM.config import Config
+from IM.ctxtlog import ContextualizationLog
+from IM.db import DataBase
+
+
+class InfrastructureArchive:
+    """
+    Retention policy of the deleted infrastructures.
+
+    The infrastructures deleted more than INF_ARCHIVE_DAYS days ago are moved from the
+    tables of the active infrastructures to the inf_archive table, with all their data
+    (VMs and contextualization logs) in a single compressed document with the format of
+    the ExportInfrastructure function. The ones deleted more than INF_PURGE_DAYS days ago
+    are removed permanently. The rows are processed in batches of INF_ARCHIVE_BATCH_SIZE
+    infrastructures, each one in a short transaction.
+    """
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    _thread = None
+    """Thread that archives the infrastructures periodically."""
+
+    _stop = threading.Event()
+    """Event to stop the archive thread."""
+
+    @staticmethod
+    def create_table(db):
+        """ Create the inf_archive table and the index to find the deleted infrastructures """
+        if not db.table_exists("inf_archive"):
+            db.execute("CREATE TABLE inf_archive(id VARCHAR(255) PRIMARY KEY, date TIMESTAMP, data LONGBLOB)")
+        if not db.index_exists("inf_list", "inf_list_deleted"):
+            db.execute("CREATE INDEX inf_list_deleted ON inf_list (deleted, date)")
+
+    @staticmethod
+    def _get_date_limit(days):
+        """ Get the date (as str comparable with the dates of the DB) of the specified days ago """
+        return (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+    @staticmethod
+    def _get_archive_data(db, inf_id, data):
+        """ Get the complete data of an infrastructure, with the format of InfrastructureInfo.serialize() """
+        dic = json.loads(codec.decode(data))
+        vms = {}
+        for vm_id, vm_data in db.select("select vm_id, data from vm_list where inf_id = %s", (inf_id,)):
+            vms[vm_id] = json.loads(codec.decode(vm_data))
+        logs = {}
+        for vm_id, chunk in db.select("select vm_id, data from ctxt_log where inf_id = %s order by vm_id, pos",
+                                      (inf_id,)):
+            logs.setdefault(vm_id, []).append(codec.decode(chunk))
+
+        if ContextualizationLog.INF_LOG_ID in logs:
+            dic['cont_out'] = "".join(logs[ContextualizationLog.INF_LOG_ID])
+        vm_list = []
+        for vm_data in dic['vm_list']:
+            if isinstance(vm_data, int):
+                if vm_data not in vms:
+                    continue
+                vm_dic = vms[vm_data]
+            else:
+                # VM data stored inside the inf data (previous versions)
+                vm_dic = json.loads(vm_data)
+            if vm_dic['im_id'] in logs:
+                vm_dic['cont_out'] = "".join(logs[vm_dic['im_id']])
+            vm_list.append(json.dumps(vm_dic))
+        dic['vm_list'] = vm_list
+        return json.dumps(dic)
+
+    @staticmethod
+    def archive(db_url, days, purge_days=0, batch_size=100):
+        """
+        Move to the archive the infrastructures deleted more than the specified days ago
+        (or remove them if they were deleted more than purge_days ago).
+
+        Returns: the number of infrastructures archived or removed.
+        """
+        db = DataBase(db_url)
+        if not db.connect():
+            InfrastructureArchive.logger.error("ERROR connecting with the database!.")
+            return 0
+
+        total = 0
+        date_limit = InfrastructureArchive._get_date_limit(days)
+        purge_limit = InfrastructureArchive._get_date_limit(purge_days) if purge_days > 0 else None
+        try:
+            data_codec = codec.get_codec()
+            while not InfrastructureArchive._stop.is_set():
+                res = db.select("select id, date, data from inf_list where deleted = 1 and date < %s"
+                                " order by date limit %s", (date_limit, batch_size))
+                sentences = []
+                for inf_id, date, data in res:
+                    if purge_limit is None or str(date) >= purge_limit:
+                        try:
+                            archive_data = InfrastructureArchive._get_archive_data(db, inf_id, data)
+                        except Exception:
+                            InfrastructureArchive.logger.exception("Inf ID: %s: Error reading the data to archive."
+                                                                   " Archiving only the inf data." % inf_id)
+                            archive_data = codec.decode(data)
+                        sentences.append(("replace into inf_archive (id, date, data) values (%s, %s, %s)",
+                                          (inf_id, date, db.blob(data_codec.encode(archive_data)))))
+                    for table, column in [("vm_list", "inf_id"), ("ctxt_log", "inf_id"),
+                                          ("inf_owner", "inf_id"), ("inf_list", "id")]:
+                        sentences.append(("delete from " + table + " where " + column + " = %s", (inf_id,)))
+                db.execute_batch(sentences)
+                total += len(res)
+                if len(res) < batch_size:
+                    break
+        finally:
+            db.close()
+        return total
+
+    @staticmethod
+    def purge(db_url, days, batch_size=100):
+        """
+        Remove from the archive the infrastructures deleted more than the specified days ago
+
+        Returns: the number of infrastructures removed.
+        """
+        db = DataBase(db_url)
+        if not db.connect():
+            InfrastructureArchive.logger.error("ERROR connecting with the database!.")
+            return 0
+
+        total = 0
+        date_limit = InfrastructureArchive._get_date_limit(days)
+        try:
+            while not InfrastructureArchive._stop.is_set():
+                res = db.select("select id from inf_archive where date < %s order by date limit %s",
+                                (date_limit, batch_size))
+                db.execute_batch([("delete from inf_archive where id = %s", (inf_id,)) for (inf_id,) in res])
+                total += len(res)
+                if len(res) < batch_size:
+                    break
+        finally:
+            db.close()
+        return total
+
+    @staticmethod
+    def get_archived(db_url, inf_id):
+        """
+        Get the data of an archived infrastructure, with the format of the ExportInfrastructure
+        function (so it can be restored with ImportInfrastructure), or None if it does not exist.
+        """
+        db = DataBase(db_url)
+        if not db.connect():
+            InfrastructureArchive.logger.error("ERROR connecting with the database!.")
+            return None
+        try:
+            res = db.select("select data from inf_archive where id = %s", (inf_id,))
+        finally:
+            db.close()
+        if res:
+            return codec.decode(res[0][0])
+        return None
+
+    @staticmethod
+    def run(db_url=None):
+        """
+        Archive and purge the deleted infrastructures as configured in
+        INF_ARCHIVE_DAYS and INF_PURGE_DAYS
+        """
+        if db_url is None:
+            db_url = Config.DATA_DB
+        archived = purged = 0
+        # If the archive is disabled the deleted infrastructures are removed directly
+        days = Config.INF_ARCHIVE_DAYS or Config.INF_PURGE_DAYS
+        if days > 0:
+            archived = InfrastructureArchive.archive(db_url, days, Config.INF_PURGE_DAYS,
+                                                     Config.INF_ARCHIVE_BATCH_SIZE)
+        if Config.INF_PURGE_DAYS > 0:
+            purged = InfrastructureArchive.purge(db_url, Config.INF_PURGE_DAYS, Config.INF_ARCHIVE_BATCH_SIZE)
+        if archived or purged:
+            InfrastructureArchive.logger.info("%d deleted infrastructures archived or removed and %d removed from"
+                                              " the archive." % (archived, purged))
+        return archived, purged
+
+    @staticmethod
+    def _run_periodically():
+        while not InfrastructureArchive._stop.wait(Config.INF_ARCHIVE_INTERVAL):
+            try:
+                InfrastructureArchive.run()
+            except Exception:
+                InfrastructureArchive.logger.exception("ERROR archiving the deleted infrastructures.")
+
+    @staticmethod
+    def start():
+        """ Launch the thread that archives the infrastructures every INF_ARCHIVE_INTERVAL seconds """
+        InfrastructureArchive._stop.clear()
+        InfrastructureArchive._thread = threading.Thread(target=InfrastructureArchive._run_periodically,
+                                                         name="IM archive")
+        InfrastructureArchive._thread.daemon = True
+        InfrastructureArchive._thread.start()
+
+    @staticmethod
+    def stop():
+        """ Stop the archive thread (after finishing the current batch) """
+        if InfrastructureArchive._thread:
+            InfrastructureArchive._stop.set()
+            InfrastructureArchive._thread.join()
+            InfrastructureArchive._thread = None
+            InfrastructureArchive._stop.clear()
@@ -17,6 +17,7 @@
 import logging
 import threading
 import time
+from itertools import count
 from uuid import uuid1
 import json
 
@@ -24,11 +25,13 @@ from ganglia import ganglia_info
 import ConfManager
 from datetime import datetime, timedelta, date
 from radl.radl import RADL, Feature, deploy, system, contextualize_item
-from radl.radl_parse import parse_radl
 from config import Config
 from Queue import PriorityQueue
 from IM.VirtualMachine import VirtualMachine
 from IM.auth import Authentication
+from IM.lazyradl import LazyRADL
+from IM.ctxtlog import ContextualizationLog
+from IM.events import publish
 
 
 class IncorrectVMException(Exception):
@@ -45,7 +48,7 @@ class DeletedVMException(Exception):
         Exception.__init__(self, msg)
 
 
-class InfrastructureInfo:
+class InfrastructureInfo(object):
     """
     Stores all the information about a registered infrastructure.
     """
@@ -55,6 +58,12 @@ class InfrastructureInfo:
 
     FAKE_SYSTEM = "F0000__FAKE_SYSTEM__"
 
+    radl = LazyRADL('radl')
+    """RADL associated to the infrastructure (parsed lazily)."""
+
+    _versions = count(1)
+    """Counter to assign the versions of the Infs (unique in the process, also for the Infs reloaded)."""
+
     def __init__(self):
         self._lock = threading.Lock()
         """Threading Lock to avoid concurrency problems."""
@@ -80,7 +89,7 @@ class InfrastructureInfo:
         """Next vm id available."""
         self.last_ganglia_update = 0
         """Last update of the ganglia info"""
-        self.cont_out = ""
+        self.cont_log = ContextualizationLog()
         """Contextualization output message"""
         self.ctxt_tasks = PriorityQueue()
         """List of contextualization tasks"""
@@ -92,8 +101,20 @@ class InfrastructureInfo:
         """ List of configuration threads."""
         self.last_access = datetime.now()
         """ Time of the last access to this Inf. """
+        self.creation_date = int(time.time())
+        """Creation time of this Inf (None in the Infs created by previous versions)."""
+        self.version = next(InfrastructureInfo._versions)
+        """Change counter of the Inf data, not including the VMs (see :py:meth:`changed`)"""
 
-    def serialize(self):
+    def changed(self):
+        """
+        Register a change of the Inf data (used to detect changes without comparing
+        the data, as in the ETags of the REST API)
+        """
+        self.version = next(InfrastructureInfo._versions)
+
+    def _get_serialize_dict(self):
+        """ Get the dict of the attributes to serialize (without the VMs) """
         with self._lock:
             odict = self.__dict__.copy()
         # Quit the ConfManager object and the lock to the data to be stored
@@ -101,23 +122,51 @@ class InfrastructureInfo:
         del odict['_lock']
         del odict['ctxt_tasks']
         del odict['conf_threads']
+        del odict['cont_log']
+        del odict['version']
         if 'last_access' in odict:
             del odict['last_access']
         if odict['vm_master']:
             odict['vm_master'] = odict['vm_master'].im_id
-        vm_list = []
-        for vm in odict['vm_list']:
-            vm_list.append(vm.serialize())
-        odict['vm_list'] = vm_list
+        odict['vm_list'] = list(odict['vm_list'])
         if odict['auth']:
             odict['auth'] = odict['auth'].serialize()
         if odict['radl']:
-            odict['radl'] = str(odict['radl'])
+            odict['radl'] = LazyRADL.to_str(odict['radl'])
+        return odict
+
+    def serialize(self):
+        """
+        Serialize all the infrastructure data, including the VMs and the contextualization logs
+        """
+        odict = self._get_serialize_dict()
+        odict['vm_list'] = [vm.serialize(cont_out=True) for vm in odict['vm_list']]
+        odict['cont_out'] = self.cont_out
+        return json.dumps(odict)
+
+    def serialize_header(self):
+        """
+        Serialize the infrastructure data, but including only the IDs of the VMs.
+        The VMs must be serialized independently, and the contextualization logs are
+        stored independently (see :py:class:`ContextualizationLog`).
+        """
+        odict = self._get_serialize_dict()
+        odict['vm_list'] = [vm.im_id for vm in odict['vm_list']]
         return json.dumps(odict)
 
     @staticmethod
-    def deserialize(str_data):
+    def deserialize(str_data, vms_data=None):
+        """
+        Deserialize an infrastructure.
+
+        Args:
+
+        - str_data(str): Data generated with serialize() or serialize_header().
+        - vms_data(dict from int to str): In case of serialize_header() data, the serialized data
+          of the VMs of the infrastructure indexed by the VM ID.
+        """
         newinf = InfrastructureInfo()
+        newinf.creation_date = None
         dic = json.loads(str_data)
         vm_list = dic['vm_list']
         vm_master_id = dic['vm_master']
@@ -125,8 +174,12 @@ class InfrastructureInfo:
         dic['vm_list'] = []
         if dic['auth']:
             dic['auth'] = Authentication.deserialize(dic['auth'])
-        if dic['radl']:
-            dic['radl'] = parse_radl(dic['radl'])
+        if 'cont_out' in dic:
+            # Data exported or stored by previous versions, with the complete log
+            newinf.cont_log.reset(dic.pop('cont_out'))
+        else:
+            newinf.cont_log = ContextualizationLog(stored=None)
+        # the radl is parsed when it is accessed (see LazyRADL)
         newinf.__dict__.update(dic)
         newinf.cloud_connector = None
         # Set the ConfManager object and the lock to the data loaded
@@ -134,6 +187,12 @@ class InfrastructureInfo:
         newinf.ctxt_tasks = PriorityQueue()
         newinf.conf_threads = []
         for vm_data in vm_list:
+            if isinstance(vm_data, int):
+                if not vms_data or vm_data not in vms_data:
+                    InfrastructureInfo.logger.error("Inf ID: %s: No data for VM ID %d. Ignoring it." %
+                                                    (newinf.id, vm_data))
+                    continue
+                vm_data = vms_data[vm_data]
             vm = VirtualMachine.deserialize(vm_data)
             vm.inf = newinf
             if vm.im_id == vm_master_id:
@@ -167,6 +226,8 @@ class InfrastructureInfo:
         """
         self.stop()
         self.deleted = True
+        self.changed()
+        publish(self.id, "deleted")
 
     def stop(self):
         """
@@ -180,24 +241,82 @@ class InfrastructureInfo:
         for vm in self.get_vm_list():
             vm.kill_check_ctxt_process()
 
+    @property
+    def cont_out(self):
+        """Contextualization output message (the complete log)"""
+        return self.get_cont_msg()
+
+    @cont_out.setter
+    def cont_out(self, value):
+        self.cont_log.reset(value)
+
     def get_cont_out(self):
         """
         Returns the contextualization message
         """
         return self.cont_out
 
+    def get_cont_msg(self, offset=0, limit=None):
+        """
+        Get the contextualization message, or a part of it
+        (see :py:meth:`ContextualizationLog.read`)
+        """
+        return self.cont_log.read(self.id, ContextualizationLog.INF_LOG_ID, offset, limit)
+
+    def get_cont_msg_size(self):
+        """ Get the size of the contextualization message """
+        return self.cont_log.size(self.id, ContextualizationLog.INF_LOG_ID)
+
     def add_vm(self, vm):
         """
         Add, and assigns a new VM ID to the infrastructure
         """
         with self._lock:
             self.vm_list.append(vm)
+        self.changed()
 
     def add_cont_msg(self, msg):
         """
         Add a line to the contextualization message
         """
-        self.cont_out += str(datetime.now()) + ": " + str(msg.decode('utf8', 'ignore')) + "\n"
+        line = str(datetime.now()) + ": " + str(msg.decode('utf8', 'ignore')) + "\n"
+        self.cont_log.append(line)
+        publish(self.id, "contmsg", {'msg': line})
+
+    @staticmethod
+    def get_aggregated_state(vm_list):
+        """
+        Get the aggregated state of an infrastructure from the (last known) state of its VMs.
+        """
+        state = None
+        for vm in vm_list:
+            if vm.state == VirtualMachine.FAILED:
+                state = VirtualMachine.FAILED
+                break
+            elif vm.state == VirtualMachine.UNKNOWN:
+                state = VirtualMachine.UNKNOWN
+                break
+            elif vm.state == VirtualMachine.PENDING:
+                state = VirtualMachine.PENDING
+            elif vm.state == VirtualMachine.RUNNING:
+                if state != VirtualMachine.PENDING:
+                    state = VirtualMachine.RUNNING
+            elif vm.state == VirtualMachine.STOPPED:
+                if state is None:
+                    state = VirtualMachine.STOPPED
+            elif vm.state == VirtualMachine.OFF:
+                if state is None:
+                    state = VirtualMachine.OFF
+            elif vm.state == VirtualMachine.CONFIGURED:
+                if state is None:
+                    state = VirtualMachine.CONFIGURED
+            elif vm.state == VirtualMachine.UNCONFIGURED:
+                if state is None or state == VirtualMachine.CONFIGURED:
+                    state = VirtualMachine.UNCONFIGURED
+
+        if state is None:
+            state = VirtualMachine.UNKNOWN
+        return state
 
     def get_vm_list(self):
         """
@@ -288,6 +407,7 @@ class InfrastructureInfo:
                     else:
                         self.private_networks[private_net] = d.cloud_id
 
+        self.changed()
         # Check the RADL
         self.radl.check()
 
@@ -397,11 +517,14 @@ class InfrastructureInfo:
 
     def set_configured(self, conf):
         with self._lock:
+            old_conf = self.configured
             if conf:
                 if self.configured is None:
                     self.configured = conf
             else:
                 self.configured = conf
+        if self.configured != old_conf:
+            publish(self.id, "configured", {'configured': self.configured})
 
     def is_configured(self):
         if self.vm_in_ctxt_tasks(self) or self.conf_threads:
@@ -16,12 +16,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import json
+import time
+import hashlib
 import logging
 import threading
-
-from IM.db import DataBase
+import weakref
+
+from IM.db import DataBase, SchemaManager
+from IM import codec
+from IM.ctxtlog import ContextualizationLog
+from IM.InfrastructureArchive import InfrastructureArchive
+from IM.idempotency import IdempotencyKeys
+from IM.journal import JournalStore
 from IM.config import Config
 import IM.InfrastructureInfo
+from radl.radl_json import parse_radl as parse_radl_json
 
 '''
 Created on 17 nov. 2016
@@ -30,6 +40,33 @@ Created on 17 nov. 2016
 '''
 
 
+class SaveRequest():
+    """
+    Pending save of an infrastructure in the write-behind queue.
+    All the saves of the same infrastructure requested before it is written are merged in it.
+    """
+
+    def __init__(self, inf):
+        self.inf = inf
+        """:py:class:`InfrastructureInfo` to save."""
+        self.time = time.time()
+        """Time of the first save requested."""
+        self.urgent = False
+        """Flag to write it as soon as possible (some thread is waiting for it)."""
+        self.done = threading.Event()
+        """Event set when the data has been written."""
+        self.retries = 0
+        """Number of failed attempts to write the data."""
+        self.merged = []
+        """Later saves of the same infrastructure merged in this one when it was queued again."""
+
+    def set_done(self):
+        """Set the done event of this save and of the saves merged in it."""
+        self.done.set()
+        for request in self.merged:
+            request.set_done()
+
+
 class InfrastructureList():
     """
     Class to manage the list of infrastructures and the serialization of the data
@@ -44,8 +81,33 @@ class InfrastructureList():
     _lock = threading.Lock()
     """Threading Lock to avoid concurrency problems."""
 
-    infrastructure_auth = {}
-    """Map from string to :py:class:`Authentication`."""
+    _evicted = weakref.WeakValueDictionary()
+    """Infrastructures evicted from infrastructure_list that may still be used by some thread."""
+
+    _cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'revalidations': 0}
+    """Counters of the infrastructures found in memory, loaded from the DB, evicted from memory
+    and found in memory after checking their version in the DB (HA mode)."""
+
+    _save_queue = {}
+    """Map from inf ID to the :py:class:`SaveRequest` pending to be written by the write-behind thread."""
+
+    _save_cond = threading.Condition()
+    """Condition to synchronize the access to the write-behind queue."""
+
+    _writer = None
+    """Write-behind thread."""
+
+    ANY_OWNER = "*"
+    """Owner of the infrastructures that can be accessed by any user (without IM username or password)."""
+
+    LIST_FILTERS = ['state', 'cloud', 'created_after', 'created_before', 'deleted']
+    """Filters of the lists of infrastructures: last state stored, cloud type of some VM,
+    creation date range ("YYYY-MM-DD[ HH:MM:SS]") and deleted (not archived yet) flag."""
+
+    _saved_digests = {}
+    """Map from (DB URL, inf ID) to a dict with the digests of the data stored in the DB of the
+    infrastructure header (key None) and of each VM (key VM ID), and the version of the
+    infrastructure in the DB (key 'version')."""
 
     @staticmethod
     def add_infrastructure(inf):
@@ -53,59 +115,219 @@ class InfrastructureList():
 
         with InfrastructureList._lock:
             InfrastructureList.infrastructure_list[inf.id] = inf
+            InfrastructureList._evict()
 
     @staticmethod
     def remove_inf(del_inf):
         """Remove destroyed infrastructure."""
 
         with InfrastructureList._lock:
-            del InfrastructureList.infrastructure_list[del_inf.id]
+            InfrastructureList.infrastructure_list.pop(del_inf.id, None)
+            InfrastructureList._evicted.pop(del_inf.id, None)
+
+    @staticmethod
+    def _get_inf_from_memory(inf_id):
+        """
+        Get an infrastructure from memory (None if it is not in memory).
+        If it has been evicted but it is still used by some thread, it is returned to the list.
+        """
+        inf = InfrastructureList.infrastructure_list.get(inf_id)
+        if inf is None:
+            inf = InfrastructureList._evicted.get(inf_id)
+            if inf is not None:
+                with InfrastructureList._lock:
+                    InfrastructureList.infrastructure_list[inf_id] = inf
+                    InfrastructureList._evicted.pop(inf_id, None)
+        return inf
+
+    @staticmethod
+    def _get_inf_size(inf_id):
+        """ Get the estimated size (in bytes) of an infrastructure (the size of its data in the DB) """
+        return InfrastructureList._saved_digests.get((Config.DATA_DB, inf_id), {}).get('size', 0)
+
+    @staticmethod
+    def _is_in_use(inf):
+        """ Check if an infrastructure has running contextualization threads or data pending to be written """
+        if inf.cm is not None and inf.cm.isAlive():
+            return True
+        if [t for t in inf.conf_threads if t.isAlive()]:
+            return True
+        return inf.id in InfrastructureList._save_queue
+
+    @staticmethod
+    def _evict():
+        """
+        Remove the least recently used infrastructures from memory while there are more than
+        INF_CACHE_MAX_ENTRIES or their size is over INF_CACHE_MAX_BYTES.
+        Infrastructures in use (see _is_in_use) are never evicted.
+        Must be called with the lock acquired.
+        """
+        max_entries = Config.INF_CACHE_MAX_ENTRIES
+        max_bytes = Config.INF_CACHE_MAX_BYTES
+        if max_entries <= 0 and max_bytes <= 0:
+            return
+
+        inf_list = InfrastructureList.infrastructure_list
+        entries = len(inf_list)
+        total_size = sum(InfrastructureList._get_inf_size(inf_id) for inf_id in inf_list) if max_bytes > 0 else 0
+
+        for inf in sorted(inf_list.values(), key=lambda inf: inf.last_access):
+            if (max_entries <= 0 or entries <= max_entries) and (max_bytes <= 0 or total_size <= max_bytes):
+                break
+            if InfrastructureList._is_in_use(inf):
+                continue
+            del inf_list[inf.id]
+            # Maintain a weak reference in case some thread is still using it
+            InfrastructureList._evicted[inf.id] = inf
+            entries -= 1
+            if max_bytes > 0:
+                total_size -= InfrastructureList._get_inf_size(inf.id)
+            InfrastructureList._cache_stats['evictions'] += 1
+            InfrastructureList.logger.debug("Inf ID: %s: Evicted from memory." % inf.id)
+
+    @staticmethod
+    def _is_cache_full():
+        """ Check if the infrastructures in memory have reached INF_CACHE_MAX_ENTRIES or INF_CACHE_MAX_BYTES """
+        inf_list = InfrastructureList.infrastructure_list
+        if Config.INF_CACHE_MAX_ENTRIES > 0 and len(inf_list) >= Config.INF_CACHE_MAX_ENTRIES:
+            return True
+        if Config.INF_CACHE_MAX_BYTES > 0:
+            size = sum(InfrastructureList._get_inf_size(inf_id) for inf_id in inf_list)
+            return size >= Config.INF_CACHE_MAX_BYTES
+        return False
+
+    @staticmethod
+    def warm_up():
+        """
+        Launch a thread that loads in memory the most recently saved infrastructures (not
+        loaded yet) until the cache limits (INF_CACHE_MAX_ENTRIES and INF_CACHE_MAX_BYTES)
+        are reached. The data is streamed from the DB in chunks.
+
+        Returns: the warm-up thread.
+        """
+        thread = threading.Thread(target=InfrastructureList._warm_up, name="IM warm-up")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _warm_up():
+        init = time.time()
+        loaded = 0
+        db = DataBase(Config.DATA_DB)
+        if not db.connect():
+            InfrastructureList.logger.error("ERROR connecting with the database!.")
+            return
+
+        try:
+            infs_data = InfrastructureList._iter_data_from_db(db)
+            for inf_id, data, vms_data, version in infs_data:
+                if InfrastructureList._is_cache_full():
+                    break
+                if inf_id in InfrastructureList.infrastructure_list:
+                    continue
+                inf, digests = InfrastructureList._deserialize(data, vms_data, version=version)
+                if not inf:
+                    continue
+                key = (Config.DATA_DB, inf.id)
+                with InfrastructureList._lock:
+                    # Check that it has not been loaded or saved meanwhile
+                    # (there is no digest of the data stored with other codec)
+                    if (inf.id not in InfrastructureList.infrastructure_list and
+                            inf.id not in InfrastructureList._evicted and
+                            InfrastructureList._saved_digests.get(key, digests).get(None) == digests.get(None)):
+                        InfrastructureList.infrastructure_list[inf.id] = inf
+                        InfrastructureList._saved_digests[key] = digests
+                        loaded += 1
+            infs_data.close()
+        except Exception:
+            InfrastructureList.logger.exception("ERROR in the warm-up of the infrastructures.")
+        finally:
+            db.close()
+
+        InfrastructureList.logger.info("Warm-up finished: %d infrastructures loaded in %.2f secs." %
+                                       (loaded, time.time() - init))
+
+    @staticmethod
+    def get_cache_stats():
+        """
+        Get the statistics of the infrastructures maintained in memory
+
+        Returns: a dict with the number of infrastructures in memory (entries), their
+                 estimated size (bytes) and the hits, misses, evictions and revalidations counters.
+        """
+        with InfrastructureList._lock:
+            res = dict(InfrastructureList._cache_stats)
+            res['entries'] = len(InfrastructureList.infrastructure_list)
+            res['bytes'] = sum(InfrastructureList._get_inf_size(inf_id)
+                               for inf_id in InfrastructureList.infrastructure_list)
+        return res
 
     @staticmethod
-    def get_inf_ids(auth=None):
-        """ Get the IDs of the Infrastructures """
+    def get_inf_ids(auth=None, limit=0, after=None, filters=None):
+        """
+        Get the IDs of the Infrastructures (in descending order)
+
+        Args:
+
+        - auth(Authentication): Get only the infrastructures of the owner of the auth data.
+        - limit(int): Maximum number of IDs to return (0 means no limit).
+        - after(str): Return the IDs after this one (the last ID of the previous page).
+        - filters(dict): Filters of the infrastructures (see :py:attr:`LIST_FILTERS`).
+        """
         if auth:
-            # In this case only loads the auth data to improve performance
-            inf_ids = []
-            for inf_id in InfrastructureList._get_inf_ids_from_db():
-                # I we have the data in memory, use it
-                if inf_id in InfrastructureList.infrastructure_auth:
-                    inf = InfrastructureList.infrastructure_auth[inf_id]
-                    if inf.is_authorized(auth):
-                        inf_ids.append(inf_id)
-                else:
-                    res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf_id, auth)
-                    if res:
-                        inf = res[inf_id]
-                        # store in memory to improve later requests
-                        InfrastructureList.infrastructure_auth[inf_id] = inf
-                        if inf and inf.is_authorized(auth):
-                            inf_ids.append(inf.id)
-            return inf_ids
+            # Use the owners table to get only the authorized ones
+            owner = InfrastructureList._get_owner(auth)
+            if owner in [None, InfrastructureList.ANY_OWNER]:
+                return []
+            return InfrastructureList._get_inf_ids_from_db(owner, limit, after, filters)
         else:
-            return InfrastructureList._get_inf_ids_from_db()
+            return InfrastructureList._get_inf_ids_from_db(limit=limit, after=after, filters=filters)
 
     @staticmethod
     def get_infrastructure(inf_id):
-        """ Get the infrastructure object """
-        if inf_id in InfrastructureList.infrastructure_list:
-            inf = InfrastructureList.infrastructure_list[inf_id]
-            if not inf.has_expired():
-                inf.touch()
-                return inf
-
-        if inf_id in InfrastructureList.get_inf_ids():
-            # Load the data from DB:
-            res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf_id)
-            if res:
-                inf = res[inf_id]
+        """ Get the infrastructure object (None if it does not exist or it is deleted) """
+        inf = InfrastructureList._get_inf_from_memory(inf_id)
+        if inf and (not inf.has_expired() or InfrastructureList._is_up_to_date(inf)):
+            inf.touch()
+            InfrastructureList._cache_stats['hits'] += 1
+            return inf
+
+        # Load the data from DB:
+        InfrastructureList._cache_stats['misses'] += 1
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf_id)
+        if res:
+            inf = res[inf_id]
+            with InfrastructureList._lock:
                 InfrastructureList.infrastructure_list[inf_id] = inf
-                return inf
-            else:
-                return None
+                InfrastructureList._evict()
+            return inf
         else:
             return None
 
+    @staticmethod
+    def _is_up_to_date(inf):
+        """
+        Check if the data of an infrastructure in memory is the last one stored in the DB
+        (it may have been modified by other IM instance in HA mode), comparing its version.
+        """
+        if inf.id in InfrastructureList._save_queue:
+            # It has changes pending to be written, so it is newer than the DB one
+            return True
+        version = InfrastructureList._saved_digests.get((Config.DATA_DB, inf.id), {}).get('version')
+        if version is None:
+            return False
+        db = DataBase(Config.DATA_DB)
+        if db.connect():
+            try:
+                res = db.select("select version from inf_list where id = %s and deleted = 0", (inf.id,))
+            finally:
+                db.close()
+            if res and res[0][0] == version:
+                InfrastructureList._cache_stats['revalidations'] += 1
+                return True
+        return False
+
     @staticmethod
     def stop():
         """ Stop securely the IM service """
@@ -114,10 +336,14 @@ class InfrastructureList():
             # Stop all the Ctxt threads of the Infrastructures
             for inf in InfrastructureList.infrastructure_list.values():
                 inf.stop()
+        # Write the pending data and stop the write-behind thread
+        InfrastructureList.flush(stop_writer=True)
+        JournalStore.close_all()
 
     @staticmethod
     def load_data():
         """ Load Data from DB """
+        InfrastructureList.init_table()
         with InfrastructureList._lock:
             try:
                 inf_list = InfrastructureList._get_data_from_db(Config.DATA_DB)
@@ -128,19 +354,35 @@ class InfrastructureList():
                 sys.exit(-1)
 
     @staticmethod
-    def save_data(inf_id=None):
+    def save_data(inf_id=None, wait=True):
         """
         Save data to DB
 
         Args:
 
         - inf_id(str): ID of the infrastructure to save. If None all will be saved.
+        - wait(bool): In write-behind mode (DB_WRITE_BEHIND) wait for the data to be written.
+          Set it to False in background tasks that do not need to wait for it.
         """
+        if inf_id:
+            inf = InfrastructureList._get_inf_from_memory(inf_id)
+            if inf is None:
+                InfrastructureList.logger.warn("Inf ID: %s: Not in memory, not saved." % inf_id)
+                return
+
+        if Config.DB_WRITE_BEHIND and inf_id:
+            request = InfrastructureList._queue_save(inf, wait)
+            if wait:
+                request.done.wait()
+            return
+
         with InfrastructureList._lock:
             try:
-                res = InfrastructureList._save_data_to_db(Config.DATA_DB,
-                                                          InfrastructureList.infrastructure_list,
-                                                          inf_id)
+                if inf_id:
+                    inf_list = {inf_id: inf}
+                else:
+                    inf_list = InfrastructureList.infrastructure_list
+                res = InfrastructureList._save_data_to_db(Config.DATA_DB, inf_list)
                 if not res:
                     InfrastructureList.logger.error("ERROR saving data.\nChanges not stored!!")
                     sys.stderr.write("ERROR saving data.\nChanges not stored!!")
@@ -148,20 +390,329 @@ class InfrastructureList():
                 InfrastructureList.logger.exception("ERROR saving data. Changes not stored!!")
                 sys.stderr.write("ERROR saving data: " + str(ex) + ".\nChanges not stored!!")
 
+    @staticmethod
+    def _queue_save(inf, urgent):
+        """
+        Add an infrastructure to the write-behind queue (or merge it with the pending save)
+
+        Returns: the :py:class:`SaveRequest` that will write the data.
+        """
+        with InfrastructureList._save_cond:
+            request = InfrastructureList._save_queue.get(inf.id)
+            if request is None:
+                request = SaveRequest(inf)
+                InfrastructureList._save_queue[inf.id] = request
+            request.urgent = request.urgent or urgent
+            if InfrastructureList._writer is None or not InfrastructureList._writer.is_alive():
+                InfrastructureList._writer = threading.Thread(target=InfrastructureList._write_behind,
+                                                              name="IM DB writer")
+                InfrastructureList._writer.daemon = True
+                InfrastructureList._writer.start()
+            InfrastructureList._save_cond.notify_all()
+        return request
+
+    @staticmethod
+    def _get_ready_saves(stop_when_empty=False):
+        """
+        Wait for the saves that must be written: the urgent ones and the ones that have been
+        in the queue more than DB_WRITE_BEHIND_DELAY seconds.
+
+        Returns: a list of :py:class:`SaveRequest` or None if the writer thread must finish.
+        """
+        with InfrastructureList._save_cond:
+            while True:
+                queue = InfrastructureList._save_queue
+                if not queue and InfrastructureList._writer is not threading.current_thread():
+                    return None
+                now = time.time()
+                wait_time = None
+                for request in queue.values():
+                    remaining = request.time + Config.DB_WRITE_BEHIND_DELAY - now
+                    if request.urgent or remaining <= 0:
+                        # Write all the pending saves in the same transaction
+                        requests = queue.values()
+                        InfrastructureList._save_queue = {}
+                        return requests
+                    elif wait_time is None or remaining < wait_time:
+                        wait_time = remaining
+                InfrastructureList._save_cond.wait(wait_time)
+
+    @staticmethod
+    def _write_behind():
+        """ Write-behind thread: writes the saves of the queue in batched transactions """
+        while True:
+            requests = InfrastructureList._get_ready_saves()
+            if requests is None:
+                break
+            res = False
+            try:
+                infs = dict((request.inf.id, request.inf) for request in requests)
+                # Do not write at the same time than the synchronous saves
+                with InfrastructureList._lock:
+                    res = InfrastructureList._save_data_to_db(Config.DATA_DB, infs)
+                if not res:
+                    InfrastructureList.logger.error("ERROR saving data. Changes will be retried.")
+            except Exception:
+                InfrastructureList.logger.exception("ERROR saving data. Changes will be retried.")
+            finally:
+                if res:
+                    for request in requests:
+                        request.set_done()
+                else:
+                    InfrastructureList._requeue_saves(requests)
+
+    @staticmethod
+    def _requeue_saves(requests):
+        """
+        Queue again the saves that have failed, to retry them after DB_WRITE_BEHIND_DELAY seconds.
+        The ones that have failed more than DB_WRITE_BEHIND_RETRIES times are discarded.
+        """
+        with InfrastructureList._save_cond:
+            now = time.time()
+            for request in requests:
+                request.retries += 1
+                if request.retries > Config.DB_WRITE_BEHIND_RETRIES:
+                    InfrastructureList.logger.error("Inf ID: %s: ERROR saving data.\nChanges not stored!!" %
+                                                    request.inf.id)
+                    request.set_done()
+                    continue
+                newer = InfrastructureList._save_queue.get(request.inf.id)
+                if newer is not None:
+                    # The data of the infrastructure is the same object, write both in one save
+                    request.merged.append(newer)
+                request.time = now
+                request.urgent = False
+                InfrastructureList._save_queue[request.inf.id] = request
+            InfrastructureList._save_cond.notify_all()
+
+    @staticmethod
+    def flush(stop_writer=False):
+        """
+        Write all the saves pending in the write-behind queue and wait for them.
+
+        Args:
+
+        - stop_writer(bool): Also finish the write-behind thread.
+        """
+        with InfrastructureList._save_cond:
+            requests = InfrastructureList._save_queue.values()
+            for request in requests:
+                request.urgent = True
+            writer = InfrastructureList._writer
+            if stop_writer:
+                InfrastructureList._writer = None
+            InfrastructureList._save_cond.notify_all()
+
+        for request in requests:
+            request.done.wait()
+        if stop_writer and writer:
+            writer.join()
+
     @staticmethod
     def init_table():
-        """ Creates de database """
-        db = DataBase(Config.DATA_DB)
-        if db.connect():
-            if not db.table_exists("inf_list"):
-                db.execute("CREATE TABLE inf_list(id VARCHAR(255) PRIMARY KEY, deleted INTEGER,"
-                           " date TIMESTAMP, data LONGBLOB)")
-                db.close()
-                return True
-        else:
+        """
+        Creates the database schema or upgrades it to the last version.
+        It must be called once at IM start.
+
+        Returns: True if the schema is ready or False in case of error.
+        """
+        try:
+            version = SchemaManager(Config.DATA_DB, InfrastructureList._get_migrations()).upgrade()
+        except Exception:
+            InfrastructureList.logger.exception("ERROR upgrading the database schema!.")
+            return False
+
+        if version is None:
             InfrastructureList.logger.error("ERROR connecting with the database!.")
+            return False
+        return True
 
-        return False
+    @staticmethod
+    def _get_migrations():
+        """ Get the list of versions of the DB schema and the functions to upgrade to them """
+        return [(1, InfrastructureList._create_inf_list),
+                (2, InfrastructureList._convert_radl_json),
+                (3, InfrastructureList._split_vm_data),
+                (4, InfrastructureList._create_inf_owner),
+                (5, InfrastructureList._add_inf_version),
+                (6, ContextualizationLog.create_table),
+                (7, InfrastructureArchive.create_table),
+                (8, InfrastructureList._add_inf_owner_fields),
+                (9, IdempotencyKeys.create_table),
+                (10, InfrastructureList._add_inf_date_index)]
+
+    @staticmethod
+    def _create_inf_list(db):
+        """ Create the inf_list table (if the DB was not created with a previous version) """
+        if not db.table_exists("inf_list"):
+            db.execute("CREATE TABLE inf_list(id VARCHAR(255) PRIMARY KEY, deleted INTEGER,"
+                       " date TIMESTAMP, data LONGBLOB)")
+
+    @staticmethod
+    def _convert_radl_json(db):
+        """ Convert the RADL documents stored in JSON format (IM versions prior to 1.5.1) to plain RADL """
+        def to_radl(data):
+            if data and data.lstrip().startswith("["):
+                return str(parse_radl_json(data))
+            return data
+
+        for (inf_id,) in db.select("select id from inf_list where deleted = 0"):
+            res = db.select("select data from inf_list where id = %s", (inf_id,))
+            if not res:
+                continue
+            dic = json.loads(res[0][0])
+            if not dic['radl'] or not dic['radl'].lstrip().startswith("["):
+                continue
+            dic['radl'] = to_radl(dic['radl'])
+            vm_list = []
+            for vm_data in dic['vm_list']:
+                vm_dic = json.loads(vm_data)
+                vm_dic['info'] = to_radl(vm_dic['info'])
+                vm_dic['requested_radl'] = to_radl(vm_dic['requested_radl'])
+                vm_list.append(json.dumps(vm_dic))
+            dic['vm_list'] = vm_list
+            db.execute("update inf_list set data = %s where id = %s", (json.dumps(dic), inf_id))
+
+    @staticmethod
+    def _split_vm_data(db):
+        """
+        Create the vm_list table and move the data of the VMs, previously stored
+        inside the infrastructure data, to it (one row per VM)
+        """
+        if not db.table_exists("vm_list"):
+            db.execute("CREATE TABLE vm_list(inf_id VARCHAR(255), vm_id INTEGER, data LONGBLOB,"
+                       " PRIMARY KEY (inf_id, vm_id))")
+
+        for (inf_id,) in db.select("select id from inf_list"):
+            res = db.select("select data from inf_list where id = %s", (inf_id,))
+            if not res:
+                continue
+            dic = json.loads(res[0][0])
+            sentences = []
+            vm_ids = []
+            for vm_data in dic['vm_list']:
+                if isinstance(vm_data, int):
+                    # already converted
+                    vm_ids.append(vm_data)
+                else:
+                    vm_id = json.loads(vm_data)['im_id']
+                    vm_ids.append(vm_id)
+                    sentences.append(("replace into vm_list (inf_id, vm_id, data) values (%s, %s, %s)",
+                                      (inf_id, vm_id, vm_data)))
+            if sentences:
+                dic['vm_list'] = vm_ids
+                sentences.append(("update inf_list set data = %s where id = %s", (json.dumps(dic), inf_id)))
+                db.execute_batch(sentences)
+
+    @staticmethod
+    def _create_inf_owner(db):
+        """ Create the inf_owner table and fill it with the owners of the current infrastructures """
+        if not db.table_exists("inf_owner"):
+            db.execute("CREATE TABLE inf_owner(owner VARCHAR(64), inf_id VARCHAR(255),"
+                       " PRIMARY KEY (owner, inf_id))")
+        if not db.index_exists("inf_owner", "inf_owner_inf_id"):
+            db.execute("CREATE INDEX inf_owner_inf_id ON inf_owner (inf_id)")
+
+        sentences = []
+        for (inf_id,) in db.select("select id from inf_list where deleted = 0"):
+            res = db.select("select data from inf_list where id = %s", (inf_id,))
+            if not res:
+                continue
+            try:
+                inf = IM.InfrastructureInfo.InfrastructureInfo.deserialize_auth(res[0][0])
+            except Exception:
+                InfrastructureList.logger.exception("ERROR reading infrastructure %s, ignoring it!." % inf_id)
+                continue
+            owner = InfrastructureList._get_owner(inf.auth)
+            if owner:
+                sentences.append(("replace into inf_owner (owner, inf_id) values (%s, %s)", (owner, inf_id)))
+            if len(sentences) >= 1000:
+                db.execute_batch(sentences)
+                sentences = []
+        db.execute_batch(sentences)
+
+    @staticmethod
+    def _add_inf_version(db):
+        """
+        Add the version column to the inf_list table: a counter incremented each time
+        the infrastructure is saved, to check if the data in memory is up to date
+        """
+        if not db.column_exists("inf_list", "version"):
+            db.execute("ALTER TABLE inf_list ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    @staticmethod
+    def _add_inf_owner_fields(db):
+        """
+        Add to the inf_owner table the fields to filter the lists of infrastructures: deleted flag,
+        state, cloud types and creation date (the date of the last save in the existing ones).
+        The rows of the deleted infrastructures are kept until they are archived.
+        """
+        for column, definition in [("deleted", "INTEGER NOT NULL DEFAULT 0"), ("state", "VARCHAR(32)"),
+                                   ("clouds", "VARCHAR(255)"), ("created", "TIMESTAMP NULL DEFAULT NULL")]:
+            if not db.column_exists("inf_owner", column):
+                db.execute("ALTER TABLE inf_owner ADD COLUMN %s %s" % (column, definition))
+        db.execute("update inf_owner set created = (select date from inf_list where inf_list.id = inf_owner.inf_id)"
+                   " where created is null")
+        if not db.index_exists("inf_owner", "inf_owner_created"):
+            db.execute("CREATE INDEX inf_owner_created ON inf_owner (owner, created)")
+
+    @staticmethod
+    def _add_inf_date_index(db):
+        """ Add an index to the inf_list table to iterate over the infrastructures by save date """
+        if not db.index_exists("inf_list", "inf_list_date"):
+            db.execute("CREATE INDEX inf_list_date ON inf_list (deleted, date)")
+
+    @staticmethod
+    def _get_listing(inf):
+        """
+        Get the fields of an infrastructure stored in the inf_owner table to filter the lists:
+        a tuple (owner, deleted, state, clouds), clouds is a comma separated list of the
+        cloud types of the VMs (also starting and ending with a comma).
+        """
+        vm_list = inf.get_vm_list()
+        clouds = sorted(set(vm.cloud.type for vm in vm_list if vm.cloud))
+        return (InfrastructureList._get_owner(inf.auth), int(inf.deleted),
+                IM.InfrastructureInfo.InfrastructureInfo.get_aggregated_state(vm_list),
+                ",%s," % ",".join(clouds) if clouds else None)
+
+    @staticmethod
+    def _get_listing_sentences(inf, listing):
+        """ Get the sentences to store the fields of an infrastructure in the inf_owner table """
+        if not listing[0]:
+            return [("delete from inf_owner where inf_id = %s", (inf.id,))]
+        created = None
+        if inf.creation_date:
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(inf.creation_date))
+        # Update the row keeping the creation date, or insert it if it does not exist
+        return [("update inf_owner set owner = %s, deleted = %s, state = %s, clouds = %s where inf_id = %s",
+                 listing + (inf.id,)),
+                ("insert into inf_owner (owner, inf_id, deleted, state, clouds, created)"
+                 " select %s, %s, %s, %s, %s, coalesce(%s, date) from inf_list where id = %s"
+                 " and not exists (select * from inf_owner where inf_id = %s)",
+                 (listing[0], inf.id) + listing[1:] + (created, inf.id, inf.id))]
+
+    @staticmethod
+    def _get_owner(auth):
+        """
+        Get the ID of the owner of an infrastructure from its auth data:
+        a hash of the username and password of the InfrastructureManager auth.
+
+        Returns: the hash, ANY_OWNER if the username or password is not set or None
+                 if there is no InfrastructureManager auth.
+        """
+        if not auth:
+            return None
+        im_auth = auth.getAuthInfo("InfrastructureManager")
+        if not im_auth:
+            return None
+        if 'username' not in im_auth[0] or 'password' not in im_auth[0]:
+            return InfrastructureList.ANY_OWNER
+        return hashlib.sha256(json.dumps([im_auth[0]['username'], im_auth[0]['password']])).hexdigest()
+
+    @staticmethod
+    def _get_digest(data):
+        """ Get the digest used to check if some data has changed since it was stored """
+        return hashlib.md5(data).hexdigest()
 
     @staticmethod
     def _get_data_from_db(db_url, inf_id=None, auth=None):
@@ -170,68 +721,256 @@ class InfrastructureList():
         If no inf_id specified all Infrastructures are loaded.
         If auth is specified only auth data will be loaded.
         """
-        if InfrastructureList.init_table():
-            return {}
-        else:
-            db = DataBase(db_url)
-            if db.connect():
-                inf_list = {}
+        db = DataBase(db_url)
+        if db.connect():
+            inf_list = {}
+            try:
                 if inf_id:
-                    res = db.select("select * from inf_list where id = '%s'" % inf_id)
-                else:
-                    res = db.select("select * from inf_list where deleted = 0 order by id desc")
-                if len(res) > 0:
-                    for elem in res:
-                        # inf_id = elem[0]
-                        # date = elem[1]
-                        # deleted = elem[2]
-                        try:
-                            if auth:
-                                inf = IM.InfrastructureInfo.InfrastructureInfo.deserialize_auth(elem[3])
-                            else:
-                                inf = IM.InfrastructureInfo.InfrastructureInfo.deserialize(elem[3])
-                            inf_list[inf.id] = inf
-                        except:
-                            InfrastructureList.logger.exception(
-                                "ERROR reading infrastructure from database, ignoring it!.")
+                    # Each row is (inf_id, vm_id, data, version), vm_id is -1 for the infrastructure data
+                    if auth:
+                        res = db.select("select id, -1, data, version from inf_list where id = %s and deleted = 0",
+                                        (inf_id,))
+                    else:
+                        res = db.select("select id, -1, data, version from inf_list where id = %s and deleted = 0"
+                                        " union all select inf_id, vm_id, data, 0 from vm_list where inf_id = %s",
+                                        (inf_id, inf_id))
+                    infs_data = []
+                    vms_data = {}
+                    for _, vm_id, data, version in res:
+                        if vm_id == -1:
+                            infs_data.append((inf_id, data, vms_data, version))
+                        else:
+                            vms_data[vm_id] = data
+                elif auth:
+                    res = db.select("select id, data from inf_list where deleted = 0 order by id desc")
+                    infs_data = [(elem_inf_id, data, None, None) for elem_inf_id, data in res]
                 else:
-                    InfrastructureList.logger.warn("No data in database!.")
-
+                    infs_data = InfrastructureList._iter_data_from_db(db)
+
+                for elem_inf_id, data, vms_data, version in infs_data:
+                    inf, digests = InfrastructureList._deserialize(data, vms_data, auth, version)
+                    if inf:
+                        if digests:
+                            InfrastructureList._saved_digests[(db_url, inf.id)] = digests
+                        inf_list[inf.id] = inf
+            finally:
                 db.close()
-                return inf_list
+
+            if not inf_list and not inf_id:
+                InfrastructureList.logger.warn("No data in database!.")
+
+            return inf_list
+        else:
+            InfrastructureList.logger.error("ERROR connecting with the database!.")
+            return {}
+
+    @staticmethod
+    def _iter_data_from_db(db):
+        """
+        Iterate over the data of all the infrastructures not deleted, the most recently saved first,
+        reading it from the DB in chunks of DB_FETCH_SIZE infrastructures: the headers are paginated
+        using the inf_list_date index and then the VMs of each chunk are read.
+
+        Returns: an iterator of tuples (inf_id, inf data, dict from VM ID to VM data, version).
+        """
+        sql = "select id, data, version, date from inf_list where deleted = 0"
+        last = None
+        while True:
+            if last is None:
+                headers = db.select(sql + " order by date desc, id desc limit %s", (Config.DB_FETCH_SIZE,))
             else:
-                InfrastructureList.logger.error("ERROR connecting with the database!.")
-                return {}
+                headers = db.select(sql + " and (date < %s or (date = %s and id < %s))"
+                                    " order by date desc, id desc limit %s",
+                                    (last[3], last[3], last[0], Config.DB_FETCH_SIZE))
+            if not headers:
+                break
+            vms_data = {}
+            res = db.select("select inf_id, vm_id, data from vm_list where inf_id in (%s)" %
+                            ", ".join(["%s"] * len(headers)), tuple(header[0] for header in headers))
+            for inf_id, vm_id, data in res:
+                vms_data.setdefault(inf_id, {})[vm_id] = data
+            for inf_id, data, version, _ in headers:
+                yield inf_id, data, vms_data.get(inf_id, {}), version
+            last = headers[-1]
+
+    @staticmethod
+    def _deserialize(data, vms_data, auth=None, version=None):
+        """
+        Deserialize an infrastructure read from the DB (with the specified version)
+
+        Returns: a tuple (inf, digests of the data), or (None, None) in case of error.
+        """
+        try:
+            if auth:
+                return IM.InfrastructureInfo.InfrastructureInfo.deserialize_auth(codec.decode(data)), None
+            current_codec = codec.get_codec()
+            digests = {'size': 0, 'version': version}
+            decoded_vms_data = {}
+            for vm_id, vm_data in vms_data.items():
+                decoded_vms_data[vm_id] = codec.decode(vm_data)
+                digests['size'] += len(decoded_vms_data[vm_id])
+                # The data stored with other codec is rewritten in the next save
+                if codec.get_format(vm_data) is current_codec:
+                    digests[vm_id] = InfrastructureList._get_digest(decoded_vms_data[vm_id])
+            decoded_data = codec.decode(data)
+            digests['size'] += len(decoded_data)
+            if codec.get_format(data) is current_codec:
+                digests[None] = InfrastructureList._get_digest(decoded_data)
+            inf = IM.InfrastructureInfo.InfrastructureInfo.deserialize(decoded_data, decoded_vms_data)
+            return inf, digests
+        except Exception:
+            InfrastructureList.logger.exception("ERROR reading infrastructure from database, ignoring it!.")
+            return None, None
 
     @staticmethod
     def _save_data_to_db(db_url, inf_list, inf_id=None):
+        """
+        Save the infrastructures to the DB.
+        Only the infrastructure data and the VMs that have changed since they
+        were stored or loaded are written (encoded with the DATA_DB_CODEC codec),
+        all of them in a single transaction.
+        The version of each infrastructure modified is incremented.
+        """
         db = DataBase(db_url)
         if db.connect():
-            infs_to_save = inf_list
-            if inf_id:
-                infs_to_save = {inf_id: inf_list[inf_id]}
-
-            for inf in infs_to_save.values():
-                res = db.execute("replace into inf_list (id, deleted, data, date) values (%s, %s, %s, now())",
-                                 (inf.id, int(inf.deleted), inf.serialize()))
+            try:
+                infs_to_save = inf_list
+                if inf_id:
+                    infs_to_save = {inf_id: inf_list[inf_id]}
+
+                sentences = []
+                new_digests = {}
+                saved_logs = []
+                data_codec = codec.get_codec()
+                for inf in infs_to_save.values():
+                    old_digests = InfrastructureList._saved_digests.get((db_url, inf.id), {})
+                    digests = {'size': 0, 'version': old_digests.get('version')}
+                    num_sentences = len(sentences)
+                    for vm in list(inf.vm_list):
+                        data = vm.serialize()
+                        digests['size'] += len(data)
+                        digests[vm.im_id] = InfrastructureList._get_digest(data)
+                        if old_digests.get(vm.im_id) != digests[vm.im_id]:
+                            sentences.append(("replace into vm_list (inf_id, vm_id, data) values (%s, %s, %s)",
+                                              (inf.id, vm.im_id, db.blob(data_codec.encode(data)))))
+                        # Only the new part of the contextualization logs is written
+                        log_sentences, state = vm.cont_log.get_save_sentences(db, inf.id, vm.im_id, data_codec)
+                        sentences.extend(log_sentences)
+                        saved_logs.append((vm.cont_log, state))
+                    log_sentences, state = inf.cont_log.get_save_sentences(db, inf.id,
+                                                                           ContextualizationLog.INF_LOG_ID, data_codec)
+                    sentences.extend(log_sentences)
+                    saved_logs.append((inf.cont_log, state))
+                    data = inf.serialize_header()
+                    digests['size'] += len(data)
+                    digests[None] = InfrastructureList._get_digest(data)
+                    header_changed = old_digests.get(None) != digests[None]
+                    if header_changed or digests['version'] is None:
+                        data = db.blob(data_codec.encode(data))
+                    if digests['version'] is None:
+                        # Not stored or loaded by this IM: it is a new one
+                        digests['version'] = 1
+                        sentences.append(("replace into inf_list (id, deleted, data, date, version)"
+                                          " values (%s, %s, %s, now(), %s)",
+                                          (inf.id, int(inf.deleted), data, digests['version'])))
+                    elif header_changed or len(sentences) > num_sentences:
+                        # Increment the version in the DB (it may be modified by other IM in HA mode)
+                        digests['version'] += 1
+                        if header_changed:
+                            sentences.append(("update inf_list set deleted = %s, data = %s, date = now(),"
+                                              " version = version + 1 where id = %s",
+                                              (int(inf.deleted), data, inf.id)))
+                        else:
+                            sentences.append(("update inf_list set version = version + 1 where id = %s",
+                                              (inf.id,)))
+                    # Maintain the owners table (it does not change the version of the data)
+                    digests['listing'] = InfrastructureList._get_listing(inf)
+                    if old_digests.get('listing') != digests['listing']:
+                        sentences.extend(InfrastructureList._get_listing_sentences(inf, digests['listing']))
+                    new_digests[(db_url, inf.id)] = (inf, digests)
+
+                res = db.execute_batch(sentences)
+            finally:
+                db.close()
 
-            db.close()
+            if res:
+                for log, state in saved_logs:
+                    log.set_saved(state)
+            for key, (inf, digests) in new_digests.items():
+                if inf.deleted:
+                    InfrastructureList._saved_digests.pop(key, None)
+                else:
+                    InfrastructureList._saved_digests[key] = digests
             return res
         else:
             InfrastructureList.logger.error("ERROR connecting with the database!.")
             return None
 
     @staticmethod
-    def _get_inf_ids_from_db():
+    def _get_inf_ids_query(owner, limit=0, after=None, filters=None):
+        """ Get the query (and its args) of the IDs of the infrastructures (of an owner if specified) """
+        filters = filters or {}
+        unknown = set(filters) - set(InfrastructureList.LIST_FILTERS)
+        if unknown:
+            raise Exception("Invalid filters: %s. Valid ones: %s." % (", ".join(sorted(unknown)),
+                                                                     ", ".join(InfrastructureList.LIST_FILTERS)))
+        sql = "select inf_id from inf_owner where deleted = %s"
+        args = [int(bool(filters.get('deleted')))]
+        if owner:
+            sql += " and (owner = %s or owner = %s)"
+            args.extend([owner, InfrastructureList.ANY_OWNER])
+        if filters.get('state'):
+            sql += " and state = %s"
+            args.append(filters['state'])
+        if filters.get('cloud'):
+            sql += " and clouds like %s"
+            args.append("%%,%s,%%" % filters['cloud'])
+        if filters.get('created_after'):
+            sql += " and created >= %s"
+            args.append(filters['created_after'])
+        if filters.get('created_before'):
+            sql += " and created < %s"
+            args.append(filters['created_before'])
+        if after:
+            sql += " and inf_id < %s"
+            args.append(after)
+        sql += " order by inf_id desc"
+        if limit:
+            sql += " limit %s"
+            args.append(int(limit))
+        return sql, tuple(args)
+
+    @staticmethod
+    def _get_inf_ids_from_db(owner=None, limit=0, after=None, filters=None):
+        """
+        Get the IDs of the infrastructures not deleted.
+        If owner is specified only the ones of the owner (or any owner) are returned.
+        They can be filtered (also to get the deleted ones not archived yet) using the
+        fields of the inf_owner table.
+        """
+        if owner or filters:
+            sql, args = InfrastructureList._get_inf_ids_query(owner, limit, after, filters)
+        else:
+            sql = "select id from inf_list where deleted = 0"
+            args = ()
+            if after:
+                sql += " and id < %s"
+                args += (after,)
+            sql += " order by id desc"
+            if limit:
+                sql += " limit %s"
+                args += (int(limit),)
         try:
             db = DataBase(Config.DATA_DB)
             if db.connect():
                 inf_list = []
-                res = db.select("select id from inf_list where deleted = 0 order by id desc")
+                try:
+                    res = db.select(sql, args)
+                finally:
+                    db.close()
                 for elem in res:
                     inf_list.append(elem[0])
 
-                db.close()
                 return inf_list
             else:
                 InfrastructureList.logger.error("ERROR connecting with the database!.")
@@ -242,9 +981,17 @@ class InfrastructureList():
     @staticmethod
     def _reinit():
         """Restart the class attributes to initial values."""
+        InfrastructureList.flush(stop_writer=True)
         InfrastructureList.infrastructure_list = {}
+        InfrastructureList._evicted = weakref.WeakValueDictionary()
+        InfrastructureList._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'revalidations': 0}
+        InfrastructureList._saved_digests = {}
         InfrastructureList._lock = threading.Lock()
         db = DataBase(Config.DATA_DB)
         if db.connect():
-            db.execute("delete from inf_list")
-            db.close()
+            try:
+                db.execute_batch([("delete from inf_list", None), ("delete from vm_list", None),
+                                  ("delete from inf_owner", None), ("delete from ctxt_log", None),
+                                  ("delete from inf_archive", None), ("delete from idem_keys", None)])
+            finally:
+                db.close()
@@ -18,6 +18,8 @@ import json
 import os
 import string
 import random
+import threading
+import time
 
 from IM.VMRC import VMRC
 from IM.CloudInfo import CloudInfo
@@ -27,7 +29,15 @@ import logging
 
 import IM.InfrastructureInfo
 import IM.InfrastructureList
-from radl import radl_parse
+from IM.InfrastructureArchive import InfrastructureArchive
+from IM.radlcache import parse_radl, radl_cache
+from IM.admission import get_admission_control
+from IM.events import get_event_bus
+from IM.operations import get_operation_manager, Operation
+from IM.idempotency import IdempotencyKeys
+from IM.request import PoolMixIn, get_request_pool, get_state_pool
+from IM.db import DataBase
+from IM.ctxtlog import read_segments
 from radl.radl import Feature, RADL
 from IM.recipe import Recipe
 
@@ -59,6 +69,13 @@ class DeletedInfrastructureException(Exception):
         Exception.__init__(self, msg)
 
 
+class IncorrectOperationException(Exception):
+    """ Invalid operation ID. """
+
+    def __init__(self, msg="Invalid operation ID or operation expired."):
+        Exception.__init__(self, msg)
+
+
 class InvaliddUserException(Exception):
     """ Invalid InfrastructureManager credentials """
 
@@ -81,6 +98,26 @@ class InfrastructureManager:
     logger = logging.getLogger('InfrastructureManager')
     """Logger object."""
 
+    start_time = None
+    """Time when the IM service was started."""
+
+    first_response_time = None
+    """Time (in secs) from the start of the IM service to the first API response."""
+
+    @staticmethod
+    def set_start_time():
+        """ Set the time when the IM service was started """
+        InfrastructureManager.start_time = time.time()
+        InfrastructureManager.first_response_time = None
+
+    @staticmethod
+    def response_sent():
+        """ Register that an API response has been sent, to compute first_response_time """
+        if InfrastructureManager.start_time and InfrastructureManager.first_response_time is None:
+            InfrastructureManager.first_response_time = time.time() - InfrastructureManager.start_time
+            InfrastructureManager.logger.info("Time from the IM start to the first response: %.3f secs." %
+                                              InfrastructureManager.first_response_time)
+
     @staticmethod
     def _reinit():
         """Restart the class attributes to initial values."""
@@ -230,10 +267,10 @@ class InfrastructureManager:
     def get_infrastructure(inf_id, auth):
         """Return infrastructure info with some id if valid authorization provided."""
 
-        if inf_id not in IM.InfrastructureList.InfrastructureList.get_inf_ids():
+        sel_inf = IM.InfrastructureList.InfrastructureList.get_infrastructure(inf_id)
+        if not sel_inf:
             InfrastructureManager.logger.error("Error, incorrect infrastructure ID")
             raise IncorrectInfrastructureException()
-        sel_inf = IM.InfrastructureList.InfrastructureList.get_infrastructure(inf_id)
         if not sel_inf.is_authorized(auth):
             InfrastructureManager.logger.error("Access Error")
             raise UnauthorizedUserException()
@@ -270,7 +307,7 @@ class InfrastructureManager:
         if isinstance(radl_data, RADL):
             radl = radl_data
         else:
-            radl = radl_parse.parse_radl(radl_data)
+            radl = parse_radl(radl_data)
         InfrastructureManager.logger.debug(radl)
 
         sel_inf = InfrastructureManager.get_infrastructure(inf_id, auth)
@@ -298,6 +335,7 @@ class InfrastructureManager:
                         (_, password, public_key, private_key) = new_creds
                         system.setCredentialValues(
                             password=password, public_key=public_key, private_key=private_key, new=True)
+        sel_inf.changed()
 
         # Stick all virtual machines to be reconfigured
         InfrastructureManager.logger.info("Contextualize the inf.")
@@ -352,7 +390,7 @@ class InfrastructureManager:
         return concrete_system, score
 
     @staticmethod
-    def AddResource(inf_id, radl_data, auth, context=True, failed_clouds=[]):
+    def AddResource(inf_id, radl_data, auth, context=True, failed_clouds=[], operation=None, idempotency_key=None):
         """
         Add the resources in the RADL to the infrastructure.
 
@@ -363,10 +401,19 @@ class InfrastructureManager:
         - auth(Authentication): parsed authentication tokens.
         - context(bool): Flag to specify if the ctxt step will be made
         - failed_clouds(list of CloudInfo): A list of failed Cloud providers to avoid launching the VMs in them.
+        - operation(Operation): asynchronous operation that executes the call (to report the progress
+          and to cancel the deployment).
+        - idempotency_key(str): if set, a retry with the same key returns the result of the first call.
 
         Return(list of int): ids of the new virtual machine created.
         """
         auth = InfrastructureManager.check_auth_data(auth)
+        if idempotency_key:
+            return InfrastructureManager._idempotent_call(idempotency_key, auth, "AddResource %s" % inf_id,
+                                                          InfrastructureManager.AddResource, inf_id, radl_data,
+                                                          auth, context, failed_clouds)
+        if operation:
+            operation.check_cancelled()
 
         InfrastructureManager.logger.info(
             "Adding resources to inf: " + str(inf_id))
@@ -374,7 +421,7 @@ class InfrastructureManager:
         if isinstance(radl_data, RADL):
             radl = radl_data
         else:
-            radl = radl_parse.parse_radl(radl_data)
+            radl = parse_radl(radl_data)
 
         InfrastructureManager.logger.debug(radl)
         radl.check()
@@ -400,7 +447,7 @@ class InfrastructureManager:
                         # This app must be installed and it has special
                         # requirements
                         try:
-                            requirements_radl = radl_parse.parse_radl(
+                            requirements_radl = parse_radl(
                                 requirements).systems[0]
                             system.applyFeatures(
                                 requirements_radl, conflict="other", missing="other")
@@ -412,6 +459,8 @@ class InfrastructureManager:
                             InfrastructureManager.logger.debug(requirements)
                         break
 
+        if operation:
+            operation.set_progress("Selecting the VM images")
         # Get VMRC credentials
         vmrc_list = []
         for vmrc_elem in auth.getAuthInfo('VMRC'):
@@ -453,6 +502,8 @@ class InfrastructureManager:
                  for s0 in vmrc_res]
             systems_with_vmrc[system_id] = n if n else [s_without_apps]
 
+        if operation:
+            operation.set_progress("Selecting the cloud providers")
         # Concrete systems with cloud providers and select systems with the greatest score
         # in every cloud
         cloud_list = dict([(c.id, c.getCloudConnector())
@@ -517,6 +568,10 @@ class InfrastructureManager:
         # Launch every group in the same cloud provider
         deployed_vm = {}
         cancel_deployment = []
+        if operation:
+            # the operation can be cancelled while launching the VMs
+            cancel_deployment = operation.cancel_deployment
+            operation.set_progress("Launching the VMs")
         try:
             if Config.MAX_SIMULTANEOUS_LAUNCHES > 1:
                 pool = ThreadPool(processes=Config.MAX_SIMULTANEOUS_LAUNCHES)
@@ -545,6 +600,9 @@ class InfrastructureManager:
                         if vm not in new_vms:
                             new_vms.append(vm)
 
+        if operation:
+            # the VMs are added to the infrastructure after the last check of the cancellation
+            operation.disable_cancel()
         if cancel_deployment:
             # If error, all deployed virtual machine will be undeployed.
             for vm in new_vms:
@@ -576,6 +634,8 @@ class InfrastructureManager:
 
         # Let's contextualize!
         if context and new_vms:
+            if operation:
+                operation.set_progress("Contextualizing the VMs")
             sel_inf.Contextualize(auth)
 
         IM.InfrastructureList.InfrastructureList.save_data(inf_id)
@@ -700,7 +760,7 @@ class InfrastructureManager:
         return vm.get_vm_info()
 
     @staticmethod
-    def GetVMContMsg(inf_id, vm_id, auth):
+    def GetVMContMsg(inf_id, vm_id, auth, offset=0, limit=None):
         """
         Get the contextualization log of a virtual machine in an infrastructure.
 
@@ -709,6 +769,8 @@ class InfrastructureManager:
         - inf_id(str): infrastructure id.
         - vm_id(str): virtual machine id.
         - auth(Authentication): parsed authentication tokens.
+        - offset(int): position of the log to start reading (negative values are relative to the end).
+        - limit(int): maximum number of bytes to return (None to return until the end).
 
         Return: a str with the contextualization log of the VM
         """
@@ -719,9 +781,10 @@ class InfrastructureManager:
 
         vm = InfrastructureManager.get_vm_from_inf(inf_id, vm_id, auth)
 
-        InfrastructureManager.logger.debug(vm.cont_out)
+        res = vm.get_cont_msg(offset, limit)
+        InfrastructureManager.logger.debug(res)
 
-        return vm.cont_out
+        return res
 
     @staticmethod
     def AlterVM(inf_id, vm_id, radl_data, auth):
@@ -750,7 +813,7 @@ class InfrastructureManager:
         if isinstance(radl_data, RADL):
             radl = radl_data
         else:
-            radl = radl_parse.parse_radl(radl_data)
+            radl = parse_radl(radl_data)
 
         exception = None
         try:
@@ -821,7 +884,41 @@ class InfrastructureManager:
         return res
 
     @staticmethod
-    def GetInfrastructureContMsg(inf_id, auth):
+    def get_change_counters(inf_id, auth, vm_id=None, fresh=False):
+        """
+        Get the change counters of an infrastructure (including its VMs and contextualization
+        logs) or of one of its VMs, to detect if the data has changed without reading it
+        (as in the ETags of the REST API). The state of the VMs is not updated.
+
+        Args:
+
+        - inf_id(str): infrastructure id.
+        - auth(Authentication): parsed authentication tokens.
+        - vm_id(str): virtual machine id (None to get the counters of the infrastructure).
+        - fresh(bool): return None if the state of some VM has not been updated in the last
+          VM_INFO_UPDATE_FREQUENCY secs (so GetInfrastructureState or GetVMInfo would update it).
+
+        Return: a tuple of int (or None).
+        """
+        auth = InfrastructureManager.check_auth_data(auth)
+        sel_inf = InfrastructureManager.get_infrastructure(inf_id, auth)
+
+        if vm_id is not None:
+            vm_list = [InfrastructureManager.get_vm_from_inf(inf_id, vm_id, auth)]
+            res = []
+        else:
+            vm_list = sel_inf.get_vm_list()
+            res = [sel_inf.version, sel_inf.cont_log.changes]
+
+        now = int(time.time())
+        for vm in vm_list:
+            if fresh and now - vm.last_update > Config.VM_INFO_UPDATE_FREQUENCY:
+                return None
+            res.extend([vm.version, vm.cont_log.changes])
+        return tuple(res)
+
+    @staticmethod
+    def GetInfrastructureContMsg(inf_id, auth, offset=0, limit=None):
         """
         Get cont msg of an infrastructure.
 
@@ -829,6 +926,8 @@ class InfrastructureManager:
 
         - inf_id(str): infrastructure id.
         - auth(Authentication): parsed authentication tokens.
+        - offset(int): position of the message to start reading (negative values are relative to the end).
+        - limit(int): maximum number of bytes to return (None to return until the end).
 
         Return: a str with the cont msg
         """
@@ -838,12 +937,19 @@ class InfrastructureManager:
             "Getting cont msg of the inf: " + str(inf_id))
 
         sel_inf = InfrastructureManager.get_infrastructure(inf_id, auth)
-        res = sel_inf.cont_out
 
+        # The message is composed by the log of the inf and the logs of the VMs.
+        # Only the logs in the requested part are read.
+        segments = [(sel_inf.get_cont_msg_size(), sel_inf.get_cont_msg)]
         for vm in sel_inf.get_vm_list():
-            if vm.cont_out:
-                res += "VM " + str(vm.id) + ":\n" + vm.cont_out + "\n"
-                res += "***************************************************************************\n"
+            size = vm.get_cont_msg_size()
+            if size:
+                header = "VM " + str(vm.id) + ":\n"
+                footer = "\n***************************************************************************\n"
+                segments.append((len(header), lambda offset, limit, text=header: text[offset:offset + limit]))
+                segments.append((size, vm.get_cont_msg))
+                segments.append((len(footer), lambda offset, limit, text=footer: text[offset:offset + limit]))
+        res = read_segments(segments, offset, limit)
 
         InfrastructureManager.logger.debug(res)
         return res
@@ -875,40 +981,117 @@ class InfrastructureManager:
             vm.update_status(auth)
             vm_states[str(vm.im_id)] = vm.state
 
-        state = None
-        for vm in sel_inf.get_vm_list():
-            # First try to update the status of the VM
-            if vm.state == VirtualMachine.FAILED:
-                state = VirtualMachine.FAILED
-                break
-            elif vm.state == VirtualMachine.UNKNOWN:
-                state = VirtualMachine.UNKNOWN
-                break
-            elif vm.state == VirtualMachine.PENDING:
-                state = VirtualMachine.PENDING
-            elif vm.state == VirtualMachine.RUNNING:
-                if state != VirtualMachine.PENDING:
-                    state = VirtualMachine.RUNNING
-            elif vm.state == VirtualMachine.STOPPED:
-                if state is None:
-                    state = VirtualMachine.STOPPED
-            elif vm.state == VirtualMachine.OFF:
-                if state is None:
-                    state = VirtualMachine.OFF
-            elif vm.state == VirtualMachine.CONFIGURED:
-                if state is None:
-                    state = VirtualMachine.CONFIGURED
-            elif vm.state == VirtualMachine.UNCONFIGURED:
-                if state is None or state == VirtualMachine.CONFIGURED:
-                    state = VirtualMachine.UNCONFIGURED
-
-        if state is None:
-            state = VirtualMachine.UNKNOWN
+        state = IM.InfrastructureInfo.InfrastructureInfo.get_aggregated_state(sel_inf.get_vm_list())
 
         InfrastructureManager.logger.debug(
             "inf: " + str(inf_id) + " is in state: " + state)
         return {'state': state, 'vm_states': vm_states}
 
+    @staticmethod
+    def GetInfrastructuresState(inf_ids, auth):
+        """
+        Get the aggregated state of several infrastructures. The states of the VMs are
+        updated concurrently by the INF_STATE_THREADS threads shared by all the calls,
+        and the VMs not updated in INF_STATE_TIMEOUT secs return their last known state.
+
+        Args:
+
+        - inf_ids(list of str): infrastructure ids (None to get all the infrastructures of the user).
+        - auth(Authentication): parsed authentication tokens.
+
+        Return: a dict indexed with the infrastructure ids, and as value a dict with the
+        elements returned by GetInfrastructureState plus 'stale' (True if the state of some
+        VM has not been updated in time), or only with an 'error' if the state cannot be obtained.
+        """
+        auth = InfrastructureManager.check_auth_data(auth)
+        if inf_ids is None:
+            inf_ids = InfrastructureManager.GetInfrastructureList(auth)
+
+        InfrastructureManager.logger.info("Getting state of %d infs" % len(inf_ids))
+
+        res = {}
+        infs = []
+        for inf_id in inf_ids:
+            try:
+                infs.append(InfrastructureManager.get_infrastructure(inf_id, auth))
+            except Exception, ex:
+                res[str(inf_id)] = {'error': str(ex)}
+
+        cond = threading.Condition()
+        pending = set()
+        expired = []
+
+        def update_status(vm):
+            with cond:
+                if expired:
+                    # Too late, do not waste the thread
+                    return
+            try:
+                vm.update_status(auth)
+            finally:
+                with cond:
+                    pending.discard(vm)
+                    cond.notify_all()
+
+        vm_lists = [(inf, inf.get_vm_list()) for inf in infs]
+        pool = get_state_pool()
+        for _, vm_list in vm_lists:
+            pending.update(vm_list)
+            for vm in vm_list:
+                pool.submit(update_status, vm)
+
+        deadline = time.time() + Config.INF_STATE_TIMEOUT
+        with cond:
+            while pending and time.time() < deadline:
+                cond.wait(deadline - time.time())
+            expired.append(True)
+            not_updated = set(pending)
+
+        for inf, vm_list in vm_lists:
+            vm_states = dict((str(vm.im_id), vm.state) for vm in vm_list)
+            stale = any(vm in not_updated for vm in vm_list)
+            res[str(inf.id)] = {'state': IM.InfrastructureInfo.InfrastructureInfo.get_aggregated_state(vm_list),
+                                'vm_states': vm_states, 'stale': stale}
+        if not_updated:
+            InfrastructureManager.logger.warn("The state of %d VMs has not been updated in time." % len(not_updated))
+        return res
+
+    @staticmethod
+    def GetInfrastructureEvents(inf_id, auth, after=None, timeout=0):
+        """
+        Get the events of an infrastructure (changes of the VM states, contextualization
+        messages and steps, ...) newer than a previous one, waiting for them if there are none.
+
+        Args:
+
+        - inf_id(str): infrastructure id.
+        - auth(Authentication): parsed authentication tokens.
+        - after(int): id of the last event received (None to start getting the events).
+        - timeout(int): maximum time (in secs) to wait for new events (up to EVENTS_MAX_WAIT).
+
+        Return: a list of dicts with the 'id', 'type' and 'data' of the events. Without after,
+        one event of type 'state' with the result of GetInfrastructureState. If some events
+        have been lost, the list starts with an event of type 'reset' and the state must be
+        obtained again.
+
+        The waiting clients do not poll the cloud providers: the changes of the VM states are
+        published when they are updated by the IM (in other calls or in the contextualization).
+        Each waiting client holds the thread of the API that serves it. If EVENTS_MAX_WAITING
+        is set, at most this number of clients wait at the same time, the rest get a
+        ServiceUnavailableException.
+        """
+        auth = InfrastructureManager.check_auth_data(auth)
+
+        sel_inf = InfrastructureManager.get_infrastructure(inf_id, auth)
+        event_bus = get_event_bus()
+
+        if after is None:
+            event_id = event_bus.watch(sel_inf.id)
+            state = InfrastructureManager.GetInfrastructureState(inf_id, auth)
+            return [{'id': event_id, 'type': 'state', 'data': state}]
+
+        return event_bus.get_events(sel_inf.id, after, min(timeout, Config.EVENTS_MAX_WAIT))
+
     @staticmethod
     def _stop_vm(vm, auth, exceptions):
         try:
@@ -1193,7 +1376,7 @@ class InfrastructureManager:
         return auth
 
     @staticmethod
-    def CreateInfrastructure(radl, auth):
+    def CreateInfrastructure(radl, auth, idempotency_key=None):
         """
         Create a new infrastructure.
 
@@ -1204,24 +1387,47 @@ class InfrastructureManager:
 
         - radl(RADL): RADL description.
         - auth(Authentication): parsed authentication tokens.
+        - idempotency_key(str): if set, a retry with the same key returns the result of the first call.
 
         Return(int): the new infrastructure ID if successful.
         """
 
         # First check the auth data
         auth = InfrastructureManager.check_auth_data(auth)
+        if idempotency_key:
+            return InfrastructureManager._idempotent_call(idempotency_key, auth, "CreateInfrastructure",
+                                                          InfrastructureManager.CreateInfrastructure, radl, auth)
+
+        inf = InfrastructureManager._new_infrastructure(auth)
+        InfrastructureManager._add_first_resources(inf, radl, auth)
+
+        return inf.id
+
+    @staticmethod
+    def _idempotent_call(idempotency_key, auth, function_name, function, *args):
+        """
+        Call a function that creates resources only once for each idempotency key of the
+        IM user (see :py:class:`IM.idempotency.IdempotencyKeys`).
+        """
+        owner = IM.InfrastructureList.InfrastructureList._get_owner(auth)
+        return IdempotencyKeys.call(owner, idempotency_key, function_name, function, *args)
 
-        # Create a new infrastructure
+    @staticmethod
+    def _new_infrastructure(auth):
+        """ Create a new empty infrastructure of the IM user of the auth data """
         inf = IM.InfrastructureInfo.InfrastructureInfo()
         inf.auth = Authentication(auth.getAuthInfo("InfrastructureManager"))
         IM.InfrastructureList.InfrastructureList.add_infrastructure(inf)
         IM.InfrastructureList.InfrastructureList.save_data(inf.id)
         InfrastructureManager.logger.info(
             "Creating new infrastructure with id: " + str(inf.id))
+        return inf
 
-        # Add the resources in radl_data
+    @staticmethod
+    def _add_first_resources(inf, radl, auth, operation=None):
+        """ Add the resources of a new infrastructure, deleting it if it fails """
         try:
-            InfrastructureManager.AddResource(inf.id, radl, auth)
+            res = InfrastructureManager.AddResource(inf.id, radl, auth, operation=operation)
         except Exception, e:
             InfrastructureManager.logger.exception(
                 "Error Creating Inf id " + str(inf.id))
@@ -1231,19 +1437,147 @@ class InfrastructureManager:
             raise e
         InfrastructureManager.logger.info(
             "Infrastructure id " + str(inf.id) + " successfully created")
+        return res
 
-        return inf.id
+    @staticmethod
+    def CreateInfrastructureAsync(radl_data, auth, idempotency_key=None):
+        """
+        Create a new infrastructure without waiting for the deployment of its resources:
+        they are added by an asynchronous operation, executed in the background when there
+        are less than MAX_SIMULTANEOUS_DEPLOYMENTS running.
+
+        Args:
+
+        - radl_data(str or RADL): RADL description.
+        - auth(Authentication): parsed authentication tokens.
+        - idempotency_key(str): if set, a retry with the same key returns the operation of the first call
+          (in the unknown state if it is not stored anymore).
+
+        Return(dict): the info of the operation (see :py:meth:`GetOperation`), with the
+        ID of the new infrastructure in the inf_id field.
+        """
+        auth = InfrastructureManager.check_auth_data(auth)
+        if idempotency_key:
+            op = InfrastructureManager._idempotent_call(idempotency_key, auth, "CreateInfrastructureAsync",
+                                                        InfrastructureManager.CreateInfrastructureAsync,
+                                                        radl_data, auth)
+            return InfrastructureManager._get_current_operation(op)
+
+        # Check the RADL before creating the infrastructure
+        radl = radl_data if isinstance(radl_data, RADL) else parse_radl(radl_data)
+        radl.check()
+
+        inf = InfrastructureManager._new_infrastructure(auth)
+        op = get_operation_manager().start(inf, "CreateInfrastructure", InfrastructureManager._add_first_resources,
+                                           inf, radl, auth)
+        InfrastructureManager.logger.info("Operation %s to create the Inf id %s queued" % (op.id, inf.id))
+        return op.to_dict()
+
+    @staticmethod
+    def AddResourceAsync(inf_id, radl_data, auth, context=True, idempotency_key=None):
+        """
+        Add the resources in the RADL to the infrastructure without waiting for their
+        deployment (see :py:meth:`CreateInfrastructureAsync`).
+
+        Args:
+
+        - inf_id(str): infrastructure id.
+        - radl_data(str or RADL): RADL description.
+        - auth(Authentication): parsed authentication tokens.
+        - context(bool): Flag to specify if the ctxt step will be made
+        - idempotency_key(str): if set, a retry with the same key returns the operation of the first call.
+
+        Return(dict): the info of the operation (see :py:meth:`GetOperation`).
+        """
+        auth = InfrastructureManager.check_auth_data(auth)
+        if idempotency_key:
+            op = InfrastructureManager._idempotent_call(idempotency_key, auth, "AddResourceAsync %s" % inf_id,
+                                                        InfrastructureManager.AddResourceAsync,
+                                                        inf_id, radl_data, auth, context)
+            return InfrastructureManager._get_current_operation(op)
+
+        radl = radl_data if isinstance(radl_data, RADL) else parse_radl(radl_data)
+        radl.check()
+
+        sel_inf = InfrastructureManager.get_infrastructure(inf_id, auth)
+        op = get_operation_manager().start(sel_inf, "AddResource", InfrastructureManager.AddResource,
+                                           inf_id, radl, auth, context)
+        InfrastructureManager.logger.info("Operation %s to add resources to Inf id %s queued" % (op.id, inf_id))
+        return op.to_dict()
 
     @staticmethod
-    def GetInfrastructureList(auth):
+    def _get_current_operation(op):
+        """
+        Get the current info of an operation returned by a previous call. If it is not stored
+        anymore the unknown state is returned, instead of the state of the previous call.
+        """
+        current = get_operation_manager().get(op['id'])
+        return current.to_dict() if current else Operation.unknown(op)
+
+    @staticmethod
+    def _get_operation(op_id, auth):
+        """ Return the asynchronous operation with some id if valid authorization provided """
+        auth = InfrastructureManager.check_auth_data(auth)
+        op = get_operation_manager().get(op_id)
+        if not op:
+            InfrastructureManager.logger.error("Error, incorrect operation ID")
+            raise IncorrectOperationException()
+        if not op.inf.is_authorized(auth):
+            InfrastructureManager.logger.error("Access Error")
+            raise UnauthorizedUserException()
+        return op
+
+    @staticmethod
+    def GetOperation(op_id, auth):
+        """
+        Get the info of an asynchronous operation (they are kept OPERATIONS_RETENTION secs
+        after they finish, in the IM instance that executes them).
+
+        Args:
+
+        - op_id(str): operation id.
+        - auth(Authentication): parsed authentication tokens.
+
+        Return(dict): with the fields id, inf_id, type (CreateInfrastructure or AddResource),
+        state (queued, running, finished, failed or cancelled), progress (description of the
+        current step), result (list of the ids of the VMs added), error, cancelled (flag set
+        when the cancellation is requested), created and finished (times in secs since epoch).
+        """
+        return InfrastructureManager._get_operation(op_id, auth).to_dict()
+
+    @staticmethod
+    def CancelOperation(op_id, auth):
+        """
+        Cancel an asynchronous operation: no more VMs are launched and the ones launched by
+        the operation are destroyed (as well as the infrastructure in CreateInfrastructure
+        operations). The launches in progress in the cloud providers are not interrupted.
+
+        Args:
+
+        - op_id(str): operation id.
+        - auth(Authentication): parsed authentication tokens.
+
+        Return(dict): the info of the operation (see :py:meth:`GetOperation`).
+        """
+        op = InfrastructureManager._get_operation(op_id, auth)
+        if op.cancel():
+            InfrastructureManager.logger.info("Operation %s of Inf id %s cancelled" % (op_id, op.inf.id))
+        return op.to_dict()
+
+    @staticmethod
+    def GetInfrastructureList(auth, limit=0, after=None, filters=None):
         """
         Return the infrastructure ids associated to IM tokens.
 
         Args:
 
         - auth(Authentication): parsed authentication tokens.
+        - limit(int): maximum number of ids to return (0 means no limit).
+        - after(str): return the ids after this one (the last one of the previous page).
+        - filters(dict): filters of the infrastructures (state, cloud, created_after,
+          created_before and deleted).
 
-        Return(list of int): list of infrastructure ids.
+        Return(list of int): list of infrastructure ids (in descending order).
         """
         auth = InfrastructureManager.check_auth_data(auth)
 
@@ -1255,7 +1589,7 @@ class InfrastructureManager:
                 "No correct auth data has been specified.")
             raise InvaliddUserException()
 
-        return IM.InfrastructureList.InfrastructureList.get_inf_ids(auth)
+        return IM.InfrastructureList.InfrastructureList.get_inf_ids(auth, limit, after, filters)
 
     @staticmethod
     def ExportInfrastructure(inf_id, delete, auth_data):
@@ -1291,6 +1625,39 @@ class InfrastructureManager:
         IM.InfrastructureList.InfrastructureList.save_data(new_inf.id)
         return new_inf.id
 
+    @staticmethod
+    def GetStatus():
+        """
+        Return the current load of the IM service. It does not require authentication.
+
+        Return(dict): with the gauges of the admission control of the API calls (admission),
+        the pool that executes the XML-RPC requests (requests), the pool that handles the
+        XML-RPC connections (xmlrpc_handlers), the infrastructures in memory (inf_cache), the
+        RADL cache (radl_cache), the infrastructures watched by the clients waiting for
+        events (events), the pool that updates the VM states in GetInfrastructuresState
+        (state_updates), the pool that executes the asynchronous deployments (deployments),
+        the DB connection pool (db_pool), the uptime (secs) and the
+        time from the start to the first response (first_response_time).
+        """
+        res = {'admission': get_admission_control().stats(),
+               'requests': get_request_pool().stats(),
+               'inf_cache': IM.InfrastructureList.InfrastructureList.get_cache_stats(),
+               'radl_cache': radl_cache.stats(),
+               'events': get_event_bus().stats(),
+               'state_updates': get_state_pool().stats(),
+               'deployments': get_operation_manager().stats()}
+        if PoolMixIn.last_handler_pool:
+            res['xmlrpc_handlers'] = PoolMixIn.last_handler_pool.stats()
+        if Config.DATA_DB in DataBase.pools:
+            res['db_pool'] = DataBase.pools[Config.DATA_DB].stats()
+        # Do not return None values, as they are not supported by XML-RPC
+        if InfrastructureManager.start_time:
+            res['uptime'] = time.time() - InfrastructureManager.start_time
+        if InfrastructureManager.first_response_time is not None:
+            res['first_response_time'] = InfrastructureManager.first_response_time
+        return res
+
     @staticmethod
     def stop():
+        InfrastructureArchive.stop()
         IM.InfrastructureList.InfrastructureList.stop()
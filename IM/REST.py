@@ -14,18 +14,29 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
+import os
 import threading
+import time
+import types
 import bottle
 import json
+import zlib
+from functools import wraps
+from urllib import urlencode
 
 from IM.InfrastructureInfo import IncorrectVMException, DeletedVMException
 from IM.InfrastructureManager import (InfrastructureManager, DeletedInfrastructureException,
                                       IncorrectInfrastructureException, UnauthorizedUserException,
-                                      InvaliddUserException)
+                                      InvaliddUserException, IncorrectOperationException)
 from IM.auth import Authentication
 from IM.config import Config
-from radl.radl_json import parse_radl as parse_radl_json, dump_radl as dump_radl_json, featuresToSimple, radlToSimple
+from IM.ServiceRequests import Request_Function
+from IM.admission import get_admission_control, ServiceUnavailableException
+from IM.idempotency import IdempotencyKeyConflictException
+from radl.radl_json import dump_radl as dump_radl_json, featuresToSimple, radlToSimple
+from IM.radlcache import parse_radl_json
 from radl.radl import RADL, Features, Feature
 
 logger = logging.getLogger('InfrastructureManager')
@@ -35,6 +46,12 @@ AUTH_LINE_SEPARATOR = '\\n'
 # Combination of chars used to separate the lines inside the auth data
 # (i.e. in a certificate)
 AUTH_NEW_LINE_SEPARATOR = '\\\\n'
+# Value unique to this IM process to build the ETags (the change counters restart with the service)
+ETAG_EPOCH = os.urandom(8).encode("hex")
+# Compression level of the responses (fast, the logs and RADLs compress well anyway)
+COMPRESSION_LEVEL = 1
+# Max time (in secs) without sending anything in the event streams (to detect the closed connections)
+EVENTS_HEARTBEAT = 15
 
 HTML_ERROR_TEMPLATE = """<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
 <html>
@@ -55,12 +72,31 @@ bottle_server = None
 # It's almost equal to the supported cherrypy class CherryPyServer
 
 
+def create_cherrypy_server(host, port, handler):
+    """
+    Create the CherryPy WSGI server with the REST_THREADS, REST_QUEUE_SIZE,
+    REST_SOCKET_TIMEOUT and REST_KEEP_ALIVE options
+    """
+    from cherrypy import wsgiserver
+    server = wsgiserver.CherryPyWSGIServer((host, port), handler, numthreads=Config.REST_THREADS,
+                                           request_queue_size=Config.REST_QUEUE_SIZE,
+                                           timeout=Config.REST_SOCKET_TIMEOUT)
+    if not Config.REST_KEEP_ALIVE:
+        class CloseHTTPRequest(wsgiserver.HTTPRequest):
+            close_connection = True
+
+        class CloseHTTPConnection(wsgiserver.HTTPConnection):
+            RequestHandlerClass = CloseHTTPRequest
+
+        server.ConnectionClass = CloseHTTPConnection
+    return server
+
+
 class MySSLCherryPy(bottle.ServerAdapter):
 
     def run(self, handler):
         from cherrypy.wsgiserver.ssl_pyopenssl import pyOpenSSLAdapter
-        from cherrypy import wsgiserver
-        server = wsgiserver.CherryPyWSGIServer((self.host, self.port), handler, request_queue_size=32)
+        server = create_cherrypy_server(self.host, self.port, handler)
         self.srv = server
 
         # If cert variable is has a valid path, SSL will be used
@@ -80,8 +116,7 @@ class MySSLCherryPy(bottle.ServerAdapter):
 class MyCherryPy(bottle.ServerAdapter):
 
     def run(self, handler):
-        from cherrypy import wsgiserver
-        server = wsgiserver.CherryPyWSGIServer((self.host, self.port), handler, request_queue_size=32)
+        server = create_cherrypy_server(self.host, self.port, handler)
         self.srv = server
         try:
             server.start()
@@ -150,6 +185,102 @@ def get_media_type(header):
     return res
 
 
+def get_accept_encoding():
+    """
+    Function to get the content codings accepted by the client (Accept-Encoding header),
+    excluding the ones with q=0. Returns a List of strings.
+    """
+    res = []
+    accept = bottle.request.headers.get('Accept-Encoding')
+    if accept:
+        for coding in accept.split(","):
+            params = coding.split(";")
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if quality > 0:
+                res.append(params[0].strip().lower())
+    return res
+
+
+def compress_output(info):
+    """
+    Compress the response with gzip or deflate if the client accepts them
+    and it is bigger than REST_COMPRESSION_MIN_SIZE bytes
+    """
+    if not Config.REST_COMPRESSION or len(info) < Config.REST_COMPRESSION_MIN_SIZE:
+        return info
+
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    encodings = get_accept_encoding()
+    if "gzip" in encodings or "x-gzip" in encodings or "*" in encodings:
+        # wbits 31: zlib deflate with the gzip header and trailer
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        encoding = "gzip"
+    elif "deflate" in encodings:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        encoding = "deflate"
+    else:
+        return info
+
+    if isinstance(info, unicode):
+        info = info.encode("utf-8")
+    bottle.response.set_header('Content-Encoding', encoding)
+    return compressor.compress(info) + compressor.flush()
+
+
+def get_etag(inf_id, auth, vm_id=None, fresh=False):
+    """
+    Get a strong ETag of the representation requested of an infrastructure (or a VM),
+    from its change counters (see :py:meth:`InfrastructureManager.get_change_counters`)
+    and the parts of the request that select the representation. It does not access the clouds.
+    Returns None if the counters cannot be obtained (the API function returns the error),
+    or if fresh is set and the state of some VM must be updated.
+    """
+    try:
+        counters = InfrastructureManager.get_change_counters(inf_id, auth, vm_id, fresh)
+    except Exception:
+        return None
+    if counters is None:
+        return None
+    key = "|".join(str(elem) for elem in [ETAG_EPOCH, counters, bottle.request.path, bottle.request.query_string,
+                                          bottle.request.headers.get('Accept', ''),
+                                          bottle.request.headers.get('Accept-Encoding', '')])
+    return '"%s"' % hashlib.md5(key).hexdigest()
+
+
+def not_modified(etag):
+    """
+    Set the ETag header of the response and check if it matches the If-None-Match
+    header of the request. In that case set the 304 status, and the body must be empty.
+    """
+    if not etag:
+        return False
+    set_etag(etag)
+    if_none_match = bottle.request.headers.get('If-None-Match')
+    if if_none_match:
+        # weak comparison, as specified for If-None-Match
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]:
+            bottle.response.status = 304
+            return True
+    return False
+
+
+def set_etag(etag):
+    """
+    Set the ETag header of the response (if the ETag is not None). The functions that update
+    the state of the VMs set it again after the update, as it may change the counters.
+    """
+    if etag:
+        bottle.response.set_header('ETag', etag)
+
+
 def get_auth_header():
     """
     Get the Authentication object from the AUTHORIZATION header
@@ -161,6 +292,104 @@ def get_auth_header():
     return Authentication(Authentication.read_auth_data(auth_data))
 
 
+def get_cont_msg_params():
+    """
+    Get the offset and limit parameters of the requests of the contextualization messages
+
+    Returns: a tuple (offset, limit), limit is None if it is not specified.
+    """
+    offset = 0
+    limit = None
+    if "offset" in bottle.request.params.keys():
+        offset = int(bottle.request.params.get("offset"))
+    if "limit" in bottle.request.params.keys():
+        limit = int(bottle.request.params.get("limit"))
+    return offset, limit
+
+
+def get_events_params():
+    """
+    Get the parameters of the requests of the events of an infrastructure: the id of the
+    last event received (after parameter or Last-Event-ID header) and the time to wait.
+
+    Returns: a tuple (after, wait), after is None if it is not specified.
+    """
+    after = bottle.request.params.get("after") or bottle.request.headers.get("Last-Event-ID")
+    if after is not None:
+        after = int(after)
+    wait = Config.EVENTS_MAX_WAIT
+    if "wait" in bottle.request.params.keys():
+        wait = int(bottle.request.params.get("wait"))
+    return after, wait
+
+
+def stream_events(inf_id, auth, events, after):
+    """
+    Generator of the server-sent events stream of an infrastructure, starting with the events
+    specified (newer than the id after). It ends after EVENTS_MAX_WAIT secs (the clients
+    reconnect with the Last-Event-ID) or when the infrastructure is deleted.
+    """
+    deadline = time.time() + Config.EVENTS_MAX_WAIT
+    while True:
+        for event in events:
+            after = event['id']
+            yield "id: %d\nevent: %s\ndata: %s\n\n" % (event['id'], event['type'], json.dumps(event['data']))
+            if event['type'] == "deleted":
+                return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        try:
+            events = InfrastructureManager.GetInfrastructureEvents(inf_id, auth, after,
+                                                                   min(remaining, EVENTS_HEARTBEAT))
+        except Exception, ex:
+            yield "event: error\ndata: %s\n\n" % json.dumps(str(ex))
+            return
+        if not events:
+            yield ": keep-alive\n\n"
+
+
+def get_list_params():
+    """
+    Get the pagination (limit and after) and filter parameters of the list of infrastructures.
+
+    Returns: a tuple (limit, after, filters).
+    """
+    limit = 0
+    if "limit" in bottle.request.params.keys():
+        try:
+            limit = int(bottle.request.params.get("limit"))
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            raise ValueError("Incorrect value in limit parameter")
+    after = None
+    if "after" in bottle.request.params.keys():
+        after = bottle.request.params.get("after")
+    filters = {}
+    for name in ["state", "cloud", "created_after", "created_before"]:
+        if name in bottle.request.params.keys():
+            filters[name] = bottle.request.params.get(name)
+    if "deleted" in bottle.request.params.keys():
+        str_deleted = bottle.request.params.get("deleted").lower()
+        if str_deleted in ['yes', 'true', '1']:
+            filters['deleted'] = True
+        elif str_deleted not in ['no', 'false', '0']:
+            raise ValueError("Incorrect value in deleted parameter")
+    return limit, after, filters
+
+
+def set_next_link(url, inf_ids, limit):
+    """
+    Set the Link header with the URL of the next page of a list of infrastructures,
+    if the current one is full.
+    """
+    if limit and len(inf_ids) == limit:
+        params = dict(bottle.request.params.items())
+        params['after'] = inf_ids[-1]
+        bottle.response.set_header('Link', '<%s?%s>; rel="next"' % (url, urlencode(sorted(params.items()))))
+
+
 def format_output_json(res, field_name=None, list_field_name=None):
     res_dict = res
     if field_name:
@@ -174,6 +403,25 @@ def format_output_json(res, field_name=None, list_field_name=None):
     return json.dumps(res_dict)
 
 
+def format_operation(op, accepted=False):
+    """
+    Format the output of the REST calls that return an asynchronous operation,
+    adding its URI and the one of its infrastructure. If accepted is True (the
+    operation has just been queued) the status is 202 with the Location of the operation.
+    """
+    protocol = "http://"
+    if Config.REST_SSL:
+        protocol = "https://"
+    url = protocol + bottle.request.environ['HTTP_HOST']
+    res = dict(op)
+    res['uri'] = url + "/operations/" + op['id']
+    res['inf_uri'] = url + "/infrastructures/" + str(op['inf_id'])
+    if accepted:
+        bottle.response.status = 202
+        bottle.response.set_header('Location', res['uri'])
+    return format_output(res, default_type="application/json", field_name="operation")
+
+
 def format_output(res, default_type="text/plain", field_name=None, list_field_name=None):
     """
     Format the output of the API responses
@@ -229,10 +477,68 @@ def format_output(res, default_type="text/plain", field_name=None, list_field_na
                 info = str(res)
         bottle.response.content_type = default_type
 
-    return info
+    return compress_output(info)
+
+
+def call_im(api_function, *args, **kwargs):
+    """
+    Execute an API function of the InfrastructureManager in the request pool, with the same
+    priority, fair share between users and limit of long operations than in the XML-RPC API.
+    Returns its result or raises its exception.
+    """
+    return Request_Function.run(api_function, getattr(InfrastructureManager, api_function), *args, **kwargs)
+
+
+@app.hook('after_request')
+def after_request():
+    InfrastructureManager.response_sent()
+
+
+def admission_control(api_function, async_function=None):
+    """
+    Decorator to apply the admission control of the API function api_function to a REST function.
+    The calls with the async parameter are classified as async_function (if set), as the
+    equivalent XML-RPC function. The rejected calls return a 503 error with the Retry-After
+    header. The calls that return a stream (generator) are in process until the stream ends.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            admission = get_admission_control()
+            function_name = api_function
+            if async_function and str(bottle.request.params.get("async", "")).lower() in ['yes', 'true', '1']:
+                function_name = async_function
+            api_class = admission.get_api_class(function_name)
+            try:
+                admission.acquire(api_class)
+            except ServiceUnavailableException, ex:
+                bottle.response.set_header('Retry-After', str(ex.retry_after))
+                return return_error(503, str(ex))
+            try:
+                res = function(*args, **kwargs)
+            except:
+                admission.release(api_class)
+                raise
+            if isinstance(res, types.GeneratorType):
+                return release_after_stream(res, admission, api_class)
+            admission.release(api_class)
+            return res
+        return wrapper
+    return decorator
+
+
+def release_after_stream(stream, admission, api_class):
+    """ Generator of the chunks of a stream that frees its admission slot when it ends or it is closed """
+    try:
+        for chunk in stream:
+            yield chunk
+    finally:
+        stream.close()
+        admission.release(api_class)
 
 
 @app.route('/infrastructures/:id', method='DELETE')
+@admission_control("DestroyInfrastructure")
 def RESTDestroyInfrastructure(id=None):
     try:
         auth = get_auth_header()
@@ -240,7 +546,7 @@ def RESTDestroyInfrastructure(id=None):
         return return_error(401, "No authentication data provided")
 
     try:
-        InfrastructureManager.DestroyInfrastructure(id, auth)
+        call_im("DestroyInfrastructure", id, auth)
         bottle.response.content_type = "text/plain"
         return ""
     except DeletedInfrastructureException, ex:
@@ -255,6 +561,7 @@ def RESTDestroyInfrastructure(id=None):
 
 
 @app.route('/infrastructures/:id', method='GET')
+@admission_control("GetInfrastructureInfo")
 def RESTGetInfrastructureInfo(id=None):
     try:
         auth = get_auth_header()
@@ -262,7 +569,9 @@ def RESTGetInfrastructureInfo(id=None):
         return return_error(401, "No authentication data provided")
 
     try:
-        vm_ids = InfrastructureManager.GetInfrastructureInfo(id, auth)
+        if not_modified(get_etag(id, auth)):
+            return ""
+        vm_ids = call_im("GetInfrastructureInfo", id, auth)
         res = []
 
         protocol = "http://"
@@ -284,7 +593,47 @@ def RESTGetInfrastructureInfo(id=None):
         return return_error(400, "Error Getting Inf. info: " + str(ex))
 
 
+@app.route('/infrastructures/:id/events', method='GET')
+@admission_control("GetInfrastructureEvents")
+def RESTGetInfrastructureEvents(id=None):
+    try:
+        auth = get_auth_header()
+    except:
+        return return_error(401, "No authentication data provided")
+
+    try:
+        try:
+            after, wait = get_events_params()
+        except ValueError:
+            return return_error(400, "Incorrect value in after or wait parameters")
+
+        accept = get_media_type('Accept')
+        if accept and "text/event-stream" in accept:
+            # The first events are obtained before the stream to return the errors
+            events = InfrastructureManager.GetInfrastructureEvents(id, auth, after, 0)
+            bottle.response.content_type = "text/event-stream"
+            bottle.response.set_header('Cache-Control', 'no-cache')
+            return stream_events(id, auth, events, after)
+
+        # Long polling
+        res = InfrastructureManager.GetInfrastructureEvents(id, auth, after, wait)
+        return format_output(res, default_type="application/json", field_name="events")
+    except ServiceUnavailableException, ex:
+        bottle.response.set_header('Retry-After', str(ex.retry_after))
+        return return_error(503, "Error Getting Inf. events: " + str(ex))
+    except DeletedInfrastructureException, ex:
+        return return_error(404, "Error Getting Inf. events: " + str(ex))
+    except IncorrectInfrastructureException, ex:
+        return return_error(404, "Error Getting Inf. events: " + str(ex))
+    except UnauthorizedUserException, ex:
+        return return_error(403, "Error Getting Inf. events: " + str(ex))
+    except Exception, ex:
+        logger.exception("Error Getting Inf. events")
+        return return_error(400, "Error Getting Inf. events: " + str(ex))
+
+
 @app.route('/infrastructures/:id/:prop', method='GET')
+@admission_control("GetInfrastructureState")
 def RESTGetInfrastructureProperty(id=None, prop=None):
     try:
         auth = get_auth_header()
@@ -292,16 +641,23 @@ def RESTGetInfrastructureProperty(id=None, prop=None):
         return return_error(401, "No authentication data provided")
 
     try:
+        if prop in ["contmsg", "radl", "state"] and not_modified(get_etag(id, auth, fresh=(prop == "state"))):
+            return ""
         if prop == "contmsg":
-            res = InfrastructureManager.GetInfrastructureContMsg(id, auth)
+            try:
+                offset, limit = get_cont_msg_params()
+            except ValueError:
+                return return_error(400, "Incorrect value in offset or limit parameters")
+            res = call_im("GetInfrastructureContMsg", id, auth, offset, limit)
         elif prop == "radl":
-            res = InfrastructureManager.GetInfrastructureRADL(id, auth)
+            res = call_im("GetInfrastructureRADL", id, auth)
         elif prop == "state":
             accept = get_media_type('Accept')
             if accept and "application/json" not in accept and "*/*" not in accept and "application/*" not in accept:
                 return return_error(415, "Unsupported Accept Media Types: %s" % accept)
             bottle.response.content_type = "application/json"
-            res = InfrastructureManager.GetInfrastructureState(id, auth)
+            res = call_im("GetInfrastructureState", id, auth)
+            set_etag(get_etag(id, auth))
             return format_output(res, default_type="application/json", field_name="state")
         else:
             return return_error(404, "Incorrect infrastructure property")
@@ -319,6 +675,7 @@ def RESTGetInfrastructureProperty(id=None, prop=None):
 
 
 @app.route('/infrastructures', method='GET')
+@admission_control("GetInfrastructureList")
 def RESTGetInfrastructureList():
     try:
         auth = get_auth_header()
@@ -326,15 +683,41 @@ def RESTGetInfrastructureList():
         return return_error(401, "No authentication data provided")
 
     try:
-        inf_ids = InfrastructureManager.GetInfrastructureList(auth)
-        res = []
-
         protocol = "http://"
         if Config.REST_SSL:
             protocol = "https://"
+        url = protocol + bottle.request.environ['HTTP_HOST'] + "/infrastructures"
+
+        try:
+            limit, after, filters = get_list_params()
+        except ValueError, ex:
+            return return_error(400, str(ex))
+
+        if "fields" in bottle.request.params.keys():
+            # Get the state of the infrastructures in the same call
+            if bottle.request.params.get("fields") != "state":
+                return return_error(400, "Incorrect value in fields parameter")
+            if "ids" in bottle.request.params.keys():
+                inf_ids = [inf_id.strip() for inf_id in bottle.request.params.get("ids").split(",") if inf_id.strip()]
+            else:
+                inf_ids = call_im("GetInfrastructureList", auth, limit, after, filters)
+                set_next_link(url, inf_ids, limit)
+            states = {}
+            if inf_ids:
+                states = call_im("GetInfrastructuresState", inf_ids, auth)
+            res = []
+            for inf_id in inf_ids:
+                state = states[str(inf_id)]
+                state['uri'] = url + "/" + str(inf_id)
+                res.append(state)
+            return format_output(res, default_type="application/json", field_name="infrastructures")
+
+        inf_ids = call_im("GetInfrastructureList", auth, limit, after, filters)
+        set_next_link(url, inf_ids, limit)
+        res = []
+
         for inf_id in inf_ids:
-            res.append(
-                protocol + bottle.request.environ['HTTP_HOST'] + "/infrastructures/" + str(inf_id))
+            res.append(url + "/" + str(inf_id))
 
         return format_output(res, "text/uri-list", "uri-list", "uri")
     except InvaliddUserException, ex:
@@ -345,6 +728,7 @@ def RESTGetInfrastructureList():
 
 
 @app.route('/infrastructures', method='POST')
+@admission_control("CreateInfrastructure", "CreateInfrastructureAsync")
 def RESTCreateInfrastructure():
     try:
         auth = get_auth_header()
@@ -352,6 +736,19 @@ def RESTCreateInfrastructure():
         return return_error(401, "No authentication data provided")
 
     try:
+        async_call = False
+        if "async" in bottle.request.params.keys():
+            str_async = bottle.request.params.get("async").lower()
+            if str_async in ['yes', 'true', '1']:
+                async_call = True
+            elif str_async in ['no', 'false', '0']:
+                async_call = False
+            else:
+                return return_error(400, "Incorrect value in async parameter")
+
+        # Optional key to deduplicate the retries of the call
+        idempotency_key = bottle.request.headers.get('Idempotency-Key')
+
         content_type = get_media_type('Content-Type')
         radl_data = bottle.request.body.read()
 
@@ -363,7 +760,13 @@ def RESTCreateInfrastructure():
             else:
                 return return_error(415, "Unsupported Media Type %s" % content_type)
 
-        inf_id = InfrastructureManager.CreateInfrastructure(radl_data, auth)
+        if async_call:
+            # Return the operation that deploys the resources in the background
+            op = call_im("CreateInfrastructureAsync", radl_data, auth, idempotency_key)
+            bottle.response.headers['InfID'] = op['inf_id']
+            return format_operation(op, accepted=True)
+
+        inf_id = call_im("CreateInfrastructure", radl_data, auth, idempotency_key)
 
         bottle.response.headers['InfID'] = inf_id
         bottle.response.content_type = "text/uri-list"
@@ -378,12 +781,15 @@ def RESTCreateInfrastructure():
         return format_output(res, "text/uri-list", "uri")
     except InvaliddUserException, ex:
         return return_error(401, "Error Getting Inf. info: " + str(ex))
+    except IdempotencyKeyConflictException, ex:
+        return return_error(409, "Error Creating Inf.: " + str(ex))
     except Exception, ex:
         logger.exception("Error Creating Inf.")
         return return_error(400, "Error Creating Inf.: " + str(ex))
 
 
 @app.route('/infrastructures/:infid/vms/:vmid', method='GET')
+@admission_control("GetVMInfo")
 def RESTGetVMInfo(infid=None, vmid=None):
     try:
         auth = get_auth_header()
@@ -391,7 +797,10 @@ def RESTGetVMInfo(infid=None, vmid=None):
         return return_error(401, "No authentication data provided")
 
     try:
-        radl = InfrastructureManager.GetVMInfo(infid, vmid, auth)
+        if not_modified(get_etag(infid, auth, vmid, fresh=True)):
+            return ""
+        radl = call_im("GetVMInfo", infid, vmid, auth)
+        set_etag(get_etag(infid, auth, vmid))
         return format_output(radl, field_name="radl")
     except DeletedInfrastructureException, ex:
         return return_error(404, "Error Getting VM. info: " + str(ex))
@@ -409,6 +818,7 @@ def RESTGetVMInfo(infid=None, vmid=None):
 
 
 @app.route('/infrastructures/:infid/vms/:vmid/:prop', method='GET')
+@admission_control("GetVMProperty")
 def RESTGetVMProperty(infid=None, vmid=None, prop=None):
     try:
         auth = get_auth_header()
@@ -416,10 +826,17 @@ def RESTGetVMProperty(infid=None, vmid=None, prop=None):
         return return_error(401, "No authentication data provided")
 
     try:
+        if not_modified(get_etag(infid, auth, vmid, fresh=(prop != "contmsg"))):
+            return ""
         if prop == 'contmsg':
-            info = InfrastructureManager.GetVMContMsg(infid, vmid, auth)
+            try:
+                offset, limit = get_cont_msg_params()
+            except ValueError:
+                return return_error(400, "Incorrect value in offset or limit parameters")
+            info = call_im("GetVMContMsg", infid, vmid, auth, offset, limit)
         else:
-            info = InfrastructureManager.GetVMProperty(infid, vmid, prop, auth)
+            info = call_im("GetVMProperty", infid, vmid, prop, auth)
+            set_etag(get_etag(infid, auth, vmid))
 
         if info is None:
             return return_error(404, "Incorrect property %s for VM ID %s" % (prop, vmid))
@@ -441,6 +858,7 @@ def RESTGetVMProperty(infid=None, vmid=None, prop=None):
 
 
 @app.route('/infrastructures/:id', method='POST')
+@admission_control("AddResource", "AddResourceAsync")
 def RESTAddResource(id=None):
     try:
         auth = get_auth_header()
@@ -458,6 +876,19 @@ def RESTAddResource(id=None):
             else:
                 return return_error(400, "Incorrect value in context parameter")
 
+        async_call = False
+        if "async" in bottle.request.params.keys():
+            str_async = bottle.request.params.get("async").lower()
+            if str_async in ['yes', 'true', '1']:
+                async_call = True
+            elif str_async in ['no', 'false', '0']:
+                async_call = False
+            else:
+                return return_error(400, "Incorrect value in async parameter")
+
+        # Optional key to deduplicate the retries of the call
+        idempotency_key = bottle.request.headers.get('Idempotency-Key')
+
         content_type = get_media_type('Content-Type')
         radl_data = bottle.request.body.read()
 
@@ -469,8 +900,11 @@ def RESTAddResource(id=None):
             else:
                 return return_error(415, "Unsupported Media Type %s" % content_type)
 
-        vm_ids = InfrastructureManager.AddResource(
-            id, radl_data, auth, context)
+        if async_call:
+            op = call_im("AddResourceAsync", id, radl_data, auth, context, idempotency_key)
+            return format_operation(op, accepted=True)
+
+        vm_ids = call_im("AddResource", id, radl_data, auth, context, idempotency_key=idempotency_key)
 
         protocol = "http://"
         if Config.REST_SSL:
@@ -487,12 +921,15 @@ def RESTAddResource(id=None):
         return return_error(404, "Error Adding resources: " + str(ex))
     except UnauthorizedUserException, ex:
         return return_error(403, "Error Adding resources: " + str(ex))
+    except IdempotencyKeyConflictException, ex:
+        return return_error(409, "Error Adding resources: " + str(ex))
     except Exception, ex:
         logger.exception("Error Adding resources")
         return return_error(400, "Error Adding resources: " + str(ex))
 
 
 @app.route('/infrastructures/:infid/vms/:vmid', method='DELETE')
+@admission_control("RemoveResource")
 def RESTRemoveResource(infid=None, vmid=None):
     try:
         auth = get_auth_header()
@@ -510,7 +947,7 @@ def RESTRemoveResource(infid=None, vmid=None):
             else:
                 return return_error(400, "Incorrect value in context parameter")
 
-        InfrastructureManager.RemoveResource(infid, vmid, auth, context)
+        call_im("RemoveResource", infid, vmid, auth, context)
         bottle.response.content_type = "text/plain"
         return ""
     except DeletedInfrastructureException, ex:
@@ -529,6 +966,7 @@ def RESTRemoveResource(infid=None, vmid=None):
 
 
 @app.route('/infrastructures/:infid/vms/:vmid', method='PUT')
+@admission_control("AlterVM")
 def RESTAlterVM(infid=None, vmid=None):
     try:
         auth = get_auth_header()
@@ -547,7 +985,7 @@ def RESTAlterVM(infid=None, vmid=None):
             else:
                 return return_error(415, "Unsupported Media Type %s" % content_type)
 
-        vm_info = InfrastructureManager.AlterVM(infid, vmid, radl_data, auth)
+        vm_info = call_im("AlterVM", infid, vmid, radl_data, auth)
 
         return format_output(vm_info, field_name="radl")
     except DeletedInfrastructureException, ex:
@@ -566,6 +1004,7 @@ def RESTAlterVM(infid=None, vmid=None):
 
 
 @app.route('/infrastructures/:id/reconfigure', method='PUT')
+@admission_control("Reconfigure")
 def RESTReconfigureInfrastructure(id=None):
     try:
         auth = get_auth_header()
@@ -595,7 +1034,7 @@ def RESTReconfigureInfrastructure(id=None):
         else:
             radl_data = ""
         bottle.response.content_type = "text/plain"
-        return InfrastructureManager.Reconfigure(id, radl_data, auth, vm_list)
+        return call_im("Reconfigure", id, radl_data, auth, vm_list)
     except DeletedInfrastructureException, ex:
         return return_error(404, "Error reconfiguring infrastructure: " + str(ex))
     except IncorrectInfrastructureException, ex:
@@ -608,6 +1047,7 @@ def RESTReconfigureInfrastructure(id=None):
 
 
 @app.route('/infrastructures/:id/start', method='PUT')
+@admission_control("StartInfrastructure")
 def RESTStartInfrastructure(id=None):
     try:
         auth = get_auth_header()
@@ -616,7 +1056,7 @@ def RESTStartInfrastructure(id=None):
 
     try:
         bottle.response.content_type = "text/plain"
-        return InfrastructureManager.StartInfrastructure(id, auth)
+        return call_im("StartInfrastructure", id, auth)
     except DeletedInfrastructureException, ex:
         return return_error(404, "Error starting infrastructure: " + str(ex))
     except IncorrectInfrastructureException, ex:
@@ -629,6 +1069,7 @@ def RESTStartInfrastructure(id=None):
 
 
 @app.route('/infrastructures/:id/stop', method='PUT')
+@admission_control("StopInfrastructure")
 def RESTStopInfrastructure(id=None):
     try:
         auth = get_auth_header()
@@ -637,7 +1078,7 @@ def RESTStopInfrastructure(id=None):
 
     try:
         bottle.response.content_type = "text/plain"
-        return InfrastructureManager.StopInfrastructure(id, auth)
+        return call_im("StopInfrastructure", id, auth)
     except DeletedInfrastructureException, ex:
         return return_error(404, "Error stopping infrastructure: " + str(ex))
     except IncorrectInfrastructureException, ex:
@@ -650,6 +1091,7 @@ def RESTStopInfrastructure(id=None):
 
 
 @app.route('/infrastructures/:infid/vms/:vmid/start', method='PUT')
+@admission_control("StartVM")
 def RESTStartVM(infid=None, vmid=None, prop=None):
     try:
         auth = get_auth_header()
@@ -658,7 +1100,7 @@ def RESTStartVM(infid=None, vmid=None, prop=None):
 
     try:
         bottle.response.content_type = "text/plain"
-        return InfrastructureManager.StartVM(infid, vmid, auth)
+        return call_im("StartVM", infid, vmid, auth)
     except DeletedInfrastructureException, ex:
         return return_error(404, "Error starting VM: " + str(ex))
     except IncorrectInfrastructureException, ex:
@@ -675,6 +1117,7 @@ def RESTStartVM(infid=None, vmid=None, prop=None):
 
 
 @app.route('/infrastructures/:infid/vms/:vmid/stop', method='PUT')
+@admission_control("StopVM")
 def RESTStopVM(infid=None, vmid=None, prop=None):
     try:
         auth = get_auth_header()
@@ -683,7 +1126,7 @@ def RESTStopVM(infid=None, vmid=None, prop=None):
 
     try:
         bottle.response.content_type = "text/plain"
-        return InfrastructureManager.StopVM(infid, vmid, auth)
+        return call_im("StopVM", infid, vmid, auth)
     except DeletedInfrastructureException, ex:
         return return_error(404, "Error stopping VM: " + str(ex))
     except IncorrectInfrastructureException, ex:
@@ -699,7 +1142,50 @@ def RESTStopVM(infid=None, vmid=None, prop=None):
         return return_error(400, "Error stopping VM: " + str(ex))
 
 
+@app.route('/operations/:id', method='GET')
+@admission_control("GetOperation")
+def RESTGetOperation(id=None):
+    try:
+        auth = get_auth_header()
+    except:
+        return return_error(401, "No authentication data provided")
+
+    try:
+        return format_operation(call_im("GetOperation", id, auth))
+    except IncorrectOperationException, ex:
+        return return_error(404, "Error Getting the operation: " + str(ex))
+    except UnauthorizedUserException, ex:
+        return return_error(403, "Error Getting the operation: " + str(ex))
+    except InvaliddUserException, ex:
+        return return_error(401, "Error Getting the operation: " + str(ex))
+    except Exception, ex:
+        logger.exception("Error Getting the operation")
+        return return_error(400, "Error Getting the operation: " + str(ex))
+
+
+@app.route('/operations/:id', method='DELETE')
+@admission_control("CancelOperation")
+def RESTCancelOperation(id=None):
+    try:
+        auth = get_auth_header()
+    except:
+        return return_error(401, "No authentication data provided")
+
+    try:
+        return format_operation(call_im("CancelOperation", id, auth))
+    except IncorrectOperationException, ex:
+        return return_error(404, "Error Cancelling the operation: " + str(ex))
+    except UnauthorizedUserException, ex:
+        return return_error(403, "Error Cancelling the operation: " + str(ex))
+    except InvaliddUserException, ex:
+        return return_error(401, "Error Cancelling the operation: " + str(ex))
+    except Exception, ex:
+        logger.exception("Error Cancelling the operation")
+        return return_error(400, "Error Cancelling the operation: " + str(ex))
+
+
 @app.route('/version', method='GET')
+@admission_control("GetVersion")
 def RESTGeVersion():
     try:
         from IM import __version__ as version
@@ -708,6 +1194,17 @@ def RESTGeVersion():
         return return_error(400, "Error getting IM version: " + str(ex))
 
 
+@app.route('/status', method='GET')
+def RESTGetStatus():
+    # It is not limited by the admission control to show the load even if the IM is overloaded
+    try:
+        res = InfrastructureManager.GetStatus()
+        bottle.response.content_type = "application/json"
+        return json.dumps(res)
+    except Exception, ex:
+        return return_error(400, "Error getting IM status: " + str(ex))
+
+
 @app.error(403)
 def error_mesage_403(error):
     return return_error(403, error.body)
@@ -17,6 +17,7 @@
 
 
 import logging
+import sys
 
 from request import Request, AsyncRequest
 import InfrastructureManager
@@ -41,6 +42,7 @@ class IMBaseRequest(AsyncRequest):
     GET_INFRASTRUCTURE_LIST = "GetInfrastructureList"
     GET_INFRASTRUCTURE_RADL = "GetInfrastructureRADL"
     GET_INFRASTRUCTURE_STATE = "GetInfrastructureState"
+    GET_INFRASTRUCTURES_STATE = "GetInfrastructuresState"
     GET_VM_CONT_MSG = "GetVMContMsg"
     GET_VM_INFO = "GetVMInfo"
     GET_VM_PROPERTY = "GetVMProperty"
@@ -52,59 +54,45 @@ class IMBaseRequest(AsyncRequest):
     START_VM = "StartVM"
     STOP_VM = "StopVM"
     GET_VERSION = "GetVersion"
+    CREATE_INFRASTRUCTURE_ASYNC = "CreateInfrastructureAsync"
+    ADD_RESOURCE_ASYNC = "AddResourceAsync"
+    GET_OPERATION = "GetOperation"
+    CANCEL_OPERATION = "CancelOperation"
 
     @staticmethod
-    def create_request(function, arguments=(), priority=Request.PRIORITY_NORMAL):
-        if function == IMBaseRequest.ADD_RESOURCE:
-            return Request_AddResource(arguments)
-        elif function == IMBaseRequest.ALTER_VM:
-            return Request_AlterVM(arguments)
-        elif function == IMBaseRequest.CREATE_INFRASTRUCTURE:
-            return Request_CreateInfrastructure(arguments)
-        elif function == IMBaseRequest.DESTROY_INFRASTRUCTURE:
-            return Request_DestroyInfrastructure(arguments)
-        elif function == IMBaseRequest.EXPORT_INFRASTRUCTURE:
-            return Request_ExportInfrastructure(arguments)
-        elif function == IMBaseRequest.GET_INFRASTRUCTURE_CONT_MSG:
-            return Request_GetInfrastructureContMsg(arguments)
-        elif function == IMBaseRequest.GET_INFRASTRUCTURE_INFO:
-            return Request_GetInfrastructureInfo(arguments)
-        elif function == IMBaseRequest.GET_INFRASTRUCTURE_LIST:
-            return Request_GetInfrastructureList(arguments)
-        elif function == IMBaseRequest.GET_INFRASTRUCTURE_RADL:
-            return Request_GetInfrastructureRADL(arguments)
-        elif function == IMBaseRequest.GET_VM_CONT_MSG:
-            return Request_GetVMContMsg(arguments)
-        elif function == IMBaseRequest.GET_VM_INFO:
-            return Request_GetVMInfo(arguments)
-        elif function == IMBaseRequest.GET_VM_PROPERTY:
-            return Request_GetVMProperty(arguments)
-        elif function == IMBaseRequest.IMPORT_INFRASTRUCTURE:
-            return Request_ImportInfrastructure(arguments)
-        elif function == IMBaseRequest.RECONFIGURE:
-            return Request_Reconfigure(arguments)
-        elif function == IMBaseRequest.REMOVE_RESOURCE:
-            return Request_RemoveResource(arguments)
-        elif function == IMBaseRequest.START_INFRASTRUCTURE:
-            return Request_StartInfrastructure(arguments)
-        elif function == IMBaseRequest.STOP_INFRASTRUCTURE:
-            return Request_StopInfrastructure(arguments)
-        elif function == IMBaseRequest.START_VM:
-            return Request_StartVM(arguments)
-        elif function == IMBaseRequest.STOP_VM:
-            return Request_StopVM(arguments)
-        elif function == IMBaseRequest.GET_INFRASTRUCTURE_STATE:
-            return Request_GetInfrastructureState(arguments)
-        elif function == IMBaseRequest.GET_VERSION:
-            return Request_GetVersion(arguments)
-
-        else:
+    def create_request(function, arguments=(), priority=None):
+        return IMBaseRequest.get_request_class(function)(arguments, priority)
+
+    @staticmethod
+    def get_request_class(function):
+        """ Get the request class of an API function """
+        if function not in REQUEST_CLASSES:
             raise NotImplementedError("Function not Implemented")
+        return REQUEST_CLASSES[function]
+
+    default_priority = Request.PRIORITY_NORMAL
+    """Priority of the requests of this class: reads are high, state changes normal and destroys low."""
 
-    def __init__(self, arguments=(), priority=Request.PRIORITY_NORMAL):
-        AsyncRequest.__init__(self, arguments, priority)
+    def __init__(self, arguments=(), priority=None, enqueue=True):
+        if priority is None:
+            priority = self.default_priority
+        AsyncRequest.__init__(self, arguments, priority, enqueue)
         self._error_mesage = "Error."
 
+    def get_user(self):
+        """ Get the IM username of the auth data of the arguments """
+        # some requests have no arguments (e.g. GetVersion)
+        if not isinstance(self.arguments, (list, tuple)):
+            return None
+        for arg in self.arguments:
+            if isinstance(arg, Authentication):
+                arg = arg.auth_list
+            if isinstance(arg, list):
+                for item in arg:
+                    if isinstance(item, dict) and item.get('type') == 'InfrastructureManager':
+                        return item.get('username')
+        return None
+
     def _call_function(self):
         """
         This function call the IM functionality
@@ -120,6 +108,8 @@ class IMBaseRequest(AsyncRequest):
             logger.exception(self._error_mesage)
             self.set(str(ex))
             return False
+        finally:
+            InfrastructureManager.InfrastructureManager.response_sent()
 
 
 class Request_AddResource(IMBaseRequest):
@@ -127,12 +117,15 @@ class Request_AddResource(IMBaseRequest):
     Request class for the AddResource function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Adding resources."
-        (inf_id, radl_data, auth_data, context) = self.arguments
+        (inf_id, radl_data, auth_data, context, idempotency_key) = self.arguments
         return InfrastructureManager.InfrastructureManager.AddResource(inf_id, radl_data,
                                                                        Authentication(auth_data),
-                                                                       context)
+                                                                       context,
+                                                                       idempotency_key=idempotency_key)
 
 
 class Request_RemoveResource(IMBaseRequest):
@@ -140,6 +133,8 @@ class Request_RemoveResource(IMBaseRequest):
     Request class for the RemoveResource function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Removing resources."
         (inf_id, vm_list, auth_data, context) = self.arguments
@@ -153,6 +148,8 @@ class Request_GetInfrastructureInfo(IMBaseRequest):
     Request class for the GetInfrastructureInfo function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error Getting Inf. Info."
         (inf_id, auth_data) = self.arguments
@@ -164,6 +161,8 @@ class Request_GetVMInfo(IMBaseRequest):
     Request class for the GetVMInfo function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error Getting VM Info."
         (inf_id, vm_id, auth_data) = self.arguments
@@ -175,6 +174,8 @@ class Request_GetVMProperty(IMBaseRequest):
     Request class for the GetVMProperty function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error Getting VM Property."
         (inf_id, vm_id, property_name, auth_data) = self.arguments
@@ -187,6 +188,8 @@ class Request_AlterVM(IMBaseRequest):
     Request class for the AlterVM function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Changing VM Info."
         (inf_id, vm_id, radl, auth_data) = self.arguments
@@ -198,6 +201,9 @@ class Request_DestroyInfrastructure(IMBaseRequest):
     Request class for the DestroyInfrastructure function
     """
 
+    default_priority = Request.PRIORITY_LOW
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Destroying Inf."
         (inf_id, auth_data) = self.arguments
@@ -209,6 +215,8 @@ class Request_StopInfrastructure(IMBaseRequest):
     Request class for the StopInfrastructure function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Stopping Inf."
         (inf_id, auth_data) = self.arguments
@@ -220,6 +228,8 @@ class Request_StartInfrastructure(IMBaseRequest):
     Request class for the StartInfrastructure function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Starting Inf."
         (inf_id, auth_data) = self.arguments
@@ -231,10 +241,13 @@ class Request_CreateInfrastructure(IMBaseRequest):
     Request class for the CreateInfrastructure function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Creating Inf."
-        (radl_data, auth_data) = self.arguments
-        return InfrastructureManager.InfrastructureManager.CreateInfrastructure(radl_data, Authentication(auth_data))
+        (radl_data, auth_data, idempotency_key) = self.arguments
+        return InfrastructureManager.InfrastructureManager.CreateInfrastructure(radl_data, Authentication(auth_data),
+                                                                                idempotency_key)
 
 
 class Request_GetInfrastructureList(IMBaseRequest):
@@ -242,10 +255,13 @@ class Request_GetInfrastructureList(IMBaseRequest):
     Request class for the GetInfrastructureList function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error Getting Inf. List."
-        (auth_data) = self.arguments
-        return InfrastructureManager.InfrastructureManager.GetInfrastructureList(Authentication(auth_data))
+        (auth_data, limit, after, filters) = self.arguments
+        return InfrastructureManager.InfrastructureManager.GetInfrastructureList(Authentication(auth_data),
+                                                                                 limit, after, filters)
 
 
 class Request_Reconfigure(IMBaseRequest):
@@ -253,6 +269,8 @@ class Request_Reconfigure(IMBaseRequest):
     Request class for the Reconfigure function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error Reconfiguring Inf."
         (inf_id, radl_data, auth_data, vm_list) = self.arguments
@@ -276,6 +294,8 @@ class Request_ExportInfrastructure(IMBaseRequest):
     Request class for the ExportInfrastructure function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error Exporting Inf."
         (inf_id, delete, auth_data) = self.arguments
@@ -288,6 +308,8 @@ class Request_GetInfrastructureRADL(IMBaseRequest):
     Request class for the GetInfrastructureRADL function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error getting RADL of the Inf."
         (inf_id, auth_data) = self.arguments
@@ -299,10 +321,13 @@ class Request_GetVMContMsg(IMBaseRequest):
     Request class for the GetVMContMsg function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error Getting VM cont msg."
-        (inf_id, vm_id, auth_data) = self.arguments
-        return InfrastructureManager.InfrastructureManager.GetVMContMsg(inf_id, vm_id, Authentication(auth_data))
+        (inf_id, vm_id, auth_data, offset, limit) = self.arguments
+        return InfrastructureManager.InfrastructureManager.GetVMContMsg(inf_id, vm_id, Authentication(auth_data),
+                                                                        offset, limit)
 
 
 class Request_GetInfrastructureContMsg(IMBaseRequest):
@@ -310,10 +335,13 @@ class Request_GetInfrastructureContMsg(IMBaseRequest):
     Request class for the GetInfrastructureContMsg function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error gettinf the Inf. cont msg"
-        (inf_id, auth_data) = self.arguments
-        return InfrastructureManager.InfrastructureManager.GetInfrastructureContMsg(inf_id, Authentication(auth_data))
+        (inf_id, auth_data, offset, limit) = self.arguments
+        return InfrastructureManager.InfrastructureManager.GetInfrastructureContMsg(inf_id, Authentication(auth_data),
+                                                                                    offset, limit)
 
 
 class Request_StartVM(IMBaseRequest):
@@ -321,6 +349,8 @@ class Request_StartVM(IMBaseRequest):
     Request class for the StartVM function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error starting VM"
         (inf_id, vm_id, auth_data) = self.arguments
@@ -334,6 +364,8 @@ class Request_StopVM(IMBaseRequest):
     Request class for the StopVM function
     """
 
+    long_operation = True
+
     def _call_function(self):
         self._error_mesage = "Error stopping VM"
         (inf_id, vm_id, auth_data) = self.arguments
@@ -347,17 +379,158 @@ class Request_GetInfrastructureState(IMBaseRequest):
     Request class for the GetInfrastructureState function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error getting the Inf. state"
         (inf_id, auth_data) = self.arguments
         return InfrastructureManager.InfrastructureManager.GetInfrastructureState(inf_id, Authentication(auth_data))
 
 
+class Request_GetInfrastructuresState(IMBaseRequest):
+    """
+    Request class for the GetInfrastructuresState function
+    """
+
+    default_priority = Request.PRIORITY_HIGH
+
+    def _call_function(self):
+        self._error_mesage = "Error getting the state of the Infs."
+        (inf_ids, auth_data) = self.arguments
+        return InfrastructureManager.InfrastructureManager.GetInfrastructuresState(inf_ids, Authentication(auth_data))
+
+
+class Request_CreateInfrastructureAsync(IMBaseRequest):
+    """
+    Request class for the CreateInfrastructureAsync function
+    """
+
+    def _call_function(self):
+        self._error_mesage = "Error Creating Inf."
+        (radl_data, auth_data, idempotency_key) = self.arguments
+        return InfrastructureManager.InfrastructureManager.CreateInfrastructureAsync(radl_data,
+                                                                                     Authentication(auth_data),
+                                                                                     idempotency_key)
+
+
+class Request_AddResourceAsync(IMBaseRequest):
+    """
+    Request class for the AddResourceAsync function
+    """
+
+    def _call_function(self):
+        self._error_mesage = "Error Adding resources."
+        (inf_id, radl_data, auth_data, context, idempotency_key) = self.arguments
+        return InfrastructureManager.InfrastructureManager.AddResourceAsync(inf_id, radl_data,
+                                                                            Authentication(auth_data),
+                                                                            context, idempotency_key)
+
+
+class Request_GetOperation(IMBaseRequest):
+    """
+    Request class for the GetOperation function
+    """
+
+    default_priority = Request.PRIORITY_HIGH
+
+    def _call_function(self):
+        self._error_mesage = "Error Getting the operation."
+        (op_id, auth_data) = self.arguments
+        return InfrastructureManager.InfrastructureManager.GetOperation(op_id, Authentication(auth_data))
+
+
+class Request_CancelOperation(IMBaseRequest):
+    """
+    Request class for the CancelOperation function
+    """
+
+    def _call_function(self):
+        self._error_mesage = "Error Cancelling the operation."
+        (op_id, auth_data) = self.arguments
+        return InfrastructureManager.InfrastructureManager.CancelOperation(op_id, Authentication(auth_data))
+
+
 class Request_GetVersion(IMBaseRequest):
     """
     Request class for the GetVersion function
     """
 
+    default_priority = Request.PRIORITY_HIGH
+
     def _call_function(self):
         self._error_mesage = "Error getting IM service version"
         return version
+
+
+class Request_Function(IMBaseRequest):
+    """
+    Request that executes a function with the priority and the long_operation flag of the
+    request class of an API function, keeping its result and its exception unchanged.
+    It is not queued in the system queue: use :py:meth:`run` to execute it.
+    """
+
+    def __init__(self, api_function, function, arguments=(), kwargs=None):
+        request_class = IMBaseRequest.get_request_class(api_function)
+        self.long_operation = request_class.long_operation
+        self.function = function
+        self.kwargs = kwargs or {}
+        self.exc_info = None
+        """Exception raised by the function (as returned by sys.exc_info())."""
+        IMBaseRequest.__init__(self, arguments, request_class.default_priority, enqueue=False)
+
+    def _execute(self):
+        try:
+            self.set(self.function(*self.arguments, **self.kwargs))
+            return True
+        except Exception:
+            self.exc_info = sys.exc_info()
+            return False
+
+    @staticmethod
+    def run(api_function, function, *args, **kwargs):
+        """
+        Execute a function in the request pool as a request of the API function api_function
+        (with the same priority, fair share between users and limit of long operations) and
+        wait for it. Used by the REST API to share the pool with the XML-RPC API.
+
+        Returns: the result of the function, or raises the exception raised by it.
+        """
+        request = Request_Function(api_function, function, args, kwargs)
+        request.process()
+        request.wait()
+        if request.status() != Request.STATUS_PROCESSED:
+            if request.exc_info:
+                raise request.exc_info[0], request.exc_info[1], request.exc_info[2]
+            raise Exception(request.get())
+        return request.get()
+
+
+REQUEST_CLASSES = {
+    IMBaseRequest.ADD_RESOURCE: Request_AddResource,
+    IMBaseRequest.ALTER_VM: Request_AlterVM,
+    IMBaseRequest.CREATE_INFRASTRUCTURE: Request_CreateInfrastructure,
+    IMBaseRequest.DESTROY_INFRASTRUCTURE: Request_DestroyInfrastructure,
+    IMBaseRequest.EXPORT_INFRASTRUCTURE: Request_ExportInfrastructure,
+    IMBaseRequest.GET_INFRASTRUCTURE_CONT_MSG: Request_GetInfrastructureContMsg,
+    IMBaseRequest.GET_INFRASTRUCTURE_INFO: Request_GetInfrastructureInfo,
+    IMBaseRequest.GET_INFRASTRUCTURE_LIST: Request_GetInfrastructureList,
+    IMBaseRequest.GET_INFRASTRUCTURE_RADL: Request_GetInfrastructureRADL,
+    IMBaseRequest.GET_VM_CONT_MSG: Request_GetVMContMsg,
+    IMBaseRequest.GET_VM_INFO: Request_GetVMInfo,
+    IMBaseRequest.GET_VM_PROPERTY: Request_GetVMProperty,
+    IMBaseRequest.IMPORT_INFRASTRUCTURE: Request_ImportInfrastructure,
+    IMBaseRequest.RECONFIGURE: Request_Reconfigure,
+    IMBaseRequest.REMOVE_RESOURCE: Request_RemoveResource,
+    IMBaseRequest.START_INFRASTRUCTURE: Request_StartInfrastructure,
+    IMBaseRequest.STOP_INFRASTRUCTURE: Request_StopInfrastructure,
+    IMBaseRequest.START_VM: Request_StartVM,
+    IMBaseRequest.STOP_VM: Request_StopVM,
+    IMBaseRequest.GET_INFRASTRUCTURE_STATE: Request_GetInfrastructureState,
+    IMBaseRequest.GET_INFRASTRUCTURES_STATE: Request_GetInfrastructuresState,
+    IMBaseRequest.GET_VERSION: Request_GetVersion,
+    IMBaseRequest.CREATE_INFRASTRUCTURE_ASYNC: Request_CreateInfrastructureAsync,
+    IMBaseRequest.ADD_RESOURCE_ASYNC: Request_AddResourceAsync,
+    IMBaseRequest.GET_OPERATION: Request_GetOperation,
+    IMBaseRequest.CANCEL_OPERATION: Request_CancelOperation
+}
+"""Map from the name of each API function to its request class."""
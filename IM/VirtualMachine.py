@@ -22,16 +22,19 @@ import string
 import json
 import tempfile
 import logging
+from itertools import count
 
 from radl.radl import network, RADL
 from IM.SSH import SSH
 from IM.SSHRetry import SSHRetry
 from IM.config import Config
-from radl.radl_parse import parse_radl
+from IM.lazyradl import LazyRADL
+from IM.ctxtlog import ContextualizationLog
+from IM.events import publish
 import IM.CloudInfo
 
 
-class VirtualMachine:
+class VirtualMachine(object):
 
     # VM states
     UNKNOWN = "unknown"
@@ -49,6 +52,14 @@ class VirtualMachine:
 
     logger = logging.getLogger('InfrastructureManager')
 
+    _versions = count(1)
+    """Counter to assign the versions of the VMs (unique in the process, also for the VMs reloaded)."""
+
+    info = LazyRADL('info')
+    """RADL object with the current information about the VM (parsed lazily)"""
+    requested_radl = LazyRADL('requested_radl')
+    """Original RADL requested by the user (parsed lazily)"""
+
     def __init__(self, inf, cloud_id, cloud, info, requested_radl, cloud_connector=None, im_id=None):
         self._lock = threading.Lock()
         """Threading Lock to avoid concurrency problems."""
@@ -76,7 +87,7 @@ class VirtualMachine:
         """RADL object with the current information about the VM"""
         self.requested_radl = requested_radl
         """Original RADL requested by the user"""
-        self.cont_out = ""
+        self.cont_log = ContextualizationLog()
         """Contextualization output message"""
         self.configured = None
         """Configure flag. If it is None the contextualization has not been finished yet"""
@@ -86,14 +97,54 @@ class VirtualMachine:
         """Number of errors in the ssh connection trying to get the state of the ctxt pid """
         self.cloud_connector = cloud_connector
         """CloudConnector object to connect with the IaaS platform"""
+        self.version = next(VirtualMachine._versions)
+        """Change counter of the VM data (see :py:meth:`changed`)"""
+        self._info_digest = None
+        """Digest of the info of the VM in the last update of the status"""
+
+    def changed(self):
+        """
+        Register a change of the VM data (used to detect changes without comparing
+        the data, as in the ETags of the REST API)
+        """
+        self.version = next(VirtualMachine._versions)
+
+    @property
+    def cont_out(self):
+        """Contextualization output message (the complete log)"""
+        return self.get_cont_msg()
 
-    def serialize(self):
+    @cont_out.setter
+    def cont_out(self, value):
+        self.cont_log.reset(value)
+
+    def get_cont_msg(self, offset=0, limit=None):
+        """
+        Get the contextualization output message, or a part of it
+        (see :py:meth:`ContextualizationLog.read`)
+        """
+        return self.cont_log.read(self.inf.id, self.im_id, offset, limit)
+
+    def get_cont_msg_size(self):
+        """ Get the size of the contextualization output message """
+        return self.cont_log.size(self.inf.id, self.im_id)
+
+    def serialize(self, cont_out=False):
+        """
+        Serialize the VM data.
+        The contextualization log is stored independently, only included if cont_out is True.
+        """
         with self._lock:
             odict = self.__dict__.copy()
         # Quit the lock to the data to be store by pickle
         del odict['_lock']
         del odict['cloud_connector']
         del odict['inf']
+        del odict['cont_log']
+        del odict['version']
+        del odict['_info_digest']
+        if cont_out:
+            odict['cont_out'] = self.cont_out
         # To avoid errors tests with Mock objects
         if 'get_ssh' in odict:
             del odict['get_ssh']
@@ -101,9 +152,9 @@ class VirtualMachine:
             del odict['get_ctxt_log']
 
         if odict['info']:
-            odict['info'] = str(odict['info'])
+            odict['info'] = LazyRADL.to_str(odict['info'])
         if odict['requested_radl']:
-            odict['requested_radl'] = str(odict['requested_radl'])
+            odict['requested_radl'] = LazyRADL.to_str(odict['requested_radl'])
         if odict['cloud']:
             odict['cloud'] = odict['cloud'].serialize()
         return json.dumps(odict)
@@ -113,12 +164,14 @@ class VirtualMachine:
         dic = json.loads(str_data)
         if dic['cloud']:
             dic['cloud'] = IM.CloudInfo.CloudInfo.deserialize(dic['cloud'])
-        if dic['info']:
-            dic['info'] = parse_radl(dic['info'])
-        if dic['requested_radl']:
-            dic['requested_radl'] = parse_radl(dic['requested_radl'])
+        # info and requested_radl are parsed when they are accessed (see LazyRADL)
 
         newvm = VirtualMachine(None, None, None, None, None, None, dic['im_id'])
+        if 'cont_out' in dic:
+            # Data exported or stored by previous versions, with the complete log
+            newvm.cont_log.reset(dic.pop('cont_out'))
+        else:
+            newvm.cont_log = ContextualizationLog(stored=None)
         newvm.__dict__.update(dic)
         # If we load a VM that is not configured, set it to False
         # because the configuration process will be lost
@@ -137,6 +190,11 @@ class VirtualMachine:
             (success, msg) = self.cloud_connector.finalize(self, auth)
             if success:
                 self.destroy = True
+                if self.inf:
+                    # the VM is removed from the list of VMs of the inf
+                    self.inf.changed()
+                    publish(self.inf.id, "vm_deleted", {'vm_id': str(self.im_id)})
+            self.changed()
             # force the update of the information
             self.last_update = 0
             return (success, msg)
@@ -152,6 +210,7 @@ class VirtualMachine:
         (success, alter_res) = self.cloud_connector.alterVM(self, radl, auth)
         # force the update of the information
         self.last_update = 0
+        self.changed()
         return (success, alter_res)
 
     def stop(self, auth):
@@ -163,6 +222,7 @@ class VirtualMachine:
         (success, msg) = self.cloud_connector.stop(self, auth)
         # force the update of the information
         self.last_update = 0
+        self.changed()
         return (success, msg)
 
     def start(self, auth):
@@ -174,6 +234,7 @@ class VirtualMachine:
         (success, msg) = self.cloud_connector.start(self, auth)
         # force the update of the information
         self.last_update = 0
+        self.changed()
         return (success, msg)
 
     def getRequestedSystem(self):
@@ -480,8 +541,19 @@ class VirtualMachine:
                 else:
                     new_state = VirtualMachine.UNCONFIGURED
 
+            state_changed = new_state != self.state
             self.state = new_state
+            if state_changed and self.inf:
+                publish(self.inf.id, "vm_state", {'vm_id': str(self.im_id), 'state': new_state})
             self.info.systems[0].setValue("state", new_state)
+            if updated:
+                # the connector may have changed other data of the VM (IPs, ...)
+                info_digest = hash(str(self.info))
+                if info_digest != self._info_digest:
+                    self._info_digest = info_digest
+                    state_changed = True
+            if state_changed:
+                self.changed()
 
         return updated
 
@@ -667,7 +739,9 @@ class VirtualMachine:
         remote_dir = Config.REMOTE_CONF_DIR + "/" + \
             str(self.inf.id) + "/" + ip + "_" + str(self.getRemoteAccessPort())
 
-        initial_count_out = self.cont_out
+        # Size of the ctxt process log already added to the cont_out and its position in it
+        log_size = 0
+        log_offset = None
         wait = 0
         while self.ctxt_pid and not self.destroy:
             ctxt_pid = self.ctxt_pid
@@ -690,20 +764,21 @@ class VirtualMachine:
                             self.ssh_connect_errors = 0
                             self.configured = False
                             self.ctxt_pid = None
-                            self.cont_out = initial_count_out + ("Too much errors getting the status of ctxt process."
-                                                                 " Check some network connection problems or if user "
-                                                                 "credentials has been changed.")
+                            self.cont_log.append("Too much errors getting the status of ctxt process."
+                                                 " Check some network connection problems or if user "
+                                                 "credentials has been changed.")
                             return None
 
                     if exit_status != 0:
                         # The process has finished, get the outputs
                         ctxt_log = self.get_ctxt_log(remote_dir, True)
                         msg = self.get_ctxt_output(remote_dir, True)
-                        if ctxt_log:
-                            self.cont_out = initial_count_out + msg + ctxt_log
-                        else:
-                            self.cont_out = initial_count_out + msg + \
-                                "Error getting contextualization process log."
+                        if not ctxt_log:
+                            ctxt_log = "Error getting contextualization process log."
+                        if log_offset is not None:
+                            # Remove the partial log added while running, to set the output before it
+                            self.cont_log.truncate(self.inf.id, self.im_id, log_offset)
+                        self.cont_log.append(msg + ctxt_log)
                         self.ctxt_pid = None
                     else:
                         # Get the log of the process to update the cont_out
@@ -713,7 +788,10 @@ class VirtualMachine:
                             VirtualMachine.logger.debug(
                                 "Get the log of the ctxt process with pid: " + str(ctxt_pid))
                             ctxt_log = self.get_ctxt_log(remote_dir)
-                            self.cont_out = initial_count_out + ctxt_log
+                            if log_offset is None:
+                                log_offset = self.cont_log.size(self.inf.id, self.im_id)
+                            self.cont_log.append(ctxt_log[log_size:])
+                            log_size = max(log_size, len(ctxt_log))
                         # The process is still running, wait
                         time.sleep(Config.CHECK_CTXT_PROCESS_INTERVAL)
                         wait += Config.CHECK_CTXT_PROCESS_INTERVAL
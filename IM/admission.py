@@ -0,0 +1,173 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from IM.config import Config
+
+FAULT_SERVICE_UNAVAILABLE = 503
+"""Code of the XML-RPC fault returned when a call is rejected."""
+
+
+class ServiceUnavailableException(Exception):
+    """ Error when an API call is rejected by the admission control """
+
+    def __init__(self, msg="Service unavailable", retry_after=0):
+        Exception.__init__(self, msg)
+        self.retry_after = retry_after
+        """Seconds to wait before retrying the call."""
+
+
+class AdmissionControl:
+    """
+    Admission control of the API calls (XML-RPC and REST) in front of the IM.
+
+    The API functions are grouped in classes (deploy, operation and read). Each class
+    can have a maximum number of calls in process (max_active) and of calls waiting
+    for a free slot (max_queued). When both are full, or a call waits more than
+    queue_timeout seconds, the call is rejected with a :py:class:`ServiceUnavailableException`,
+    so an overloaded IM fails fast instead of accumulating work until it falls over.
+
+    Arguments:
+       - max_active(dict): Map from class to the maximum number of calls in process
+         (0 or not set means unlimited).
+       - max_queued(dict): Map from class to the maximum number of calls waiting.
+       - queue_timeout(int): Maximum time (in secs) waiting for a free slot.
+       - retry_after(int): Seconds to suggest the clients to wait before retrying.
+    """
+
+    DEPLOY = "deploy"
+    OPERATION = "operation"
+    READ = "read"
+
+    API_CLASSES = {
+        "CreateInfrastructure": DEPLOY,
+        "AddResource": DEPLOY,
+        "AlterVM": DEPLOY,
+        "Reconfigure": DEPLOY,
+        "DestroyInfrastructure": OPERATION,
+        "RemoveResource": OPERATION,
+        "StartInfrastructure": OPERATION,
+        "StopInfrastructure": OPERATION,
+        "StartVM": OPERATION,
+        "StopVM": OPERATION,
+        "ImportInfrastructure": OPERATION,
+        "CreateInfrastructureAsync": OPERATION,
+        "AddResourceAsync": OPERATION,
+        "CancelOperation": OPERATION,
+    }
+    """Class of the API functions (the rest are reads)."""
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    def __init__(self, max_active=None, max_queued=None, queue_timeout=60, retry_after=30):
+        self.max_active = max_active or {}
+        self.max_queued = max_queued or {}
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {}
+
+    @staticmethod
+    def get_api_class(function):
+        """ Get the class of an API function """
+        return AdmissionControl.API_CLASSES.get(function, AdmissionControl.READ)
+
+    def _get_stats(self, api_class):
+        """ Get the counters of a class. Must be called with the lock acquired """
+        if api_class not in self._stats:
+            self._stats[api_class] = {'active': 0, 'queued': 0, 'admitted': 0, 'rejected': 0}
+        return self._stats[api_class]
+
+    def _reject(self, api_class, stats, reason):
+        stats['rejected'] += 1
+        AdmissionControl.logger.warn("Rejecting a %s call: %s (%d in process, %d queued)." %
+                                     (api_class, reason, stats['active'], stats['queued']))
+        raise ServiceUnavailableException("Service unavailable: too many %s calls in process (%s)."
+                                          " Retry after %d seconds." % (api_class, reason, self.retry_after),
+                                          self.retry_after)
+
+    def acquire(self, api_class):
+        """ Wait for a free slot of the class, or raise a ServiceUnavailableException """
+        max_active = self.max_active.get(api_class, 0)
+        with self._cond:
+            stats = self._get_stats(api_class)
+            if max_active > 0 and stats['active'] >= max_active:
+                if stats['queued'] >= self.max_queued.get(api_class, 0):
+                    self._reject(api_class, stats, "queue full")
+                stats['queued'] += 1
+                deadline = time.time() + self.queue_timeout
+                try:
+                    while stats['active'] >= max_active:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._reject(api_class, stats, "timeout in queue")
+                        self._cond.wait(remaining)
+                finally:
+                    stats['queued'] -= 1
+            stats['active'] += 1
+            stats['admitted'] += 1
+
+    def release(self, api_class):
+        """ Free the slot of a call of the class """
+        with self._cond:
+            self._get_stats(api_class)['active'] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Get a dict with the gauges of each class: calls in process (active), waiting (queued),
+        admitted and rejected, and the limits (max_active, max_queued, 0 means unlimited).
+        """
+        res = {}
+        with self._cond:
+            for api_class in [AdmissionControl.DEPLOY, AdmissionControl.OPERATION, AdmissionControl.READ]:
+                res[api_class] = dict(self._get_stats(api_class))
+                res[api_class]['max_active'] = self.max_active.get(api_class, 0)
+                res[api_class]['max_queued'] = self.max_queued.get(api_class, 0)
+        return res
+
+
+def _parse_limits(values):
+    """ Parse a list of class:limit values """
+    res = {}
+    for elem in values:
+        if elem.strip():
+            api_class, limit = elem.strip().rsplit(":", 1)
+            res[api_class] = int(limit)
+    return res
+
+
+ADMISSION_CONTROL = None
+"""Shared admission control of the APIs, created by get_admission_control()."""
+_admission_lock = threading.Lock()
+
+
+def get_admission_control():
+    """
+    Get the :py:class:`AdmissionControl` shared by the APIs, created with the
+    ADMISSION_* options of the configuration.
+    """
+    global ADMISSION_CONTROL
+    with _admission_lock:
+        if ADMISSION_CONTROL is None:
+            ADMISSION_CONTROL = AdmissionControl(_parse_limits(Config.ADMISSION_MAX_ACTIVE),
+                                                 _parse_limits(Config.ADMISSION_MAX_QUEUED),
+                                                 Config.ADMISSION_QUEUE_TIMEOUT, Config.ADMISSION_RETRY_AFTER)
+        return ADMISSION_CONTROL
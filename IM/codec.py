@@ -0,0 +1,155 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Codecs to encode the data of the infrastructures stored in the DB"""
+import logging
+import zlib
+
+from IM.config import Config
+
+try:
+    import lz4.frame
+    LZ4_AVAILABLE = True
+except:
+    LZ4_AVAILABLE = False
+
+
+class BlobCodec:
+    """
+    Base class of the codecs of the data stored in the DB.
+    The encoded data starts with a header (MAGIC followed by the format ID of the
+    codec) to know how to decode it. Data without header is the plain serialized data.
+    """
+
+    MAGIC = "\x00IM"
+    """Prefix of the header of the encoded data (serialized data never starts with it)."""
+
+    name = None
+    """Name of the codec (used in the DATA_DB_CODEC option)."""
+    format_id = None
+    """ID of the format written in the header: codec type and version (2 chars)."""
+
+    def encode(self, data):
+        """ Encode the serialized data (str), returning it with the header """
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """ Decode the data (str) without the header """
+        raise NotImplementedError()
+
+
+class PlainCodec(BlobCodec):
+    """ Codec that stores the serialized data as is, without header """
+
+    name = "none"
+
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return data
+
+
+class ZlibCodec(BlobCodec):
+    """ Codec that compresses the data with zlib """
+
+    name = "zlib"
+    format_id = "z1"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        return BlobCodec.MAGIC + self.format_id + zlib.compress(data, self.level)
+
+    def decode(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Codec(BlobCodec):
+    """ Codec that compresses the data with LZ4 (faster than zlib but with a lower ratio) """
+
+    name = "lz4"
+    format_id = "l1"
+
+    def encode(self, data):
+        return BlobCodec.MAGIC + self.format_id + lz4.frame.compress(data)
+
+    def decode(self, data):
+        return lz4.frame.decompress(data)
+
+
+logger = logging.getLogger('InfrastructureManager')
+
+codecs = {}
+"""Map from codec name to :py:class:`BlobCodec`."""
+_formats = {}
+"""Map from format ID to :py:class:`BlobCodec`."""
+
+
+def register_codec(codec):
+    """ Add a new codec (it replaces any codec with the same name or format ID) """
+    codecs[codec.name] = codec
+    if codec.format_id:
+        _formats[codec.format_id] = codec
+
+
+register_codec(PlainCodec())
+register_codec(ZlibCodec())
+if LZ4_AVAILABLE:
+    register_codec(LZ4Codec())
+
+
+def get_codec(name=None):
+    """
+    Get the codec with the specified name (by default DATA_DB_CODEC).
+    If it does not exist (or its library is not installed) the zlib one is returned.
+    """
+    if name is None:
+        name = Config.DATA_DB_CODEC
+    if name not in codecs:
+        logger.warn("Codec %s not available. Using zlib." % name)
+        name = ZlibCodec.name
+    return codecs[name]
+
+
+def get_format(data):
+    """ Get the codec used to encode some data """
+    data = str(data) if isinstance(data, buffer) else data
+    if data and data.startswith(BlobCodec.MAGIC):
+        format_id = data[len(BlobCodec.MAGIC):len(BlobCodec.MAGIC) + 2]
+        if format_id not in _formats:
+            raise ValueError("Unknown format of the encoded data: %s" % repr(format_id))
+        return _formats[format_id]
+    return codecs[PlainCodec.name]
+
+
+def encode(data, name=None):
+    """ Encode the serialized data with the specified codec (by default DATA_DB_CODEC) """
+    return get_codec(name).encode(data)
+
+
+def decode(data):
+    """
+    Decode some data read from the DB, encoded with any codec,
+    or plain serialized data stored by previous IM versions.
+    """
+    if isinstance(data, buffer):
+        data = str(data)
+    codec = get_format(data)
+    if codec.format_id:
+        return codec.decode(data[len(BlobCodec.MAGIC) + len(codec.format_id):])
+    return data
@@ -67,19 +67,44 @@ class Config:
     RECIPES_DB_FILE = CONTEXTUALIZATION_DIR + '/recipes_ansible.db'
     MAX_CONTEXTUALIZATION_TIME = 7200
     MAX_SIMULTANEOUS_LAUNCHES = 1
+    MAX_SIMULTANEOUS_DEPLOYMENTS = 5
+    OPERATIONS_RETENTION = 3600
+    IDEMPOTENCY_KEY_TTL = 86400
+    IDEMPOTENCY_LEASE = 300
     DATA_DB = '/etc/im/inf.dat'
     XMLRCP_SSL = False
     XMLRCP_SSL_KEYFILE = "/etc/im/pki/server-key.pem"
     XMLRCP_SSL_CERTFILE = "/etc/im/pki/server-cert.pem"
     XMLRCP_SSL_CA_CERTS = "/etc/im/pki/ca-chain.pem"
+    XMLRCP_MAX_THREADS = 0
+    XMLRCP_MAX_QUEUED = 100
+    MAX_SIMULTANEOUS_REQUESTS = 30
+    MAX_USER_LONG_OPERATIONS = 5
+    REQUEST_USER_WEIGHTS = []
+    ADMISSION_MAX_ACTIVE = []
+    ADMISSION_MAX_QUEUED = []
+    ADMISSION_QUEUE_TIMEOUT = 60
+    ADMISSION_RETRY_AFTER = 30
     REST_SSL = False
     REST_SSL_KEYFILE = "/etc/im/pki/server-key.pem"
     REST_SSL_CERTFILE = "/etc/im/pki/server-cert.pem"
     REST_SSL_CA_CERTS = "/etc/im/pki/ca-chain.pem"
+    REST_THREADS = 10
+    REST_QUEUE_SIZE = 32
+    REST_SOCKET_TIMEOUT = 10
+    REST_KEEP_ALIVE = True
+    REST_COMPRESSION = True
+    REST_COMPRESSION_MIN_SIZE = 1024
+    EVENTS_MAX_WAIT = 60
+    EVENTS_BUFFER_SIZE = 100
+    EVENTS_RETENTION = 300
+    EVENTS_MAX_WAITING = 0
     GET_GANGLIA_INFO = False
     GANGLIA_INFO_UPDATE_FREQUENCY = 30
     PLAYBOOK_RETRIES = 1
     VM_INFO_UPDATE_FREQUENCY = 10
+    INF_STATE_THREADS = 10
+    INF_STATE_TIMEOUT = 20
     # This value must be always higher than VM_INFO_UPDATE_FREQUENCY
     VM_INFO_UPDATE_ERROR_GRACE_PERIOD = 120
     REMOTE_CONF_DIR = "/tmp/.im"
@@ -91,6 +116,27 @@ class Config:
     UPDATE_CTXT_LOG_INTERVAL = 20
     ANSIBLE_INSTALL_TIMEOUT = 900
     INF_CACHE_TIME = None
+    INF_CACHE_MAX_ENTRIES = 0
+    INF_CACHE_MAX_BYTES = 0
+    INF_WARMUP = False
+    DB_FETCH_SIZE = 100
+    DB_POOL_MIN_SIZE = 1
+    DB_POOL_MAX_SIZE = 10
+    DB_POOL_IDLE_TIMEOUT = 300
+    DB_POOL_CHECK_INTERVAL = 30
+    DB_POOL_TIMEOUT = 30
+    DB_WRITE_BEHIND = False
+    DB_WRITE_BEHIND_DELAY = 1
+    DB_WRITE_BEHIND_RETRIES = 3
+    DB_JOURNAL_SYNC = True
+    DB_JOURNAL_SNAPSHOT_SIZE = 67108864
+    DATA_DB_CODEC = 'none'
+    CTXT_LOG_TAIL_SIZE = 65536
+    INF_ARCHIVE_DAYS = 0
+    INF_PURGE_DAYS = 0
+    INF_ARCHIVE_INTERVAL = 3600
+    INF_ARCHIVE_BATCH_SIZE = 100
+    RADL_CACHE_MAX_SIZE = 10485760
 
 config = ConfigParser.ConfigParser()
 config.read([Config.IM_PATH + '/../im.cfg', Config.IM_PATH +
@@ -0,0 +1,279 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Contextualization logs stored in chunks in the DB"""
+import threading
+
+from IM import codec
+from IM.config import Config
+from IM.db import DataBase
+
+
+class ContextualizationLog(object):
+    """
+    Append-only contextualization log of an infrastructure or a VM (it can also be reset or truncated).
+
+    The content is stored in the ctxt_log table of the DB in chunks indexed by their
+    position in the log, so each save only writes the data appended since the previous
+    one. In memory only the data not saved yet and the last CTXT_LOG_TAIL_SIZE bytes
+    are maintained, the rest is read from the DB when it is requested.
+    The log is identified in the DB by the infrastructure ID and the VM ID (-1 for the
+    log of the infrastructure), that must be specified in the functions that access the DB.
+
+    Arguments:
+       - data(str): Initial content of the log (not saved yet).
+       - stored(int): Size of the log already stored in the DB (None if it is unknown).
+    """
+
+    CHUNK_SIZE = 65536
+    """Maximum size of the chunks written to the DB."""
+
+    INF_LOG_ID = -1
+    """VM ID used to store the log of the infrastructure."""
+
+    def __init__(self, data="", stored=0):
+        self._lock = threading.Lock()
+        self.generation = 0
+        """Counter of the resets of the log."""
+        self.changes = 0
+        """Counter of the modifications of the log (to detect changes without reading it)."""
+        self.reset_pending = False
+        """Flag to specify that the log has been reset and the stored chunks must be deleted."""
+        self.truncate_pending = None
+        """Position from which the stored chunks must be deleted as the log has been truncated."""
+        self.stored = stored
+        """Size of the log stored in the DB."""
+        self.tail = data
+        """Last part of the log maintained in memory (it includes all the data not saved)."""
+        self.unsaved = len(data)
+        """Size of the data at the end of the tail not saved yet."""
+
+    @staticmethod
+    def create_table(db):
+        """ Create the table to store the logs """
+        if not db.table_exists("ctxt_log"):
+            db.execute("CREATE TABLE ctxt_log(inf_id VARCHAR(255), vm_id INTEGER, pos INTEGER, size INTEGER,"
+                       " data LONGBLOB, PRIMARY KEY (inf_id, vm_id, pos))")
+
+    def _trim(self):
+        """ Remove from the tail the saved data over CTXT_LOG_TAIL_SIZE. Must be called with the lock acquired """
+        max_size = max(Config.CTXT_LOG_TAIL_SIZE, self.unsaved)
+        if len(self.tail) > max_size:
+            self.tail = self.tail[len(self.tail) - max_size:]
+
+    def append(self, data):
+        """ Add some data at the end of the log """
+        if data:
+            with self._lock:
+                self.tail += data
+                self.unsaved += len(data)
+                self.changes += 1
+                self._trim()
+
+    def reset(self, data=""):
+        """ Remove the content of the log, setting a new one """
+        with self._lock:
+            self.generation += 1
+            self.changes += 1
+            self.reset_pending = True
+            self.truncate_pending = None
+            self.stored = 0
+            self.tail = data
+            self.unsaved = len(data)
+
+    def truncate(self, inf_id, vm_id, size):
+        """
+        Remove the end of the log from the position size. Only the stored chunks after
+        that position are deleted (and the chunk that contains it is rewritten).
+        """
+        if size >= self.size(inf_id, vm_id):
+            return
+        with self._lock:
+            if size >= self.stored:
+                # Only the data not saved is removed
+                removed = self.stored + self.unsaved - size
+                self.tail = self.tail[:len(self.tail) - removed]
+                self.unsaved -= removed
+                self.changes += 1
+                return
+
+        db = DataBase(Config.DATA_DB)
+        if not db.connect():
+            raise Exception("Error connecting with the database.")
+        try:
+            res = db.select("select min(pos) from ctxt_log where inf_id = %s and vm_id = %s and pos + size > %s",
+                            (inf_id, vm_id, size))
+        finally:
+            db.close()
+        pos = int(res[0][0]) if res and res[0][0] is not None else size
+        data = self.read(inf_id, vm_id, pos, size - pos)
+        with self._lock:
+            self.generation += 1
+            self.changes += 1
+            if not self.reset_pending:
+                self.truncate_pending = pos
+            self.stored = pos
+            self.tail = data
+            self.unsaved = len(data)
+
+    def _get_stored(self, db, inf_id, vm_id):
+        """ Get the size of the log stored in the DB, reading it if it is not known """
+        if self.stored is None:
+            res = db.select("select max(pos + size) from ctxt_log where inf_id = %s and vm_id = %s",
+                            (inf_id, vm_id))
+            with self._lock:
+                if self.stored is None:
+                    self.stored = int(res[0][0]) if res and res[0][0] is not None else 0
+        return self.stored
+
+    def size(self, inf_id, vm_id):
+        """ Get the size of the log """
+        if self.stored is None:
+            db = DataBase(Config.DATA_DB)
+            if not db.connect():
+                raise Exception("Error connecting with the database.")
+            try:
+                self._get_stored(db, inf_id, vm_id)
+            finally:
+                db.close()
+        with self._lock:
+            return self.stored + self.unsaved
+
+    def read(self, inf_id, vm_id, offset=0, limit=None):
+        """
+        Get a part of the log
+
+        Arguments:
+           - inf_id(str): ID of the infrastructure.
+           - vm_id(int): ID of the VM (INF_LOG_ID for the log of the infrastructure).
+           - offset(int): Position of the log to start reading. Negative values are relative
+             to the end of the log.
+           - limit(int): Maximum number of bytes to read (None to read until the end).
+
+        Returns: a str with the requested data.
+        """
+        # Get the stored size from the DB if it is not known
+        self.size(inf_id, vm_id)
+        with self._lock:
+            size = self.stored + self.unsaved
+            tail = self.tail
+        if offset < 0:
+            offset = max(0, size + offset)
+        end = size if limit is None else min(size, offset + max(0, limit))
+        if offset >= end:
+            return ""
+
+        tail_start = size - len(tail)
+        if offset >= tail_start:
+            return tail[offset - tail_start:end - tail_start]
+
+        # Read the beginning from the DB
+        db = DataBase(Config.DATA_DB)
+        if not db.connect():
+            raise Exception("Error connecting with the database.")
+        try:
+            db_end = min(end, tail_start)
+            res = db.select("select pos, data from ctxt_log where inf_id = %s and vm_id = %s"
+                            " and pos < %s and pos + size > %s order by pos", (inf_id, vm_id, db_end, offset))
+        finally:
+            db.close()
+        data = "".join(codec.decode(chunk) for _, chunk in res)
+        start = res[0][0] if res else offset
+        data = data[offset - start:db_end - start]
+        if end > tail_start:
+            data += tail[:end - tail_start]
+        return data
+
+    def get_save_sentences(self, db, inf_id, vm_id, data_codec):
+        """
+        Get the SQL sentences to store the data of the log not saved yet.
+        When they have been executed :py:meth:`set_saved` must be called with the returned state.
+
+        Arguments:
+           - db(:py:class:`DataBase`): Connected DB.
+           - inf_id(str): ID of the infrastructure.
+           - vm_id(int): ID of the VM (INF_LOG_ID for the log of the infrastructure).
+           - data_codec(:py:class:`codec.BlobCodec`): Codec to encode the chunks.
+
+        Returns: a tuple (list of SQL sentences, state of the saved data).
+        """
+        with self._lock:
+            if not self.unsaved and not self.reset_pending and self.truncate_pending is None:
+                return [], None
+        self._get_stored(db, inf_id, vm_id)
+        with self._lock:
+            generation = self.generation
+            reset = self.reset_pending
+            truncate = self.truncate_pending
+            pos = self.stored
+            data = self.tail[len(self.tail) - self.unsaved:] if self.unsaved else ""
+
+        sentences = []
+        if reset:
+            sentences.append(("delete from ctxt_log where inf_id = %s and vm_id = %s", (inf_id, vm_id)))
+        elif truncate is not None:
+            sentences.append(("delete from ctxt_log where inf_id = %s and vm_id = %s and pos >= %s",
+                              (inf_id, vm_id, truncate)))
+        for i in range(0, len(data), self.CHUNK_SIZE):
+            chunk = data[i:i + self.CHUNK_SIZE]
+            sentences.append(("replace into ctxt_log (inf_id, vm_id, pos, size, data) values (%s, %s, %s, %s, %s)",
+                              (inf_id, vm_id, pos + i, len(chunk), db.blob(data_codec.encode(chunk)))))
+        return sentences, (generation, pos + len(data))
+
+    def set_saved(self, state):
+        """ Mark as saved the data returned by :py:meth:`get_save_sentences` """
+        if state is None:
+            return
+        generation, stored = state
+        with self._lock:
+            # Ignore it if the log has been reset meanwhile
+            if generation == self.generation:
+                self.reset_pending = False
+                self.truncate_pending = None
+                if stored > self.stored:
+                    self.unsaved -= stored - self.stored
+                    self.stored = stored
+                self._trim()
+
+
+def read_segments(segments, offset=0, limit=None):
+    """
+    Read a part of a message composed by several segments, reading only the needed ones.
+
+    Arguments:
+       - segments(list of tuples (int, function)): size of each segment and function to read
+         a part of it, receiving the offset and the limit.
+       - offset(int): Position of the message to start reading. Negative values are relative
+         to the end of the message.
+       - limit(int): Maximum number of bytes to read (None to read until the end).
+
+    Returns: a str with the requested data.
+    """
+    size = sum(segment_size for segment_size, _ in segments)
+    if offset < 0:
+        offset = max(0, size + offset)
+    end = size if limit is None else min(size, offset + max(0, limit))
+
+    res = ""
+    pos = 0
+    for segment_size, read in segments:
+        if pos >= end:
+            break
+        if pos + segment_size > offset:
+            start = max(offset, pos) - pos
+            res += read(start, min(end, pos + segment_size) - pos - start)
+        pos += segment_size
+    return res
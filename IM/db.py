@@ -15,8 +15,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Class to manage DB operations"""
+import fcntl
+import logging
+import random
+import re
+import threading
 import time
+from contextlib import contextmanager
+from urlparse import parse_qsl
 
+from IM.config import Config
 from IM.uriparse import uriparse
 
 try:
@@ -36,39 +44,265 @@ if not SQLITE_AVAILABLE:
 
 try:
     import MySQLdb as mdb
+    import MySQLdb.cursors
     MYSQL_AVAILABLE = True
 except:
     MYSQL_AVAILABLE = False
 
 
+class ConnectionPool:
+    """
+    Thread-safe pool of connections to a DB
+
+    Arguments:
+        - db_url(str): URL of the DB to connect.
+        - min_size(int): Number of connections to maintain open although they are idle.
+        - max_size(int): Maximum number of connections open at the same time.
+        - idle_timeout(int): Time (in secs) a connection over min_size can be idle before being closed.
+        - check_interval(int): Time (in secs) a connection can be idle before checking it again.
+        - timeout(int): Time (in secs) to wait for a free connection.
+    """
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    def __init__(self, db_url, min_size=0, max_size=10, idle_timeout=300, check_interval=30, timeout=30):
+        self.db_url = db_url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.db_type = None
+        """Type of the DB (One of :py:attr:`DataBase.DB_TYPES`)."""
+        self._idle = []
+        """List of tuples (connection, time of the last use) of the free connections."""
+        self._size = 0
+        """Number of connections currently open (free or in use)."""
+        self._cond = threading.Condition(threading.Lock())
+
+        try:
+            for _ in range(self.min_size):
+                connection = self._open()
+                if connection is None:
+                    break
+                self._idle.append((connection, time.time()))
+                self._size += 1
+        except Exception:
+            ConnectionPool.logger.exception("Error opening the initial connections to the DB.")
+
+    def _open(self):
+        """ Open a new connection to the DB, returns None if the DB type is not available """
+        db = DataBase(self.db_url)
+        if db._connect(pooled=True):
+            self.db_type = db.db_type
+            return db.connection
+        return None
+
+    def _check(self, connection):
+        """ Check that the connection is still usable """
+        try:
+            if self.db_type == DataBase.MYSQL:
+                connection.ping()
+            else:
+                connection.cursor().execute("select 1")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self, now):
+        """ Get the list of idle connections to close. Must be called with the lock acquired """
+        to_close = []
+        while self._size > self.min_size and self._idle and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.pop(0)
+            self._size -= 1
+            to_close.append(connection)
+        return to_close
+
+    def acquire(self):
+        """
+        Get a connection from the pool, opening a new one if needed.
+
+        Returns: the connection or None in case of error.
+        """
+        connection = last_use = None
+        new_slot = False
+        to_close = []
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                to_close.extend(self._evict_idle(now))
+                if self._idle:
+                    # get the most recently used connection
+                    connection, last_use = self._idle.pop()
+                    break
+                elif self._size < self.max_size:
+                    self._size += 1
+                    new_slot = True
+                    break
+                elif now >= deadline:
+                    ConnectionPool.logger.error("Timeout waiting for a free connection to the DB.")
+                    break
+                self._cond.wait(deadline - now)
+
+        for elem in to_close:
+            self._close(elem)
+
+        if connection is not None and time.time() - last_use > self.check_interval:
+            if not self._check(connection):
+                ConnectionPool.logger.warn("DB connection not valid. Opening a new one.")
+                self._close(connection)
+                connection = None
+                new_slot = True
+
+        if new_slot:
+            try:
+                connection = self._open()
+            except Exception:
+                self._release_slot()
+                raise
+            if connection is None:
+                self._release_slot()
+
+        return connection
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, connection, discard=False):
+        """
+        Return a connection to the pool.
+
+        Arguments:
+           - connection: The connection to return.
+           - discard(bool): Close the connection instead of reusing it.
+        """
+        if not discard:
+            try:
+                # Finish any pending transaction to avoid holding locks or old snapshots
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        if discard:
+            self._close(connection)
+            self._release_slot()
+        else:
+            with self._cond:
+                self._idle.append((connection, time.time()))
+                to_close = self._evict_idle(time.time())
+                self._cond.notify()
+            for elem in to_close:
+                self._close(elem)
+
+    def close(self):
+        """ Close all the idle connections of the pool """
+        with self._cond:
+            to_close = [connection for connection, _ in self._idle]
+            self._size -= len(to_close)
+            self._idle = []
+        for connection in to_close:
+            self._close(connection)
+
+    def stats(self):
+        """ Get a dict with the number of open and idle connections """
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle)}
+
+
 # Class to manage DB operations
 class DataBase:
     """Class to manage DB operations"""
 
     db_available = SQLITE_AVAILABLE or MYSQL_AVAILABLE
     RETRY_SLEEP = 2
+    """Maximum time (in secs) to wait before retrying an operation on a locked DB."""
+    RETRY_BASE_SLEEP = 0.05
+    """Maximum time (in secs) to wait before the first retry, doubled in each retry."""
     MAX_RETRIES = 15
+    SQLITE_OPTIONS = {'journal_mode': None, 'busy_timeout': '5000', 'synchronous': None, 'cache_size': None}
+    """
+    Default values of the options of the SQLite DBs (they can be set in the query string of the URL).
+    None means not to change the current value of the DB (or the SQLite default one).
+    """
+    SQLITE_VALUES = {'journal_mode': ['delete', 'truncate', 'persist', 'memory', 'wal', 'off'],
+                     'synchronous': ['off', 'normal', 'full', 'extra', '0', '1', '2', '3']}
+    """Valid values of the SQLite options (the rest are integers)."""
     MYSQL = "MySQL"
     SQLITE = "SQLite"
     DB_TYPES = [MYSQL, SQLITE]
 
+    pools = {}
+    """Map from DB URL to :py:class:`ConnectionPool`."""
+    _pools_lock = threading.Lock()
+
     def __init__(self, db_url):
         self.db_url = db_url
         self.connection = None
         self.db_type = None
+        self._pool = None
+        self._discard = False
+        self._transaction = False
+
+    @staticmethod
+    def get_pool(db_url):
+        """ Get the connection pool of the specified DB URL, creating it if needed """
+        with DataBase._pools_lock:
+            if db_url not in DataBase.pools:
+                DataBase.pools[db_url] = ConnectionPool(db_url, Config.DB_POOL_MIN_SIZE, Config.DB_POOL_MAX_SIZE,
+                                                        Config.DB_POOL_IDLE_TIMEOUT, Config.DB_POOL_CHECK_INTERVAL,
+                                                        Config.DB_POOL_TIMEOUT)
+            return DataBase.pools[db_url]
+
+    @staticmethod
+    def close_pools():
+        """ Close all the idle connections of all the pools """
+        with DataBase._pools_lock:
+            pools = DataBase.pools.values()
+            DataBase.pools = {}
+        for pool in pools:
+            pool.close()
 
     def connect(self):
-        """ Function to connect to the DB
+        """ Function to connect to the DB.
+            If DB_POOL_MAX_SIZE > 0 the connection is obtained from a pool.
 
             Returns: True if the connection is established correctly
                      of False in case of errors.
         """
+        if Config.DB_POOL_MAX_SIZE > 0:
+            pool = DataBase.get_pool(self.db_url)
+            connection = pool.acquire()
+            if connection is None:
+                return False
+            self.connection = connection
+            self.db_type = pool.db_type
+            self._pool = pool
+            self._discard = False
+            return True
+        else:
+            return self._connect()
+
+    def _connect(self, pooled=False):
+        """ Open a new connection to the DB """
         uri = uriparse(self.db_url)
         protocol = uri[0]
         if protocol == "mysql":
             return self._connect_mysql(uri[1], uri[2][1:])
         elif protocol == "file" or protocol == "sqlite" or not protocol:  # sqlite is the default one
-            return self._connect_sqlite(uri[2])
+            return self._connect_sqlite(uri[2], pooled, uri[4])
+        elif protocol == "journal":
+            return self._connect_journal(uri[2])
 
         return False
 
@@ -104,15 +338,71 @@ class DataBase:
         else:
             return False
 
-    def _connect_sqlite(self, db_filename):
+    @staticmethod
+    def _get_sqlite_options(query):
+        """ Get the SQLite options (:py:attr:`SQLITE_OPTIONS`) set in the query string of the URL """
+        options = dict(DataBase.SQLITE_OPTIONS)
+        for name, value in parse_qsl(query or ""):
+            name = name.lower()
+            value = value.lower()
+            if name not in options:
+                raise ValueError("Unknown SQLite option: %s" % name)
+            if name in DataBase.SQLITE_VALUES:
+                if value not in DataBase.SQLITE_VALUES[name]:
+                    raise ValueError("Incorrect value of the SQLite option %s: %s" % (name, value))
+            else:
+                try:
+                    int(value)
+                except ValueError:
+                    raise ValueError("Incorrect value of the SQLite option %s: %s" % (name, value))
+            options[name] = value
+        return options
+
+    def _connect_sqlite(self, db_filename, pooled=False, query=""):
         if SQLITE_AVAILABLE:
-            self.connection = sqlite.connect(db_filename)
+            options = self._get_sqlite_options(query)
+            if SQLITE3_AVAILABLE:
+                timeout = int(options['busy_timeout']) / 1000.0
+                # pooled connections may be used by different threads (never at the same time)
+                self.connection = sqlite.connect(db_filename, timeout=timeout, check_same_thread=not pooled)
+            else:
+                self.connection = sqlite.connect(db_filename)
+            self.db_type = DataBase.SQLITE
+
+            cursor = self.connection.cursor()
+            if options['journal_mode'] is not None:
+                # the journal mode is stored in the DB, change it only if needed
+                cursor.execute("PRAGMA journal_mode")
+                if str(cursor.fetchone()[0]).lower() != options['journal_mode']:
+                    cursor.execute("PRAGMA journal_mode = %s" % options['journal_mode'])
+                    cursor.fetchall()
+            cursor.execute("PRAGMA busy_timeout = %s" % options['busy_timeout'])
+            if options['synchronous'] is not None:
+                cursor.execute("PRAGMA synchronous = %s" % options['synchronous'])
+            if options['cache_size'] is not None:
+                cursor.execute("PRAGMA cache_size = %s" % options['cache_size'])
+            cursor.close()
+            return True
+        else:
+            return False
+
+    def _connect_journal(self, path):
+        if SQLITE3_AVAILABLE:
+            from IM.journal import JournalStore, JournalConnection
+            # open the store to recover the data (and to fail here in case of error)
+            JournalStore.get(path)
+            self.connection = JournalConnection(path)
+            # the journal store uses the SQL dialect of SQLite
             self.db_type = DataBase.SQLITE
             return True
         else:
             return False
 
-    def _execute_retry(self, sql, args, fetch=False):
+    def _get_retry_sleep(self, retries):
+        """ Get the time to wait before a retry: exponential backoff with full jitter """
+        return random.uniform(0, min(self.RETRY_SLEEP, self.RETRY_BASE_SLEEP * 2 ** retries))
+
+    def _execute_retry(self, sql, args, fetch=False, sentences=None):
         """ Function to execute a SQL function, retrying in case of locked DB
 
             Arguments:
@@ -120,6 +410,8 @@ class DataBase:
             - args: A List of arguments to substitute in the SQL sentence
             - fetch: If the function must fetch the results.
                     (Optional, default False)
+            - sentences: A list of tuples (sql, args) to execute in a single
+                    transaction instead of sql and args. (Optional, default None)
 
             Returns: True if fetch is False and the operation is performed
                      correctly or a list with the "Fetch" of the results
@@ -128,38 +420,56 @@ class DataBase:
         if self.connection is None:
             raise Exception("DataBase object not connected")
         else:
+            if sentences is None:
+                sentences = [(sql, args)]
             retries_cont = 0
             while retries_cont < self.MAX_RETRIES:
                 try:
                     cursor = self.connection.cursor()
-                    if args is not None:
-                        if self.db_type == DataBase.SQLITE:
-                            new_sql = sql.replace("%s", "?").replace("now()", "date('now')")
-                        elif self.db_type == DataBase.MYSQL:
-                            new_sql = sql.replace("?", "%s")
-                        cursor.execute(new_sql, args)
-                    else:
-                        cursor.execute(sql)
+                    for sql, args in sentences:
+                        if args is not None:
+                            if self.db_type == DataBase.SQLITE:
+                                new_sql = sql.replace("%s", "?").replace("now()", "datetime('now')")
+                            elif self.db_type == DataBase.MYSQL:
+                                new_sql = sql.replace("?", "%s")
+                            cursor.execute(new_sql, args)
+                        else:
+                            cursor.execute(sql)
 
                     if fetch:
                         res = cursor.fetchall()
                     else:
-                        self.connection.commit()
+                        if not self._transaction:
+                            self.connection.commit()
                         res = True
                     return res
                 # If the operational error is db lock, retry
                 except sqlite.OperationalError, ex:
-                    if str(ex).lower() == 'database is locked':
+                    # inside a transaction the rollback would undo the previous sentences too
+                    if str(ex).lower() == 'database is locked' and not self._transaction:
                         retries_cont += 1
-                        # release the connection
-                        self.close()
-                        time.sleep(self.RETRY_SLEEP)
-                        # and get it again
-                        self.connect()
+                        if retries_cont >= self.MAX_RETRIES:
+                            raise ex
+                        # undo the sentences executed and retry the transaction
+                        try:
+                            self.connection.rollback()
+                        except Exception:
+                            pass
+                        time.sleep(self._get_retry_sleep(retries_cont))
                     else:
                         raise ex
-                except sqlite.IntegrityError, ex:
-                    raise IntegrityError()
+                except Exception, ex:
+                    if isinstance(ex, sqlite.IntegrityError) or (MYSQL_AVAILABLE and
+                                                                  isinstance(ex, mdb.IntegrityError)):
+                        # undo the transaction to release the locks
+                        try:
+                            self.connection.rollback()
+                        except Exception:
+                            pass
+                        raise IntegrityError()
+                    # Do not return this connection to the pool
+                    self._discard = True
+                    raise
 
     def execute(self, sql, args=None):
         """ Executes a SQL sentence without returning results
@@ -173,6 +483,55 @@ class DataBase:
         """
         return self._execute_retry(sql, args)
 
+    def execute_batch(self, sentences):
+        """ Executes a list of SQL sentences in a single transaction
+
+            Arguments:
+            - sentences: A list of tuples (sql, args) with the SQL sentences
+                    and the list of arguments (or None) of each one.
+
+            Returns: True if the operation is performed correctly
+        """
+        if not sentences:
+            return True
+        return self._execute_retry(None, None, sentences=sentences)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager to execute all the sentences of the block in a single transaction,
+        committed at the end of the block or rolled back if it raises an exception.
+        In SQLite (and the journal) it also includes the changes of the schema, but MySQL
+        commits them implicitly.
+        """
+        if self.connection is None:
+            raise Exception("DataBase object not connected")
+        # the sqlite3 module commits before each change of the schema: begin the transaction explicitly
+        isolation_level = getattr(self.connection, "isolation_level", False)
+        if isolation_level is not False:
+            self.connection.isolation_level = None
+            self.connection.cursor().execute("BEGIN IMMEDIATE")
+        self._transaction = True
+        try:
+            yield
+            self.connection.commit()
+        except:
+            try:
+                self.connection.rollback()
+            except Exception:
+                self._discard = True
+            raise
+        finally:
+            self._transaction = False
+            if isolation_level is not False:
+                self.connection.isolation_level = isolation_level
+
+    def blob(self, data):
+        """ Get the value to use as argument to store binary data (str) in a BLOB column """
+        if self.db_type == DataBase.SQLITE and SQLITE3_AVAILABLE:
+            return sqlite.Binary(data)
+        return data
+
     def select(self, sql, args=None):
         """ Executes a SQL sentence that returns results
 
@@ -185,10 +544,59 @@ class DataBase:
         """
         return self._execute_retry(sql, args, fetch=True)
 
+    def select_iter(self, sql, args=None, chunk_size=100):
+        """ Executes a SQL sentence and returns an iterator over the results,
+            fetching them in chunks (using a server side cursor in case of MySQL),
+            to avoid loading all the results in memory.
+            The connection must not be used until the iteration has finished.
+
+            Arguments:
+            - sql: The SQL sentence
+            - args: A List of arguments to substitute in the SQL sentence
+                    (Optional, default None)
+            - chunk_size: Number of rows fetched in each chunk (Optional, default 100)
+
+            Returns: An iterator over the rows of the results
+        """
+        if self.connection is None:
+            raise Exception("DataBase object not connected")
+
+        if self.db_type == DataBase.MYSQL:
+            cursor = self.connection.cursor(mdb.cursors.SSCursor)
+        else:
+            cursor = self.connection.cursor()
+        try:
+            if args is not None:
+                if self.db_type == DataBase.SQLITE:
+                    sql = sql.replace("%s", "?")
+                cursor.execute(sql, args)
+            else:
+                cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        except Exception:
+            # Do not return this connection to the pool
+            self._discard = True
+            raise
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                self._discard = True
+
     def close(self):
-        """ Closes the DB connection """
+        """ Closes the DB connection (or returns it to the pool) """
         if self.connection is None:
             return False
+        elif self._pool:
+            self._pool.release(self.connection, self._discard)
+            self.connection = None
+            self._pool = None
+            return True
         else:
             try:
                 self.connection.close()
@@ -220,6 +628,130 @@ class DataBase:
         else:
             return True
 
+    def column_exists(self, table_name, column_name):
+        """ Checks if a column of a table exists in the DB """
+        if self.db_type == DataBase.SQLITE:
+            res = self.select("select sql from sqlite_master where type = 'table' and name = %s", (table_name,))
+            return bool(res) and re.search(r"[(,\s]%s\s" % re.escape(column_name), res[0][0], re.I) is not None
+        elif self.db_type == DataBase.MYSQL:
+            res = self.select("select * from information_schema.columns where table_schema = %s and"
+                              " table_name = %s and column_name = %s",
+                              (uriparse(self.db_url)[2][1:], table_name, column_name))
+            return len(res) > 0
+        return False
+
+    def index_exists(self, table_name, index_name):
+        """ Checks if an index of a table exists in the DB """
+        if self.db_type == DataBase.SQLITE:
+            res = self.select("select name from sqlite_master where type = 'index' and tbl_name = %s and name = %s",
+                              (table_name, index_name))
+        elif self.db_type == DataBase.MYSQL:
+            res = self.select("select * from information_schema.statistics where table_schema = %s and"
+                              " table_name = %s and index_name = %s",
+                              (uriparse(self.db_url)[2][1:], table_name, index_name))
+        else:
+            return False
+        return len(res) > 0
+
+
+class SchemaManager:
+    """
+    Class to create and upgrade the schema of a DB, storing the current version in a table
+
+    Each migration is applied in a transaction together with the insertion of its version,
+    so a failure does not leave the version out of step with the schema. As MySQL commits
+    the changes of the schema implicitly, the migrations must also be able to run again
+    over a partially upgraded DB (checking the tables, columns and indexes that exist).
+
+    Arguments:
+        - db_url(str): URL of the DB.
+        - migrations(list of tuples (int, function)): Sorted list with the schema versions and the
+          functions to upgrade the DB to each version. The functions receive a connected
+          :py:class:`DataBase` object.
+    """
+
+    VERSION_TABLE = "schema_version"
+    """Name of the table with the schema versions applied."""
+
+    LOCK_NAME = "im_schema_upgrade"
+    """Name of the lock that serializes the upgrades of the IM instances sharing the DB."""
+
+    LOCK_TIMEOUT = 300
+    """Maximum time (in secs) to wait for the upgrade of other IM instance."""
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    def __init__(self, db_url, migrations):
+        self.db_url = db_url
+        self.migrations = migrations
+
+    def get_version(self, db):
+        """ Get the current version of the schema of the DB (0 if it is empty) """
+        if not db.table_exists(SchemaManager.VERSION_TABLE):
+            return 0
+        res = db.select("select max(version) from " + SchemaManager.VERSION_TABLE)
+        if res and res[0][0] is not None:
+            return int(res[0][0])
+        return 0
+
+    @contextmanager
+    def _lock(self, db):
+        """
+        Hold an exclusive lock to upgrade the schema, shared by all the IM instances using the DB:
+        a named lock of MySQL or a lock of a file next to the SQLite DB (the journal DBs are only
+        used by one IM).
+        """
+        uri = uriparse(self.db_url)
+        if db.db_type == DataBase.MYSQL:
+            res = db.select("select GET_LOCK(%s, %s)", (SchemaManager.LOCK_NAME, SchemaManager.LOCK_TIMEOUT))
+            if not res or res[0][0] != 1:
+                raise Exception("Timeout waiting for the upgrade of the DB schema of other IM instance.")
+            try:
+                yield
+            finally:
+                db.select("select RELEASE_LOCK(%s)", (SchemaManager.LOCK_NAME,))
+        elif uri[0] in ["file", "sqlite", ""] and uri[2] != ":memory:":
+            lock_file = open(uri[2] + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+            finally:
+                lock_file.close()
+        else:
+            yield
+
+    def upgrade(self):
+        """
+        Apply the pending migrations to the DB. The IM instances that start at the same
+        time wait for the upgrade of the first one, and then they find the DB upgraded.
+
+        Returns: The version of the schema after the upgrade or None in case of connection error.
+        """
+        db = DataBase(self.db_url)
+        if not db.connect():
+            return None
+
+        try:
+            with self._lock(db):
+                if not db.table_exists(SchemaManager.VERSION_TABLE):
+                    db.execute("CREATE TABLE " + SchemaManager.VERSION_TABLE +
+                               "(version INTEGER PRIMARY KEY, date TIMESTAMP)")
+                # read the version with the lock held (other instance may have upgraded it)
+                current = self.get_version(db)
+                for version, migration in self.migrations:
+                    if version > current:
+                        SchemaManager.logger.info("Upgrading DB schema to version %d." % version)
+                        with db.transaction():
+                            migration(db)
+                            db.execute("insert into " + SchemaManager.VERSION_TABLE +
+                                       " (version, date) values (%s, now())", (version,))
+                        current = version
+                return current
+        finally:
+            db.close()
+
+
 try:
     class IntegrityError(sqlite.IntegrityError):
         """ Class to return IntegrityError independently of the DB used"""
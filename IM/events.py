@@ -0,0 +1,168 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import deque
+from itertools import count
+
+from IM.admission import ServiceUnavailableException
+from IM.config import Config
+
+
+class EventBus:
+    """
+    Bus of the events of the infrastructures (changes of the VM states, contextualization
+    messages, ...), so the clients can wait for them instead of polling the IM.
+
+    The events are only stored for the infrastructures watched by some client (the ones
+    with a call to :py:meth:`watch` or :py:meth:`get_events` in the last retention secs), in a buffer of the
+    last buffer_size events of each one. Publishing an event of other infrastructure costs
+    nothing more than a dict lookup.
+
+    Each event is a dict with an id, a type and the data of the event. The ids are increasing
+    for all the infrastructures, and start with the time of the creation of the bus (in msecs)
+    so that they also increase after a restart of the IM.
+
+    Each client waiting holds the thread of the API that serves it, so the number of clients
+    waiting at the same time (for all the infrastructures) is limited to max_waiting.
+
+    Arguments:
+       - buffer_size(int): Maximum number of events stored of each infrastructure.
+       - retention(int): Time (in secs) to keep the events of an infrastructure without clients.
+       - max_waiting(int): Maximum number of clients waiting at the same time (0 means unlimited).
+    """
+
+    RESET = "reset"
+    """Type of the event returned when some of the events requested have been lost."""
+
+    def __init__(self, buffer_size=100, retention=300, max_waiting=0):
+        self.buffer_size = buffer_size
+        self.retention = retention
+        self.max_waiting = max_waiting
+        self._waiting = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._ids = count(int(time.time() * 1000))
+        self.last_id = next(self._ids)
+        """Id of the last event published."""
+        self._watched = {}
+        self._last_cleanup = time.time()
+
+    def publish(self, inf_id, event_type, data=None):
+        """ Publish an event of an infrastructure and wake up the clients waiting for it """
+        with self._cond:
+            self.last_id = next(self._ids)
+            watched = self._watched.get(inf_id)
+            if watched is not None:
+                events = watched['events']
+                if len(events) == self.buffer_size:
+                    watched['lost'] = events[0]['id']
+                events.append({'id': self.last_id, 'type': event_type, 'data': data})
+                self._cond.notify_all()
+
+    def _cleanup(self, now):
+        """ Stop storing the events of the infrastructures not watched. Must be called with the lock acquired """
+        if now - self._last_cleanup > self.retention:
+            self._last_cleanup = now
+            for inf_id, watched in self._watched.items():
+                if not watched['waiting'] and now - watched['last_access'] > self.retention:
+                    del self._watched[inf_id]
+
+    def _watch(self, inf_id):
+        """ Get the events stored of an infrastructure, starting to store them if needed """
+        now = time.time()
+        self._cleanup(now)
+        watched = self._watched.get(inf_id)
+        if watched is None:
+            # the previous events have not been stored
+            watched = {'events': deque(maxlen=self.buffer_size), 'lost': self.last_id, 'waiting': 0}
+            self._watched[inf_id] = watched
+        watched['last_access'] = now
+        return watched
+
+    def watch(self, inf_id):
+        """
+        Start storing the events of an infrastructure (if they were not already stored).
+        Returns the id of the last event published, to get the next ones with :py:meth:`get_events`.
+        """
+        with self._cond:
+            self._watch(inf_id)
+            return self.last_id
+
+    def get_events(self, inf_id, after, timeout=0):
+        """
+        Get the events of an infrastructure newer than the id after, waiting up to
+        timeout secs if there are none. If some of them have been lost (they were not
+        stored or they are not in the buffer anymore) the list starts with an event of
+        type RESET, and the client must get the state of the infrastructure again.
+        If there are max_waiting clients waiting it raises a ServiceUnavailableException
+        instead of waiting.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            watched = self._watch(inf_id)
+            waiting = False
+            try:
+                while True:
+                    res = [event for event in watched['events'] if event['id'] > after]
+                    remaining = deadline - time.time()
+                    if res or after < watched['lost'] or remaining <= 0:
+                        break
+                    if not waiting:
+                        if self.max_waiting > 0 and self._waiting >= self.max_waiting:
+                            raise ServiceUnavailableException("Service unavailable: too many clients waiting for"
+                                                              " events. Retry after %d seconds." %
+                                                              Config.ADMISSION_RETRY_AFTER,
+                                                              Config.ADMISSION_RETRY_AFTER)
+                        waiting = True
+                        watched['waiting'] += 1
+                        self._waiting += 1
+                    self._cond.wait(remaining)
+            finally:
+                if waiting:
+                    watched['waiting'] -= 1
+                    self._waiting -= 1
+                watched['last_access'] = time.time()
+
+            if after < watched['lost']:
+                res.insert(0, {'id': watched['lost'], 'type': EventBus.RESET, 'data': None})
+            return res
+
+    def stats(self):
+        """ Get a dict with the number of infrastructures watched and the clients waiting """
+        with self._cond:
+            return {'watched': len(self._watched), 'waiting': self._waiting}
+
+
+EVENT_BUS = None
+"""Shared bus of the events, created by get_event_bus()."""
+_event_bus_lock = threading.Lock()
+
+
+def get_event_bus():
+    """
+    Get the :py:class:`EventBus` of the IM, created with the EVENTS_* options of the configuration.
+    """
+    global EVENT_BUS
+    with _event_bus_lock:
+        if EVENT_BUS is None:
+            EVENT_BUS = EventBus(Config.EVENTS_BUFFER_SIZE, Config.EVENTS_RETENTION, Config.EVENTS_MAX_WAITING)
+        return EVENT_BUS
+
+
+def publish(inf_id, event_type, data=None):
+    """ Publish an event of an infrastructure in the :py:class:`EventBus` of the IM """
+    get_event_bus().publish(inf_id, event_type, data)
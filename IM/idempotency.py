@@ -0,0 +1,171 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+import time
+from uuid import uuid1
+
+from IM.config import Config
+from IM.db import DataBase, IntegrityError
+
+
+class IdempotencyKeyConflictException(Exception):
+    """ The idempotency key is in use by a call in progress or it has been used in other call """
+
+    def __init__(self, msg="The idempotency key is in use."):
+        Exception.__init__(self, msg)
+
+
+class IdempotencyKeys:
+    """
+    Idempotency keys of the calls that create resources, to avoid launching the VMs
+    again when a client retries a call (for example after a timeout).
+
+    The first call with a key records it in the idem_keys table of the DATA_DB (so it is
+    shared by all the IM instances), and then the result of the call. A retry with the same
+    key (of the same owner) returns the stored result instead of calling the function again,
+    or an error if the first call is still in progress. The failed calls remove their key, so
+    they can be retried. The keys expire IDEMPOTENCY_KEY_TTL secs after the first call.
+
+    The call in progress holds a lease of the key, renewed while it runs. If the IM stops
+    during the call the lease is not renewed, and once it expires a retry takes the key over.
+    """
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    @staticmethod
+    def create_table(db):
+        """ Create the idem_keys table and the index to remove the expired keys """
+        if not db.table_exists("idem_keys"):
+            db.execute("CREATE TABLE idem_keys(owner VARCHAR(64), idem_key VARCHAR(255), function VARCHAR(255),"
+                       " expires INTEGER, holder VARCHAR(36), lease INTEGER, result LONGBLOB,"
+                       " PRIMARY KEY (owner, idem_key))")
+        if not db.index_exists("idem_keys", "idem_keys_expires"):
+            db.execute("CREATE INDEX idem_keys_expires ON idem_keys (expires)")
+
+    @staticmethod
+    def _connect():
+        db = DataBase(Config.DATA_DB)
+        if not db.connect():
+            raise Exception("Error connecting to the DB to check the idempotency key.")
+        return db
+
+    @staticmethod
+    def _acquire(owner, key, function_name, holder):
+        """
+        Record the key of a new call held by holder (removing before the expired keys and
+        the key if the lease of its call has expired).
+        Returns None if it has been recorded or a tuple (function, result) of the previous
+        call with the key (result is None while it is in progress).
+        """
+        db = IdempotencyKeys._connect()
+        try:
+            while True:
+                now = int(time.time())
+                db.execute_batch([("delete from idem_keys where expires < %s", (now,)),
+                                  ("delete from idem_keys where owner = %s and idem_key = %s and result is null"
+                                   " and lease < %s", (owner, key, now))])
+                try:
+                    db.execute("insert into idem_keys (owner, idem_key, function, expires, holder, lease)"
+                               " values (%s, %s, %s, %s, %s, %s)",
+                               (owner, key, function_name, now + Config.IDEMPOTENCY_KEY_TTL, holder,
+                                now + Config.IDEMPOTENCY_LEASE))
+                    return None
+                except IntegrityError:
+                    res = db.select("select function, result from idem_keys where owner = %s and idem_key = %s",
+                                    (owner, key))
+                    # if it has been removed in the meanwhile try again
+                    if res:
+                        return res[0]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _renew_lease(owner, key, holder, finished):
+        """ Renew the lease of the key held by holder until the finished event is set """
+        while not finished.wait(Config.IDEMPOTENCY_LEASE / 3.0):
+            try:
+                db = IdempotencyKeys._connect()
+                try:
+                    db.execute("update idem_keys set lease = %s where owner = %s and idem_key = %s and holder = %s",
+                               (int(time.time()) + Config.IDEMPOTENCY_LEASE, owner, key, holder))
+                finally:
+                    db.close()
+            except Exception:
+                IdempotencyKeys.logger.exception("Error renewing the lease of the idempotency key %s." % key)
+
+    @staticmethod
+    def _set_result(owner, key, holder, result):
+        """ Store the result of the call of a key held by holder (or remove the key if result is None) """
+        db = IdempotencyKeys._connect()
+        try:
+            if result is None:
+                db.execute("delete from idem_keys where owner = %s and idem_key = %s and holder = %s",
+                           (owner, key, holder))
+            else:
+                db.execute("update idem_keys set result = %s where owner = %s and idem_key = %s and holder = %s",
+                           (json.dumps(result), owner, key, holder))
+        finally:
+            db.close()
+
+    @staticmethod
+    def call(owner, key, function_name, function, *args):
+        """
+        Call function(*args) only once for each key of an owner, returning the result
+        of the first call in the next ones. If the first call is still in progress it raises
+        an :py:class:`IdempotencyKeyConflictException` without waiting for it.
+
+        Args:
+
+        - owner(str): owner of the key (the calls of different owners can use the same keys).
+        - key(str): idempotency key sent by the client.
+        - function_name(str): name of the function (and the ID of the infrastructure if
+          needed), the key cannot be used in calls with other names.
+        - function(callable): function to call, its result must be JSON serializable.
+        """
+        if len(key) > 255:
+            raise Exception("Incorrect idempotency key: it must have at most 255 characters.")
+        holder = str(uuid1())
+        previous = IdempotencyKeys._acquire(owner, key, function_name, holder)
+        if previous is not None:
+            prev_function, result = previous
+            if prev_function != function_name:
+                raise IdempotencyKeyConflictException("The idempotency key %s has been used in other call: %s."
+                                                      % (key, prev_function))
+            if result is None:
+                raise IdempotencyKeyConflictException("The %s call with the idempotency key %s is still in"
+                                                      " progress. Retry it later." % (function_name, key))
+            IdempotencyKeys.logger.info("Returning the result of the previous %s call with the idempotency"
+                                        " key %s." % (function_name, key))
+            return json.loads(str(result))
+
+        finished = threading.Event()
+        renewal = threading.Thread(target=IdempotencyKeys._renew_lease, args=(owner, key, holder, finished),
+                                   name="IM idempotency lease")
+        renewal.daemon = True
+        renewal.start()
+        try:
+            res = function(*args)
+        except Exception:
+            IdempotencyKeys._set_result(owner, key, holder, None)
+            raise
+        finally:
+            finished.set()
+        IdempotencyKeys._set_result(owner, key, holder, res)
+        return res
@@ -0,0 +1,436 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local DB store built from a write-ahead journal and snapshots (journal:// URLs)"""
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+import zlib
+import sqlite3 as sqlite
+
+from IM.config import Config
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except:
+    FCNTL_AVAILABLE = False
+
+
+class JournalStore:
+    """
+    Local DB for single node installations, used with the journal://path URLs.
+
+    The data is maintained in an in-memory SQLite DB, so it uses the same SQL dialect,
+    and the reads never access the disk. Each committed transaction is appended as a
+    record to the journal file (path) by a single writer thread, that writes all the
+    records pending in a single write and fsync (group commit). The commits return when
+    their record is durable, but the changes are visible to the other readers as soon as
+    they are applied to the in-memory DB: a reader may see a change that is lost if the
+    process crashes before its record is written.
+    When the journal grows over DB_JOURNAL_SNAPSHOT_SIZE bytes a background thread copies
+    the DB to a temporary DB file, writes it to the snapshot file (path.snap) without
+    blocking the readers and the writers, and removes from the journal the records included
+    in it. At start the DB is recovered loading the snapshot and replaying the journal
+    records not included in it. An incomplete record at the end of the journal (a crash in
+    the middle of a write) is discarded.
+
+    Arguments:
+       - path(str): Path of the journal file.
+       - sync(bool): Call fsync after each group of records written.
+       - snapshot_size(int): Size of the journal (in bytes) to write a new snapshot.
+    """
+
+    HEADER = struct.Struct("<IIQ")
+    """Header of the journal records: size of the data, CRC32 of the data and sequence number."""
+
+    SNAPSHOT_HEADER = "-- IM journal snapshot %d\n"
+    """First line of the snapshot file, with the sequence number of the last record included."""
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    stores = {}
+    """Map from path to the open :py:class:`JournalStore`."""
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path, sync=True, snapshot_size=67108864):
+        self.path = path
+        self.snapshot_path = path + ".snap"
+        self.sync = sync
+        self.snapshot_size = snapshot_size
+        self._lock = threading.Lock()
+        """Lock of the in-memory DB."""
+        self._io_lock = threading.Lock()
+        """Lock of the writes to the journal file."""
+        self._snapshot_lock = threading.Lock()
+        """Lock to write only one snapshot at a time."""
+        self._snapshot_thread = None
+        """Thread writing the snapshots in background (None if it is not running)."""
+        self._snapshot_requested = False
+        self._cond = threading.Condition(threading.Lock())
+        """Condition to notify the pending and the written records."""
+        self._pending = []
+        """List of tuples (sequence number, record) not written yet."""
+        self._seq = 0
+        """Sequence number of the last record applied to the in-memory DB."""
+        self._durable = 0
+        """Sequence number of the last record written to the journal."""
+        self._error = None
+        self._closing = False
+        self._db = sqlite.connect(":memory:", check_same_thread=False)
+
+        self._file = open(self.path, "ab")
+        try:
+            if FCNTL_AVAILABLE:
+                try:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    raise Exception("Journal %s in use by other process." % self.path)
+            self._recover()
+        except Exception:
+            self._file.close()
+            self._db.close()
+            raise
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._writer = threading.Thread(target=self._write_records, name="IM journal writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    @staticmethod
+    def get(path):
+        """ Get the store of the specified path, opening it if needed """
+        with JournalStore._stores_lock:
+            if path not in JournalStore.stores:
+                JournalStore.stores[path] = JournalStore(path, Config.DB_JOURNAL_SYNC,
+                                                         Config.DB_JOURNAL_SNAPSHOT_SIZE)
+            return JournalStore.stores[path]
+
+    @staticmethod
+    def close_all():
+        """ Close all the open stores """
+        with JournalStore._stores_lock:
+            stores = JournalStore.stores.values()
+            JournalStore.stores = {}
+        for store in stores:
+            store.close()
+
+    @staticmethod
+    def _encode(sentences):
+        """ Serialize a list of sentences, marking the binary arguments """
+        res = []
+        for sql, args in sentences:
+            if args is not None:
+                args = [(str(arg),) if isinstance(arg, buffer) else arg for arg in args]
+            res.append((sql, args))
+        return marshal.dumps(res)
+
+    @staticmethod
+    def _decode(data):
+        """ Deserialize a list of sentences serialized with :py:meth:`_encode` """
+        res = []
+        for sql, args in marshal.loads(data):
+            if args is not None:
+                args = [sqlite.Binary(arg[0]) if isinstance(arg, tuple) else arg for arg in args]
+            res.append((sql, args))
+        return res
+
+    def _apply(self, sentences):
+        """ Execute a list of sentences in a transaction. Must be called with the lock acquired """
+        try:
+            cursor = self._db.cursor()
+            for sql, args in sentences:
+                if args is not None:
+                    cursor.execute(sql, args)
+                else:
+                    cursor.execute(sql)
+            self._db.commit()
+        except Exception:
+            self._db.rollback()
+            raise
+
+    def _recover(self):
+        """ Load the snapshot and replay the journal """
+        snapshot_seq = 0
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                header = f.readline()
+                snapshot_seq = int(header.split()[-1])
+                self._db.executescript(f.read().decode("utf-8"))
+        self._seq = snapshot_seq
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        pos = replayed = 0
+        while pos < len(data):
+            if pos + self.HEADER.size > len(data):
+                break
+            size, crc, seq = self.HEADER.unpack_from(data, pos)
+            record = data[pos + self.HEADER.size:pos + self.HEADER.size + size]
+            if len(record) < size or zlib.crc32(record) & 0xffffffff != crc:
+                break
+            if seq > snapshot_seq:
+                self._apply(self._decode(record))
+                self._seq = seq
+                replayed += 1
+            pos += self.HEADER.size + size
+
+        if pos < len(data):
+            JournalStore.logger.warn("Discarding %d bytes of an incomplete record at the end of the journal %s." %
+                                     (len(data) - pos, self.path))
+            with open(self.path, "r+b") as f:
+                f.truncate(pos)
+        self._durable = self._seq
+        JournalStore.logger.info("Journal %s recovered: %d records replayed." % (self.path, replayed))
+
+    def select(self, sql, args=None):
+        """ Execute a query in the in-memory DB and return all the results """
+        with self._lock:
+            cursor = self._db.cursor()
+            if args is not None:
+                cursor.execute(sql, args)
+            else:
+                cursor.execute(sql)
+            return cursor.fetchall()
+
+    def commit(self, sentences):
+        """
+        Execute a list of sentences in a transaction and append them to the journal.
+        Returns when the record is written to disk.
+        """
+        # Store the date used by the sentences to replay them with the same values
+        date = "'%s'" % time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        sentences = [(sql.replace("datetime('now')", date), args) for sql, args in sentences]
+        record = self._encode(sentences)
+        with self._lock:
+            if self._error or self._closing:
+                raise Exception("Journal %s closed." % self.path)
+            self._apply(sentences)
+            self._seq += 1
+            seq = self._seq
+            with self._cond:
+                self._pending.append((seq, self.HEADER.pack(len(record), zlib.crc32(record) & 0xffffffff, seq) +
+                                      record))
+                self._cond.notify_all()
+
+        with self._cond:
+            while self._durable < seq and not self._error:
+                self._cond.wait()
+            if self._error:
+                raise Exception("Error writing to the journal %s: %s" % (self.path, self._error))
+
+    def _flush(self):
+        """ Write all the pending records to the journal """
+        with self._io_lock:
+            with self._cond:
+                records = self._pending
+                self._pending = []
+            if not records:
+                return
+            data = "".join(record for _, record in records)
+            self._file.write(data)
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+            self._size += len(data)
+            with self._cond:
+                self._durable = records[-1][0]
+                self._cond.notify_all()
+
+    def _copy_db(self, path):
+        """ Copy the in-memory DB to a new DB file. Must be called with the lock acquired """
+        if hasattr(self._db, "backup"):
+            copy_db = sqlite.connect(path)
+            try:
+                self._db.backup(copy_db)
+            finally:
+                copy_db.close()
+        else:
+            self._db.execute("VACUUM INTO ?", (path,))
+
+    def snapshot(self):
+        """ Write the in-memory DB to the snapshot file and remove the records included from the journal """
+        with self._snapshot_lock:
+            copy_path = self.snapshot_path + ".db"
+            if os.path.exists(copy_path):
+                os.unlink(copy_path)
+            with self._lock:
+                # The records applied must be in the journal or in the snapshot
+                self._flush()
+                seq = self._seq
+                offset = self._size
+                self._copy_db(copy_path)
+
+            try:
+                copy_db = sqlite.connect(copy_path)
+                try:
+                    tmp_path = self.snapshot_path + ".tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(self.SNAPSHOT_HEADER % seq)
+                        for line in copy_db.iterdump():
+                            f.write(line.encode("utf-8") + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                finally:
+                    copy_db.close()
+            finally:
+                os.unlink(copy_path)
+            os.rename(tmp_path, self.snapshot_path)
+            # If it crashes before removing them the records already in the snapshot are ignored
+            self._compact(offset)
+
+    def _compact(self, offset):
+        """ Remove from the journal the records before the offset (the ones included in the snapshot) """
+        with self._io_lock:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            if not tail:
+                self._file.truncate(0)
+                if self.sync:
+                    os.fsync(self._file.fileno())
+            else:
+                # Records written during the snapshot: replace the journal with a new one with them
+                tmp_path = self.path + ".tmp"
+                new_file = open(tmp_path, "wb")
+                try:
+                    new_file.write(tail)
+                    new_file.flush()
+                    os.fsync(new_file.fileno())
+                    if FCNTL_AVAILABLE:
+                        fcntl.flock(new_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.rename(tmp_path, self.path)
+                except Exception:
+                    new_file.close()
+                    raise
+                self._file.close()
+                self._file = new_file
+            self._size = len(tail)
+
+    def _request_snapshot(self):
+        """ Write a new snapshot in background (after the current one if it is being written) """
+        with self._cond:
+            self._snapshot_requested = True
+            if self._snapshot_thread is None:
+                self._snapshot_thread = threading.Thread(target=self._write_snapshots, name="IM journal snapshot")
+                self._snapshot_thread.daemon = True
+                self._snapshot_thread.start()
+
+    def _write_snapshots(self):
+        while True:
+            with self._cond:
+                if not self._snapshot_requested:
+                    self._snapshot_thread = None
+                    return
+                self._snapshot_requested = False
+            try:
+                self.snapshot()
+            except Exception:
+                JournalStore.logger.exception("Error writing the snapshot of the journal %s." % self.path)
+
+    def _write_records(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if self._closing and not self._pending:
+                    break
+            try:
+                self._flush()
+                if self._size > self.snapshot_size:
+                    self._request_snapshot()
+            except Exception, ex:
+                JournalStore.logger.exception("Error writing to the journal %s." % self.path)
+                with self._cond:
+                    self._error = str(ex)
+                    self._pending = []
+                    self._cond.notify_all()
+                break
+
+    def close(self, snapshot=True):
+        """ Stop the writer thread writing the pending records and close the files """
+        with self._lock:
+            with self._cond:
+                self._closing = True
+                self._cond.notify_all()
+        self._writer.join()
+        with self._cond:
+            snapshot_thread = self._snapshot_thread
+        if snapshot_thread:
+            snapshot_thread.join()
+        if snapshot and not self._error:
+            try:
+                self.snapshot()
+            except Exception:
+                JournalStore.logger.exception("Error writing the snapshot of the journal %s." % self.path)
+        self._file.close()
+        self._db.close()
+
+
+class JournalConnection:
+    """
+    DB-API connection to a :py:class:`JournalStore`. The sentences (other than selects)
+    are kept until commit, and then executed in the store in a single transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sentences = []
+
+    def cursor(self):
+        return JournalCursor(self)
+
+    def commit(self):
+        if self._sentences:
+            sentences = self._sentences
+            self._sentences = []
+            JournalStore.get(self.path).commit(sentences)
+
+    def rollback(self):
+        self._sentences = []
+
+    def close(self):
+        self._sentences = []
+
+
+class JournalCursor:
+    """ DB-API cursor of a :py:class:`JournalConnection` """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = []
+
+    def execute(self, sql, args=None):
+        if sql.lstrip()[:6].lower() == "select":
+            self._rows = JournalStore.get(self.connection.path).select(sql, args)
+        else:
+            self.connection._sentences.append((sql, args))
+
+    def fetchall(self):
+        rows = self._rows
+        self._rows = []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows = self._rows[:size]
+        self._rows = self._rows[size:]
+        return rows
+
+    def close(self):
+        self._rows = []
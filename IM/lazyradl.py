@@ -0,0 +1,78 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from IM.radlcache import parse_radl
+
+
+class LazyRADL(object):
+    """
+    Descriptor for the RADL attributes of a class, to parse them only when they are accessed.
+
+    The value is stored in the ``__dict__`` of the instance with the same name, so the objects
+    can be serialized and deserialized copying their ``__dict__``: if a RADL text is stored
+    (e.g. when deserializing an object) it is parsed the first time the attribute is read.
+    Until then, the original text is maintained, so serializing an object whose RADL has not
+    been accessed does not require to convert it again to text.
+
+    Arguments:
+       - name(str): name of the attribute.
+    """
+
+    _lock = threading.Lock()
+    """
+    Lock to publish the parsed RADLs. It is only held to compare and set the value,
+    the RADLs are parsed outside it so the parsing of different objects is not serialized.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.name)
+        if isinstance(value, basestring):
+            parsed = parse_radl(value)
+            with LazyRADL._lock:
+                # Other thread may have parsed or set it in the meanwhile: use its value
+                current = obj.__dict__.get(self.name)
+                if current is value:
+                    obj.__dict__[self.name] = parsed
+                    current = parsed
+            if not isinstance(current, basestring):
+                return current
+            return self.__get__(obj, objtype)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+    @staticmethod
+    def is_parsed(obj, name):
+        """ Check if the RADL attribute of an object has been parsed """
+        return not isinstance(obj.__dict__.get(name), basestring)
+
+    @staticmethod
+    def to_str(value):
+        """
+        Get the text of a RADL attribute copied from the ``__dict__`` of an object
+        (it may be the original text or a parsed RADL)
+        """
+        if isinstance(value, basestring):
+            return value
+        return str(value)
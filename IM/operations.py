@@ -0,0 +1,220 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from uuid import uuid1
+
+from IM.config import Config
+from IM.events import publish
+from IM.request import WorkerPool
+
+
+class OperationCancelledException(Exception):
+    """ The operation has been cancelled by the user """
+
+    def __init__(self, msg="Operation cancelled by the user."):
+        Exception.__init__(self, msg)
+
+
+class Operation:
+    """
+    Asynchronous operation (the deployment of the resources of a CreateInfrastructure
+    or AddResource call) executed in the background by the :py:class:`OperationManager`.
+
+    The changes of its state and progress are also published as events of type
+    "operation" of the infrastructure.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    UNKNOWN = "unknown"
+    """State returned for the operations that are not available anymore (see :py:meth:`unknown`)."""
+
+    def __init__(self, inf, op_type):
+        self.id = str(uuid1())
+        """Operation ID."""
+        self.inf = inf
+        """Infrastructure of the operation (used to check the authorization)."""
+        self.type = op_type
+        """Type of the operation (the name of the function)."""
+        self.state = Operation.QUEUED
+        self.progress = None
+        """Description of the current step of the operation."""
+        self.result = None
+        """Result of the operation (the IDs of the VMs created)."""
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancelled = False
+        """Flag set when the user asks to cancel the operation."""
+        self.cancel_deployment = []
+        """List of errors that stop the deployment (shared with the launch threads)."""
+        self.cancellable = True
+        """Flag unset when the operation has passed the point where a cancellation can take effect."""
+        self._lock = threading.Lock()
+
+    def is_finished(self):
+        return self.state in [Operation.FINISHED, Operation.FAILED, Operation.CANCELLED]
+
+    def set_progress(self, progress):
+        """ Set the description of the current step of the operation """
+        self.progress = progress
+        publish(self.inf.id, "operation", self.to_dict())
+
+    def check_cancelled(self):
+        """ Raise an :py:class:`OperationCancelledException` if the operation has been cancelled """
+        if self.cancelled:
+            raise OperationCancelledException()
+
+    def cancel(self):
+        """
+        Cancel the operation: the VMs are not launched if it has not started yet, otherwise
+        the launches in progress end but no more VMs are launched and all the VMs launched
+        by the operation are destroyed. Returns False if the operation has already finished
+        or it cannot be cancelled anymore (see :py:meth:`disable_cancel`).
+        """
+        with self._lock:
+            if self.is_finished() or not self.cancellable:
+                return False
+            if not self.cancelled:
+                self.cancelled = True
+                self.cancel_deployment.append(OperationCancelledException())
+            return True
+
+    def disable_cancel(self):
+        """
+        Mark the point after which a cancellation cannot take effect (the VMs launched are
+        added to the infrastructure). The next calls to :py:meth:`cancel` return False.
+        """
+        with self._lock:
+            self.cancellable = False
+
+    @staticmethod
+    def unknown(info):
+        """
+        Get the info (as returned by :py:meth:`to_dict`) of an operation that is not stored
+        anymore (after a restart of the IM or its retention), setting the unknown state.
+        """
+        return dict(info, state=Operation.UNKNOWN,
+                    error="The operation is not available anymore: check the state of the infrastructure.")
+
+    def to_dict(self):
+        """ Get the info of the operation as a dict (without None values, not supported by XML-RPC) """
+        res = {'id': self.id, 'inf_id': self.inf.id, 'type': self.type, 'state': self.state,
+               'created': self.created, 'cancelled': self.cancelled}
+        for name in ['progress', 'result', 'error', 'finished']:
+            value = getattr(self, name)
+            if value is not None:
+                res[name] = value
+        return res
+
+
+class OperationManager:
+    """
+    Executes the asynchronous operations in a pool of max_running threads (the rest wait
+    in the queue) and keeps the finished ones retention secs to return their results.
+
+    The operations are only stored in the memory of the IM instance that executes them,
+    so they are not found in other IM instances (in HA mode) nor after a restart.
+
+    Arguments:
+       - max_running(int): Maximum number of operations executed at the same time.
+       - retention(int): Time (in secs) to keep the finished operations.
+    """
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    def __init__(self, max_running=5, retention=3600):
+        self.retention = retention
+        self._pool = WorkerPool(max_running, name="IM deployment")
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def start(self, inf, op_type, function, *args):
+        """
+        Queue an operation of an infrastructure that calls function(*args, operation=op).
+        Returns the :py:class:`Operation` object.
+        """
+        op = Operation(inf, op_type)
+        with self._lock:
+            self._cleanup(time.time())
+            self._operations[op.id] = op
+        publish(inf.id, "operation", op.to_dict())
+        self._pool.submit(self._run, op, function, args)
+        return op
+
+    def _run(self, op, function, args):
+        op.state = Operation.RUNNING
+        op.set_progress("Started")
+        try:
+            op.result = function(*args, operation=op)
+            op.state = Operation.FINISHED
+        except Exception, ex:
+            if op.cancelled:
+                op.state = Operation.CANCELLED
+            else:
+                OperationManager.logger.exception("Error in the %s operation %s of Inf ID: %s" %
+                                                  (op.type, op.id, op.inf.id))
+                op.state = Operation.FAILED
+            op.error = str(ex)
+        op.finished = time.time()
+        op.set_progress("Finished")
+
+    def _cleanup(self, now):
+        """ Remove the operations finished more than retention secs ago. Must be called with the lock acquired """
+        for op_id, op in self._operations.items():
+            if op.finished and now - op.finished > self.retention:
+                del self._operations[op_id]
+
+    def get(self, op_id):
+        """ Get the :py:class:`Operation` with the specified ID (None if it does not exist) """
+        with self._lock:
+            return self._operations.get(op_id)
+
+    def stats(self):
+        """
+        Get a dict with the gauges of the pool of threads that execute the operations and
+        the number of operations stored in each state (operations).
+        """
+        res = self._pool.stats()
+        res['operations'] = {}
+        with self._lock:
+            for op in self._operations.values():
+                res['operations'][op.state] = res['operations'].get(op.state, 0) + 1
+        return res
+
+
+OPERATION_MANAGER = None
+"""Shared manager of the operations, created by get_operation_manager()."""
+_operation_manager_lock = threading.Lock()
+
+
+def get_operation_manager():
+    """
+    Get the :py:class:`OperationManager` of the IM, created with the MAX_SIMULTANEOUS_DEPLOYMENTS
+    and OPERATIONS_RETENTION options of the configuration.
+    """
+    global OPERATION_MANAGER
+    with _operation_manager_lock:
+        if OPERATION_MANAGER is None:
+            OPERATION_MANAGER = OperationManager(Config.MAX_SIMULTANEOUS_DEPLOYMENTS, Config.OPERATIONS_RETENTION)
+        return OPERATION_MANAGER
@@ -0,0 +1,117 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from radl import radl_parse, radl_json
+from IM.config import Config
+
+
+class RADLCache:
+    """
+    Thread-safe LRU cache of parsed RADL documents, indexed by a digest of their text.
+    It returns clones of the cached RADL objects, so they can be modified by the callers.
+
+    Arguments:
+       - max_size(int): Maximum size (in bytes) of the RADL texts cached.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        """Size of the RADL texts cached."""
+        self.hits = 0
+        """Number of documents obtained from the cache."""
+        self.misses = 0
+        """Number of documents parsed."""
+        self._cache = OrderedDict()
+        """Map from (parser name, digest) to (RADL object, size of the text)."""
+        self._lock = threading.Lock()
+
+    def parse(self, data, parser=radl_parse.parse_radl):
+        """
+        Get the RADL object of a document, parsing it only if it is not in the cache.
+
+        Arguments:
+           - data(str): RADL document.
+           - parser(function): Function to parse the document.
+
+        Returns: a :py:class:`radl.RADL` object.
+        """
+        size = len(data)
+        if size > self.max_size:
+            with self._lock:
+                self.misses += 1
+            return parser(data)
+
+        if isinstance(data, unicode):
+            digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        else:
+            digest = hashlib.sha1(data).hexdigest()
+        key = (parser.__module__, digest)
+
+        with self._lock:
+            elem = self._cache.pop(key, None)
+            if elem:
+                # Move it to the end of the LRU order
+                self._cache[key] = elem
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if elem:
+            return elem[0].clone()
+
+        radl = parser(data)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = (radl.clone(), size)
+                self.size += size
+                while self.size > self.max_size:
+                    _, (_, old_size) = self._cache.popitem(last=False)
+                    self.size -= old_size
+        return radl
+
+    def clear(self):
+        """ Remove all the cached documents and reset the counters """
+        with self._lock:
+            self._cache = OrderedDict()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        """ Get a dict with the number of cached documents, their size and the hit and miss counters """
+        with self._lock:
+            return {'entries': len(self._cache), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+radl_cache = RADLCache(Config.RADL_CACHE_MAX_SIZE)
+"""Shared cache of RADL documents."""
+
+
+def parse_radl(data):
+    """ Parse a RADL document using the shared cache (if RADL_CACHE_MAX_SIZE > 0) """
+    if Config.RADL_CACHE_MAX_SIZE > 0:
+        return radl_cache.parse(data)
+    return radl_parse.parse_radl(data)
+
+
+def parse_radl_json(data):
+    """ Parse a RADL document in JSON format using the shared cache (if RADL_CACHE_MAX_SIZE > 0) """
+    if Config.RADL_CACHE_MAX_SIZE > 0 and isinstance(data, basestring):
+        return radl_cache.parse(data, radl_json.parse_radl)
+    return radl_json.parse_radl(data)
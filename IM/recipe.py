@@ -45,8 +45,8 @@ class Recipe:
         if not DataBase.db_available:
             return False
         else:
+            db = DataBase(Config.RECIPES_DB_FILE)
             try:
-                db = DataBase(Config.RECIPES_DB_FILE)
                 db.connect()
 
                 res = db.execute('''insert into recipes values ("%s", "%s", "%s", "%s", %d, %d, "%s", "%s")''' % (
@@ -54,6 +54,8 @@ class Recipe:
                 return res
             except Exception:
                 return False
+            finally:
+                db.close()
 
     @staticmethod
     def getRecipes():
@@ -61,8 +63,8 @@ class Recipe:
         if not DataBase.db_available:
             return []
         else:
+            db = DataBase(Config.RECIPES_DB_FILE)
             try:
-                db = DataBase(Config.RECIPES_DB_FILE)
                 db.connect()
 
                 res = []
@@ -82,6 +84,8 @@ class Recipe:
                 return res
             except Exception:
                 return []
+            finally:
+                db.close()
 
     @staticmethod
     def insertApp(name, version, module, recipe, galaxy_module=None, requirements=""):
@@ -94,8 +98,8 @@ class Recipe:
         if not DataBase.db_available:
             return []
         else:
+            db = DataBase(Config.RECIPES_DB_FILE)
             try:
-                db = DataBase(Config.RECIPES_DB_FILE)
                 db.connect()
 
                 res = []
@@ -113,6 +117,8 @@ class Recipe:
                 return res
             except Exception:
                 return []
+            finally:
+                db.close()
 
     @staticmethod
     def getInfoApps(apps_to_install):
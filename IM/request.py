@@ -15,7 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
-from Queue import Queue, Empty
+import logging
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+from Queue import Queue, PriorityQueue, Empty
 import threading
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 import SocketServer
@@ -24,13 +28,26 @@ from timedcall import TimedCall
 from config import Config
 
 
-class RequestQueue(Queue):
+class RequestQueue(PriorityQueue):
     """
     Modela una cola del sistema que procesa las peticiones encoladas de acuerdo a unas prioridades.
     Se elige la prioridad con indice menor, siguiendo la prioridad convencional de las PriorityQueue
     estandar.
     """
 
+    def __init__(self, maxsize=0):
+        PriorityQueue.__init__(self, maxsize)
+        self._counter = count()
+
+    def _put(self, item):
+        # keep the FIFO order of the requests with the same priority
+        priority, request = item
+        PriorityQueue._put(self, (priority, next(self._counter), request))
+
+    def _get(self):
+        priority, _, request = PriorityQueue._get(self)
+        return priority, request
+
     def process_requests(self, max_requests, wait_time_for_element=0):
         """
         Procesa solicitudes de la cola, utilizando el metodo "process" de la clase
@@ -53,7 +70,12 @@ class RequestQueue(Queue):
                     _, request = self.get(True, wait_time_for_element)
                 else:
                     _, request = self.get(False)
-                request.process()
+                try:
+                    request.process()
+                except Exception, ex:
+                    # an erroneous request must not stop the processing of the rest
+                    logging.getLogger('InfrastructureManager').exception("Error processing a request.")
+                    request.abort(str(ex))
                 requests_processed = requests_processed + 1
             except Empty:
                 empty = True
@@ -108,6 +130,262 @@ class RequestQueue(Queue):
             sys.exit(0)
 
 
+class WorkerPool:
+    """
+    Fixed-size pool of threads that execute the functions submitted in FIFO order.
+    A function that has to wait for something executed elsewhere can release its
+    slot of the pool while it waits (see :py:meth:`released`), so a new thread
+    executes the next functions meanwhile.
+
+    Arguments:
+       - size(int): Number of threads of the pool.
+       - max_queued(int): Maximum number of functions waiting for a free thread
+         (0 means unlimited). When it is reached :py:meth:`submit` blocks.
+       - name(str): Name of the threads.
+    """
+
+    logger = logging.getLogger('InfrastructureManager')
+    """Logger object."""
+
+    _current = threading.local()
+    """Pool of the current thread (attribute pool)."""
+
+    def __init__(self, size, max_queued=0, name="IM worker"):
+        self.size = size
+        self.name = name
+        self._queue = Queue(max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self._released = 0
+        """Number of threads executing a function that has released its slot."""
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    def _start_threads(self):
+        """ Start the threads of the pool (the first time it is used) """
+        with self._lock:
+            while len(self._threads) < self.size + self._released:
+                thread = threading.Thread(target=self._work, name="%s %d" % (self.name, len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    @staticmethod
+    @contextmanager
+    def released():
+        """
+        Context manager to wait for something without taking a slot of the pool of the current
+        thread (if it is a thread of a pool): a new thread executes the queued functions meanwhile,
+        and the pool gets back to its size when the function of this thread finishes.
+        """
+        pool = getattr(WorkerPool._current, 'pool', None)
+        if pool is None:
+            yield
+            return
+        with pool._lock:
+            pool._released += 1
+            pool._busy -= 1
+        pool._start_threads()
+        try:
+            yield
+        finally:
+            with pool._lock:
+                pool._released -= 1
+                pool._busy += 1
+
+    def submit(self, function, *args):
+        """ Queue a function to be executed by a thread of the pool """
+        self._start_threads()
+        self._queue.put((time.time(), function, args))
+
+    def _get(self):
+        """ Wait for the next function to execute, returns a tuple (time queued, function, args) """
+        return self._queue.get()
+
+    def _finished(self, function, args):
+        """ Called when a function has been executed """
+        pass
+
+    def _queued(self):
+        """ Get the number of functions waiting in the queue """
+        return self._queue.qsize()
+
+    def _work(self):
+        WorkerPool._current.pool = self
+        while True:
+            queued, function, args = self._get()
+            wait = time.time() - queued
+            with self._lock:
+                self._busy += 1
+                self._wait_total += wait
+                self._wait_last = wait
+                self._wait_max = max(self._wait_max, wait)
+            try:
+                function(*args)
+            except Exception:
+                WorkerPool.logger.exception("Error executing a function in the %s pool." % self.name)
+            finally:
+                self._finished(function, args)
+                with self._lock:
+                    self._busy -= 1
+                    self._processed += 1
+                    if len(self._threads) > self.size + self._released:
+                        # A thread started while this one had released its slot
+                        self._threads.remove(threading.current_thread())
+                        return
+
+    def stats(self):
+        """
+        Get a dict with the gauges of the pool: size, busy threads, queued functions,
+        functions processed and time (in secs) waited in the queue (last, average and max).
+        """
+        with self._lock:
+            started = self._processed + self._busy
+            return {'size': self.size, 'busy': self._busy, 'queued': self._queued(),
+                    'processed': self._processed, 'wait_time_last': self._wait_last,
+                    'wait_time_avg': self._wait_total / started if started else 0.0,
+                    'wait_time_max': self._wait_max}
+
+
+class RequestScheduler(WorkerPool):
+    """
+    Pool of threads that executes :py:class:`Request` objects in order of priority
+    and, within the same priority, with weighted fair queuing across users: each
+    request gets a virtual finish time (the one of the previous request of the same
+    user, or the current virtual time, plus 1 / weight of the user) and the one with
+    the lowest is executed first. So a user with many queued requests does not delay
+    the requests of the rest.
+    Users cannot have more than max_user_long long operations (the requests with
+    the long_operation flag) in execution at the same time, the rest wait in the queue.
+
+    Arguments:
+       - size(int): Number of threads of the pool.
+       - max_user_long(int): Maximum number of long operations in execution per user
+         (0 means unlimited).
+       - weights(dict): Weight of each user (1 by default).
+       - name(str): Name of the threads.
+    """
+
+    def __init__(self, size, max_user_long=0, weights=None, name="IM request"):
+        WorkerPool.__init__(self, size, name=name)
+        self.max_user_long = max_user_long
+        self.weights = weights or {}
+        self._cond = threading.Condition(threading.Lock())
+        self._queues = {}
+        """Map from priority to a map from user to the list of its requests (finish time, time queued, request)."""
+        self._virtual_time = {}
+        """Map from priority to the finish time of the last request executed."""
+        self._last_finish = {}
+        """Map from (priority, user) to the finish time of the last request queued."""
+        self._long_running = {}
+        """Map from user to the number of long operations in execution."""
+        self._num_queued = 0
+
+    def submit(self, request):
+        """ Queue a request to be executed by a thread of the pool """
+        self._start_threads()
+        priority = request.priority
+        user = request.get_user()
+        with self._cond:
+            start = max(self._virtual_time.get(priority, 0.0), self._last_finish.get((priority, user), 0.0))
+            finish = start + 1.0 / self.weights.get(user, 1)
+            self._last_finish[(priority, user)] = finish
+            self._queues.setdefault(priority, {}).setdefault(user, deque()).append((finish, time.time(), request))
+            self._num_queued += 1
+            self._cond.notify()
+
+    def _can_start(self, user, request):
+        return (not request.long_operation or self.max_user_long <= 0 or
+                self._long_running.get(user, 0) < self.max_user_long)
+
+    def _pick(self):
+        """ Get the next request to execute (or None). Must be called with the lock acquired """
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            # the user can be None (requests without auth data)
+            selected = found = None
+            for user, requests in users.items():
+                if self._can_start(user, requests[0][2]) and (not found or requests[0][0] < users[selected][0][0]):
+                    selected, found = user, True
+            if found:
+                finish, queued, request = users[selected].popleft()
+                self._virtual_time[priority] = finish
+                if not users[selected]:
+                    del users[selected]
+                    del self._last_finish[(priority, selected)]
+                if not users:
+                    del self._queues[priority]
+                if request.long_operation:
+                    self._long_running[selected] = self._long_running.get(selected, 0) + 1
+                self._num_queued -= 1
+                return queued, request
+        return None
+
+    def _get(self):
+        with self._cond:
+            while True:
+                res = self._pick()
+                if res:
+                    queued, request = res
+                    return queued, Request.process, (request,)
+                self._cond.wait()
+
+    def _finished(self, function, args):
+        request = args[0]
+        if request.long_operation:
+            user = request.get_user()
+            with self._cond:
+                self._long_running[user] -= 1
+                if not self._long_running[user]:
+                    del self._long_running[user]
+                # the queued long operations of the user can be executed now
+                self._cond.notify_all()
+
+    def _queued(self):
+        with self._cond:
+            return self._num_queued
+
+
+REQUEST_POOL = None
+"""Shared pool of the requests, created by get_request_pool()."""
+STATE_POOL = None
+"""Shared pool of the VM state updates, created by get_state_pool()."""
+_pools_lock = threading.Lock()
+
+
+def get_request_pool():
+    """
+    Get the :py:class:`RequestScheduler` that executes the :py:class:`AsyncRequest` objects
+    (with MAX_SIMULTANEOUS_REQUESTS threads), creating it if needed.
+    """
+    global REQUEST_POOL
+    with _pools_lock:
+        if REQUEST_POOL is None:
+            weights = {}
+            for elem in Config.REQUEST_USER_WEIGHTS:
+                if elem.strip():
+                    user, weight = elem.strip().rsplit(":", 1)
+                    weights[user] = float(weight)
+            REQUEST_POOL = RequestScheduler(Config.MAX_SIMULTANEOUS_REQUESTS, Config.MAX_USER_LONG_OPERATIONS,
+                                            weights)
+        return REQUEST_POOL
+
+
+def get_state_pool():
+    """
+    Get the :py:class:`WorkerPool` that updates the state of the VMs in the calls that get
+    the state of several infrastructures (with INF_STATE_THREADS threads), creating it if needed.
+    """
+    global STATE_POOL
+    with _pools_lock:
+        if STATE_POOL is None:
+            STATE_POOL = WorkerPool(Config.INF_STATE_THREADS, name="IM state update")
+        return STATE_POOL
+
+
 def get_system_queue():
     """
     Obtiene la cola general del sistema. Al utilizar este mecanismo, diferimos la creacion
@@ -141,22 +419,35 @@ class Request(object):
     PRIORITY_NORMAL = 1  # Prioridad normal
     PRIORITY_LOW = 2  # Prioridad baja
 
-    def __init__(self, arguments=(), priority=PRIORITY_NORMAL):
+    long_operation = False
+    """Flag to specify that the request may take a long time (limited per user by the scheduler)."""
+
+    def __init__(self, arguments=(), priority=PRIORITY_NORMAL, enqueue=True):
         """
         La prioridad debe utilizarse principalmente para temas de interaccion con el usuario. Por ejemplo
         consultar el estado del sistema deberia ser prioritario puesto que en realidad no necesita realizar
         procesamiento y resultaria raro que el usuario necesitase esperar demasiado rato
+        Con enqueue a False no se encola en la cola del sistema (se debe llamar a process directamente)
         """
         self.__event = threading.Event()
         self.__value = None
         self.__status = Request.STATUS_PENDING
         self.__arguments = arguments
 
+        self.priority = priority
+
         # Este semaforo es para acceder a los atributos y que sea "threadsafe"
         self.__semaphore = threading.Lock()
 
         # Se encola en la cola general del sistema
-        get_system_queue().put((priority, self))
+        if enqueue:
+            get_system_queue().put((priority, self))
+
+    def get_user(self):
+        """
+        Devuelve el usuario que ha realizado la peticion (None si no se conoce)
+        """
+        return None
 
     @property
     def arguments(self):
@@ -169,8 +460,10 @@ class Request(object):
     def wait(self):
         """
         Espera a que se reciba la señal de fin de procesamiento de la peticion
+        (sin ocupar el hueco del pool del thread, p.e. el de los handlers de XML-RPC)
         """
-        self.__event.wait()
+        with WorkerPool.released():
+            self.__event.wait()
 
     def set(self, x=True):
         """
@@ -222,6 +515,14 @@ class Request(object):
         # Se ha terminado de ejecutar, asi que notificamos
         self.__event.set()
 
+    def abort(self, error):
+        """
+        Finish the request with an error (without executing it), to wake up the clients waiting for it
+        """
+        self.set(error)
+        self.set_status(Request.STATUS_ERROR)
+        self.__event.set()
+
     def _execute(self):
         """
         Implementa de forma efectiva el procesamiento de la ejecucion
@@ -236,19 +537,49 @@ class AsyncRequest(Request):
     de forma asincrona, en un thread independiente
     """
 
-    def __init__(self, arguments=(), priority=Request.PRIORITY_NORMAL):
-        Request.__init__(self, arguments, priority)
+    def __init__(self, arguments=(), priority=Request.PRIORITY_NORMAL, enqueue=True):
+        Request.__init__(self, arguments, priority, enqueue)
         self.__thread = None
 
     def process(self):
         """
-        En este caso lo que se hace es lanzar el thread
+        En este caso lo que se hace es lanzar el thread (o encolarla en el pool de threads
+        si MAX_SIMULTANEOUS_REQUESTS > 0)
         """
-        self.__thread = threading.Thread(target=Request.process, args=[self])
-        self.__thread.start()
+        if Config.MAX_SIMULTANEOUS_REQUESTS > 0:
+            get_request_pool().submit(self)
+        else:
+            self.__thread = threading.Thread(target=Request.process, args=[self])
+            self.__thread.start()
+
+
+class PoolMixIn(SocketServer.ThreadingMixIn):
+    """
+    Mix-in class to handle each connection in a thread of a bounded pool (with
+    XMLRCP_MAX_THREADS threads and XMLRCP_MAX_QUEUED connections waiting), instead of
+    in a new thread. When the queue is full no more connections are accepted until a
+    thread is free. If XMLRCP_MAX_THREADS is 0 a new thread is used for each connection.
+    The handlers release their slot while they wait for their :py:class:`Request`, so the
+    requests are only queued (by priority and user) in the :py:class:`RequestScheduler`.
+    """
+
+    handler_pool = None
+
+    last_handler_pool = None
+    """Pool of the last server created, to show its load in the IM status."""
+
+    def process_request(self, request, client_address):
+        if Config.XMLRCP_MAX_THREADS > 0:
+            if self.handler_pool is None:
+                self.handler_pool = WorkerPool(Config.XMLRCP_MAX_THREADS, Config.XMLRCP_MAX_QUEUED,
+                                               "IM XML-RPC handler")
+                PoolMixIn.last_handler_pool = self.handler_pool
+            self.handler_pool.submit(self.process_request_thread, request, client_address)
+        else:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
 
 
-class AsyncXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+class AsyncXMLRPCServer(PoolMixIn, SimpleXMLRPCServer):
 
     def serve_forever_in_thread(self):
         """
@@ -266,7 +597,7 @@ class AsyncXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
 if Config.XMLRCP_SSL:
     from springpython.remoting.xmlrpc import SSLServer
 
-    class AsyncSSLXMLRPCServer(SocketServer.ThreadingMixIn, SSLServer):
+    class AsyncSSLXMLRPCServer(PoolMixIn, SSLServer):
 
         def __init__(self, *args, **kwargs):
             super(AsyncSSLXMLRPCServer, self).__init__(*args, **kwargs)
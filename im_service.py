@@ -24,12 +24,16 @@ import os
 import signal
 import subprocess
 import time
+import xmlrpclib
+from functools import wraps
 
 from IM.request import Request, AsyncXMLRPCServer, get_system_queue
 from IM.config import Config
 from IM.InfrastructureManager import InfrastructureManager
 from IM.InfrastructureList import InfrastructureList
+from IM.InfrastructureArchive import InfrastructureArchive
 from IM.ServiceRequests import IMBaseRequest
+from IM.admission import get_admission_control, ServiceUnavailableException, FAULT_SERVICE_UNAVAILABLE
 from IM import __version__ as version
 
 if sys.version_info <= (2, 6):
@@ -58,60 +62,90 @@ def WaitRequest(request):
     success = (request.status() == Request.STATUS_PROCESSED)
     return (success, request.get())
 
+
+def admission_control(function):
+    """
+    Decorator to apply the admission control to an API function.
+    The rejected calls return a XML-RPC fault with code FAULT_SERVICE_UNAVAILABLE.
+    """
+    @wraps(function)
+    def wrapper(*args):
+        admission = get_admission_control()
+        api_class = admission.get_api_class(function.__name__)
+        try:
+            admission.acquire(api_class)
+        except ServiceUnavailableException, ex:
+            raise xmlrpclib.Fault(FAULT_SERVICE_UNAVAILABLE, str(ex))
+        try:
+            return function(*args)
+        finally:
+            admission.release(api_class)
+    return wrapper
+
+
 """
 API functions.
 They create the specified request and wait for it.
 """
 
 
-def AddResource(inf_id, radl_data, auth_data, context=True):
+@admission_control
+def AddResource(inf_id, radl_data, auth_data, context=True, idempotency_key=None):
     request = IMBaseRequest.create_request(
-        IMBaseRequest.ADD_RESOURCE, (inf_id, radl_data, auth_data, context))
+        IMBaseRequest.ADD_RESOURCE, (inf_id, radl_data, auth_data, context, idempotency_key))
     return WaitRequest(request)
 
 
+@admission_control
 def RemoveResource(inf_id, vm_list, auth_data, context=True):
     request = IMBaseRequest.create_request(
         IMBaseRequest.REMOVE_RESOURCE, (inf_id, vm_list, auth_data, context))
     return WaitRequest(request)
 
 
+@admission_control
 def GetVMInfo(inf_id, vm_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.GET_VM_INFO, (inf_id, vm_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def GetVMProperty(inf_id, vm_id, property_name, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.GET_VM_PROPERTY, (inf_id, vm_id, property_name, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def AlterVM(inf_id, vm_id, radl, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.ALTER_VM, (inf_id, vm_id, radl, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def GetInfrastructureInfo(inf_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.GET_INFRASTRUCTURE_INFO, (inf_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def StopInfrastructure(inf_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.STOP_INFRASTRUCTURE, (inf_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def StartInfrastructure(inf_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.START_INFRASTRUCTURE, (inf_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def DestroyInfrastructure(inf_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.DESTROY_INFRASTRUCTURE, (inf_id, auth_data))
@@ -120,82 +154,139 @@ def DestroyInfrastructure(inf_id, auth_data):
     return WaitRequest(request)
 
 
-def CreateInfrastructure(radl_data, auth_data):
+@admission_control
+def CreateInfrastructure(radl_data, auth_data, idempotency_key=None):
     request = IMBaseRequest.create_request(
-        IMBaseRequest.CREATE_INFRASTRUCTURE, (radl_data, auth_data))
+        IMBaseRequest.CREATE_INFRASTRUCTURE, (radl_data, auth_data, idempotency_key))
     return WaitRequest(request)
 
 
-def GetInfrastructureList(auth_data):
+@admission_control
+def GetInfrastructureList(auth_data, limit=0, after=None, filters=None):
     request = IMBaseRequest.create_request(
-        IMBaseRequest.GET_INFRASTRUCTURE_LIST, (auth_data))
+        IMBaseRequest.GET_INFRASTRUCTURE_LIST, (auth_data, limit, after, filters))
     return WaitRequest(request)
 
 
+@admission_control
 def Reconfigure(inf_id, radl_data, auth_data, vm_list=None):
     request = IMBaseRequest.create_request(
         IMBaseRequest.RECONFIGURE, (inf_id, radl_data, auth_data, vm_list))
     return WaitRequest(request)
 
 
+@admission_control
 def ImportInfrastructure(str_inf, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.IMPORT_INFRASTRUCTURE, (str_inf, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def ExportInfrastructure(inf_id, delete, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.EXPORT_INFRASTRUCTURE, (inf_id, delete, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def GetInfrastructureRADL(inf_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.GET_INFRASTRUCTURE_RADL, (inf_id, auth_data))
     return WaitRequest(request)
 
 
-def GetVMContMsg(inf_id, vm_id, auth_data):
+@admission_control
+def GetVMContMsg(inf_id, vm_id, auth_data, offset=0, limit=None):
     request = IMBaseRequest.create_request(
-        IMBaseRequest.GET_VM_CONT_MSG, (inf_id, vm_id, auth_data))
+        IMBaseRequest.GET_VM_CONT_MSG, (inf_id, vm_id, auth_data, offset, limit))
     return WaitRequest(request)
 
 
-def GetInfrastructureContMsg(inf_id, auth_data):
+@admission_control
+def GetInfrastructureContMsg(inf_id, auth_data, offset=0, limit=None):
     request = IMBaseRequest.create_request(
-        IMBaseRequest.GET_INFRASTRUCTURE_CONT_MSG, (inf_id, auth_data))
+        IMBaseRequest.GET_INFRASTRUCTURE_CONT_MSG, (inf_id, auth_data, offset, limit))
     return WaitRequest(request)
 
 
+@admission_control
 def StopVM(inf_id, vm_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.STOP_VM, (inf_id, vm_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def StartVM(inf_id, vm_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.START_VM, (inf_id, vm_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
 def GetInfrastructureState(inf_id, auth_data):
     request = IMBaseRequest.create_request(
         IMBaseRequest.GET_INFRASTRUCTURE_STATE, (inf_id, auth_data))
     return WaitRequest(request)
 
 
+@admission_control
+def GetInfrastructuresState(inf_ids, auth_data):
+    request = IMBaseRequest.create_request(
+        IMBaseRequest.GET_INFRASTRUCTURES_STATE, (inf_ids, auth_data))
+    return WaitRequest(request)
+
+
+@admission_control
+def CreateInfrastructureAsync(radl_data, auth_data, idempotency_key=None):
+    request = IMBaseRequest.create_request(
+        IMBaseRequest.CREATE_INFRASTRUCTURE_ASYNC, (radl_data, auth_data, idempotency_key))
+    return WaitRequest(request)
+
+
+@admission_control
+def AddResourceAsync(inf_id, radl_data, auth_data, context=True, idempotency_key=None):
+    request = IMBaseRequest.create_request(
+        IMBaseRequest.ADD_RESOURCE_ASYNC, (inf_id, radl_data, auth_data, context, idempotency_key))
+    return WaitRequest(request)
+
+
+@admission_control
+def GetOperation(op_id, auth_data):
+    request = IMBaseRequest.create_request(
+        IMBaseRequest.GET_OPERATION, (op_id, auth_data))
+    return WaitRequest(request)
+
+
+@admission_control
+def CancelOperation(op_id, auth_data):
+    request = IMBaseRequest.create_request(
+        IMBaseRequest.CANCEL_OPERATION, (op_id, auth_data))
+    return WaitRequest(request)
+
+
+@admission_control
 def GetVersion():
     request = IMBaseRequest.create_request(IMBaseRequest.GET_VERSION, None)
     return WaitRequest(request)
 
 
+def GetStatus():
+    # It is not queued nor limited to show the load even if the IM is overloaded
+    return (True, InfrastructureManager.GetStatus())
+
+
 def launch_daemon():
     """
     Launch the IM daemon
     """
+    InfrastructureManager.set_start_time()
     InfrastructureList.init_table()
+    if Config.INF_WARMUP:
+        InfrastructureList.warm_up()
+    if Config.INF_ARCHIVE_DAYS > 0 or Config.INF_PURGE_DAYS > 0:
+        InfrastructureArchive.start()
 
     if Config.XMLRCP_SSL:
         # if specified launch the secure version
@@ -229,7 +320,13 @@ def launch_daemon():
     server.register_function(StartVM)
     server.register_function(StopVM)
     server.register_function(GetInfrastructureState)
+    server.register_function(GetInfrastructuresState)
+    server.register_function(CreateInfrastructureAsync)
+    server.register_function(AddResourceAsync)
+    server.register_function(GetOperation)
+    server.register_function(CancelOperation)
     server.register_function(GetVersion)
+    server.register_function(GetStatus)
 
     InfrastructureManager.logger.info(
         '************ Start Infrastructure Manager daemon (v.%s) ************' % version)
@@ -0,0 +1,73 @@
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from optparse import OptionParser
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+from IM.InfrastructureList import InfrastructureList
+from IM.InfrastructureArchive import InfrastructureArchive
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]",
+                          description="Archive (and purge) the infrastructures deleted in the IM DB.")
+    parser.add_option("-a", "--archive-days", dest="archive_days", type="int", default=Config.INF_ARCHIVE_DAYS,
+                      help="Archive the infrastructures deleted more than DAYS ago (0 to disable) [%default]",
+                      metavar="DAYS")
+    parser.add_option("-p", "--purge-days", dest="purge_days", type="int", default=Config.INF_PURGE_DAYS,
+                      help="Remove the infrastructures deleted more than DAYS ago (0 to disable) [%default]",
+                      metavar="DAYS")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=Config.INF_ARCHIVE_BATCH_SIZE,
+                      help="Number of infrastructures processed in each transaction [%default]")
+    parser.add_option("-d", "--db", dest="db_url", default=Config.DATA_DB,
+                      help="URL of the DB [DATA_DB of the im.cfg file]")
+    parser.add_option("-e", "--export", dest="inf_id",
+                      help="Print the data of an archived infrastructure (to import it with ImportInfrastructure)")
+    (options, args) = parser.parse_args()
+
+    if not options.db_url:
+        sys.stderr.write("No DATA_DB defined in the im.cfg file!!")
+        sys.exit(-1)
+    if options.batch_size <= 0:
+        sys.stderr.write("Incorrect batch size: %d" % options.batch_size)
+        sys.exit(-1)
+
+    # Upgrade the DB schema to create the archive table
+    Config.DATA_DB = options.db_url
+    if not InfrastructureList.init_table():
+        sys.stderr.write("ERROR connecting with the database!.")
+        sys.exit(-1)
+
+    if options.inf_id:
+        data = InfrastructureArchive.get_archived(options.db_url, options.inf_id)
+        if data is None:
+            sys.stderr.write("Infrastructure %s not found in the archive." % options.inf_id)
+            sys.exit(-1)
+        sys.stdout.write(data + "\n")
+        sys.exit(0)
+
+    # If the archive is disabled the deleted infrastructures are removed directly
+    days = options.archive_days or options.purge_days
+    if days > 0:
+        archived = InfrastructureArchive.archive(options.db_url, days, options.purge_days, options.batch_size)
+        sys.stdout.write("%d infrastructures archived or removed.\n" % archived)
+    if options.purge_days > 0:
+        purged = InfrastructureArchive.purge(options.db_url, options.purge_days, options.batch_size)
+        sys.stdout.write("%d infrastructures removed from the archive.\n" % purged)
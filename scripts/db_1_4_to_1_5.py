@@ -20,7 +20,7 @@ sys.path.append("..")
 sys.path.append(".")
 
 from IM.config import Config
-from IM.db import DataBase
+from IM.db import DataBase, SchemaManager
 import cPickle as pickle
 import time
 import threading
@@ -71,10 +71,28 @@ class DB14to15():
             sys.stderr.write("ERROR connecting with the database!.")
             sys.exit(-1)
 
+    @staticmethod
+    def check_schema_version():
+        """ Refuse to convert a DB already upgraded to the current schema by the IM (its data is not pickled) """
+        db = DataBase(Config.DATA_DB)
+        if db.connect():
+            version = SchemaManager(Config.DATA_DB, []).get_version(db)
+            db.close()
+            if version > 1:
+                sys.stderr.write("The DB has the schema version %d: it has already been converted by the IM."
+                                 " Do not use this script.\n" % version)
+                sys.exit(-1)
+        else:
+            sys.stderr.write("ERROR connecting with the database!.")
+            sys.exit(-1)
+
     @staticmethod
     def rename_old_data():
         db = DataBase(Config.DATA_DB)
         if db.connect():
+            if db.table_exists(SchemaManager.VERSION_TABLE):
+                # only the creation of the table has been applied: create the schema again
+                db.execute("DROP TABLE " + SchemaManager.VERSION_TABLE)
             if db.table_exists("inf_list"):
                 now = str(int(time.time() * 100))
                 if db.db_type == DataBase.SQLITE:
@@ -121,6 +139,7 @@ if __name__ == "__main__":
         sys.stdout.write("Previous table inf_list will be renamed to inf_list_XXXXXX.")
 
     import IM.InfrastructureList
+    DB14to15.check_schema_version()
     inf_list = DB14to15.load_data(data_file)
     DB14to15.rename_old_data()
     # To create the new table
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM import codec
+from IM.auth import Authentication
+from IM.CloudInfo import CloudInfo
+from IM.InfrastructureInfo import InfrastructureInfo
+from IM.connectors.Dummy import DummyCloudConnector
+from radl.radl_parse import parse_radl
+
+NUM_VMS = 50
+NUM_OPS = 20
+# Number of tasks of the contextualization log of each VM
+NUM_TASKS = 200
+
+RADL = """
+network publica (outbound = 'yes')
+system front (
+cpu.count>=1 and
+memory.size>=512m and
+net_interface.0.connection = 'publica' and
+disk.0.os.name = 'linux' and
+disk.0.image.url = 'dummy://image' and
+disk.0.applications contains (name = 'ansible.modules.grycap.slurm')
+)
+deploy front %d
+""" % NUM_VMS
+
+TASK_LOG = """
+TASK [grycap.slurm : Install Slurm packages (%d)] *****************************
+changed: [front_%d] => (item=[u'slurm', u'slurm-munge', u'slurm-plugins'])
+ok: [front_%d] => {"changed": false, "msg": "", "rc": 0, "results": ["munge-0.5.11-3.el7.x86_64 installed"]}
+"""
+
+
+class LoadTestCodec(unittest.TestCase):
+    """
+    Benchmark of the size and the encode/decode time of the data stored in the DB with each codec
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        auth = Authentication([{'id': 'dummy', 'type': 'Dummy'}])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        inf = InfrastructureInfo()
+        inf.auth = Authentication([{'type': 'InfrastructureManager', 'username': 'user', 'password': 'pass'}])
+        radl = parse_radl(RADL)
+        for success, vm in DummyCloudConnector(cloud).launch(inf, radl, radl, NUM_VMS, auth):
+            inf.add_vm(vm)
+            vm.cont_out = "".join(TASK_LOG % (i, vm.im_id, vm.im_id) for i in range(NUM_TASKS))
+        inf.vm_master = inf.vm_list[0]
+        inf.cont_out = "".join(TASK_LOG % (i, 0, 0) for i in range(NUM_TASKS))
+        # The rows stored in the DB (the contextualization logs are stored in their own rows)
+        cls.rows = ([inf.serialize_header(), inf.cont_out] + [vm.serialize() for vm in inf.vm_list] +
+                    [vm.cont_out for vm in inf.vm_list])
+
+    def test_10_codecs(self):
+        """ Compare the size and the encode/decode time of the available codecs """
+        plain_size = sum(len(data) for data in self.rows)
+        for name in sorted(codec.codecs):
+            before = time.time()
+            for _ in range(NUM_OPS):
+                encoded = [codec.encode(data, name) for data in self.rows]
+            encode_time = (time.time() - before) / NUM_OPS
+            before = time.time()
+            for _ in range(NUM_OPS):
+                decoded = [codec.decode(data) for data in encoded]
+            decode_time = (time.time() - before) / NUM_OPS
+            size = sum(len(data) for data in encoded)
+            sys.stdout.write("\n%s: %d KB (%.1f%%), encode %.2f ms, decode %.2f ms (%d VMs)\n" %
+                             (name, size / 1024, size * 100.0 / plain_size, encode_time * 1000,
+                              decode_time * 1000, NUM_VMS))
+            self.assertEqual(decoded, self.rows)
+            if name != "none":
+                self.assertLess(size, plain_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+from IM.db import DataBase
+from IM.auth import Authentication
+from IM.CloudInfo import CloudInfo
+from IM.InfrastructureInfo import InfrastructureInfo
+from IM.InfrastructureList import InfrastructureList
+from IM.connectors.Dummy import DummyCloudConnector
+from radl.radl_parse import parse_radl
+
+NUM_VMS = 200
+NUM_SAVES = 50
+# Size of the contextualization log of each VM
+CONT_OUT_SIZE = 20 * 1024
+
+RADL = """
+network publica (outbound = 'yes')
+system front (
+cpu.count>=1 and
+memory.size>=512m and
+net_interface.0.connection = 'publica' and
+disk.0.os.name = 'linux' and
+disk.0.image.url = 'dummy://image' and
+disk.0.applications contains (name = 'ansible.modules.grycap.slurm')
+)
+deploy front %d
+""" % NUM_VMS
+
+
+class LoadTestInfSave(unittest.TestCase):
+    """
+    Benchmark of the storage of a large infrastructure, changing only one VM between saves
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        (fd, cls.db_file) = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        cls.old_db = Config.DATA_DB
+        Config.DATA_DB = "sqlite://" + cls.db_file
+        InfrastructureList.init_table()
+
+        auth = Authentication([{'id': 'dummy', 'type': 'Dummy'}])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        cls.inf = InfrastructureInfo()
+        cls.inf.auth = Authentication([{'type': 'InfrastructureManager', 'username': 'user', 'password': 'pass'}])
+        radl = parse_radl(RADL)
+        for success, vm in DummyCloudConnector(cloud).launch(cls.inf, radl, radl, NUM_VMS, auth):
+            cls.inf.add_vm(vm)
+            vm.cont_out = "x" * CONT_OUT_SIZE
+        cls.inf.vm_master = cls.inf.vm_list[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        Config.DATA_DB = cls.old_db
+        DataBase.close_pools()
+        os.unlink(cls.db_file)
+
+    def save_ops(self, save):
+        before = time.time()
+        for i in range(NUM_SAVES):
+            self.inf.vm_list[i % NUM_VMS].cont_log.append("Task %d: ok\n" % i)
+            save()
+        return (time.time() - before) / NUM_SAVES
+
+    def save_blob(self):
+        """ Save the whole infrastructure in a single blob (previous storage layout) """
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        db.execute("replace into inf_list (id, deleted, data, date) values (%s, %s, %s, now())",
+                   (self.inf.id, 0, self.inf.serialize()))
+        db.close()
+
+    def save_rows(self):
+        """ Save only the changed rows """
+        InfrastructureList._save_data_to_db(Config.DATA_DB, {self.inf.id: self.inf})
+
+    def test_10_save(self):
+        """ Compare the whole blob rewrite against the per-VM rows storage """
+        blob_size = len(self.inf.serialize())
+        blob = self.save_ops(self.save_blob)
+        # first save writes all the rows
+        self.save_rows()
+        rows = self.save_ops(self.save_rows)
+        rows_size = len(self.inf.serialize_header()) + len(self.inf.vm_list[0].serialize())
+        sys.stdout.write("\n%d VMs: blob rewrite %.2f ms/save (%d KB written), "
+                         "per-VM rows %.2f ms/save (%d KB written)\n" %
+                         (NUM_VMS, blob * 1000, blob_size / 1024, rows * 1000, rows_size / 1024))
+        self.assertLess(rows, blob)
+
+    def test_20_load(self):
+        """ Time to load the infrastructure from the per-VM rows """
+        before = time.time()
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, self.inf.id)
+        sys.stdout.write("\nLoad %d VMs: %.2f ms\n" % (NUM_VMS, (time.time() - before) * 1000))
+        self.assertEqual(len(res[self.inf.id].vm_list), NUM_VMS)
+
+
+if __name__ == '__main__':
+    unittest.main()
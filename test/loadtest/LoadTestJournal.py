@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+from IM.db import DataBase
+from IM.auth import Authentication
+from IM.CloudInfo import CloudInfo
+from IM.InfrastructureInfo import InfrastructureInfo
+from IM.InfrastructureList import InfrastructureList
+from IM.journal import JournalStore
+from IM.connectors.Dummy import DummyCloudConnector
+from radl.radl_parse import parse_radl
+
+NUM_THREADS = 20
+NUM_SAVES = 50
+NUM_VMS = 5
+
+RADL = """
+network publica (outbound = 'yes')
+system front (
+cpu.count>=1 and
+memory.size>=512m and
+net_interface.0.connection = 'publica' and
+disk.0.os.name = 'linux' and
+disk.0.image.url = 'dummy://image'
+)
+deploy front %d
+""" % NUM_VMS
+
+
+class LoadTestJournal(unittest.TestCase):
+    """
+    Benchmark of concurrent saves of infrastructures (as the ones of the ConfManager threads)
+    in a SQLite DB and in a journal
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.old_db = Config.DATA_DB
+        auth = Authentication([{'id': 'dummy', 'type': 'Dummy'}])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = parse_radl(RADL)
+        cls.infs = []
+        for _ in range(NUM_THREADS):
+            inf = InfrastructureInfo()
+            inf.auth = Authentication([{'type': 'InfrastructureManager', 'username': 'user', 'password': 'pass'}])
+            for success, vm in DummyCloudConnector(cloud).launch(inf, radl, radl, NUM_VMS, auth):
+                inf.add_vm(vm)
+            inf.vm_master = inf.vm_list[0]
+            cls.infs.append(inf)
+
+    @classmethod
+    def tearDownClass(cls):
+        Config.DATA_DB = cls.old_db
+        DataBase.close_pools()
+        JournalStore.close_all()
+        shutil.rmtree(cls.tmp_dir)
+
+    def save_ops(self, db_url):
+        """ Save the infrastructures concurrently, returning the throughput and the latencies """
+        Config.DATA_DB = db_url
+        InfrastructureList.init_table()
+        InfrastructureList._saved_digests = {}
+        times = []
+        errors = []
+
+        def save(inf):
+            try:
+                for i in range(NUM_SAVES):
+                    inf.vm_list[i % NUM_VMS].cont_log.append("Task %d: ok\n" % i)
+                    before = time.time()
+                    InfrastructureList._save_data_to_db(db_url, {inf.id: inf})
+                    times.append(time.time() - before)
+            except Exception, ex:
+                errors.append(ex)
+
+        before = time.time()
+        threads = [threading.Thread(target=save, args=(inf,)) for inf in self.infs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total = time.time() - before
+        self.assertEqual(errors, [])
+        times.sort()
+        return len(times) / total, times[len(times) / 2], times[int(len(times) * 0.99)]
+
+    def test_10_saves(self):
+        """ Compare the concurrent saves in SQLite and in the journal """
+        res = {}
+        for name, db_url in [("sqlite", "sqlite://" + os.path.join(self.tmp_dir, "inf.db")),
+                             ("journal", "journal://" + os.path.join(self.tmp_dir, "inf.jdb"))]:
+            res[name] = self.save_ops(db_url)
+            sys.stdout.write("\n%s: %.0f saves/s, p50 %.2f ms, p99 %.2f ms (%d threads)\n" %
+                             (name, res[name][0], res[name][1] * 1000, res[name][2] * 1000, NUM_THREADS))
+        self.assertGreater(res["journal"][0], res["sqlite"][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.InfrastructureInfo import InfrastructureInfo
+from IM.VirtualMachine import VirtualMachine
+from IM.CloudInfo import CloudInfo
+from radl.radl_parse import parse_radl
+
+NUM_VMS = 200
+TESTS_PATH = os.path.dirname(os.path.realpath(__file__))
+
+
+class LoadTestLazyRADL(unittest.TestCase):
+    """
+    Microbenchmark of the load time of the VMs of an infrastructure
+    with the RADL parsed eagerly (as before) or lazily
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        radl = parse_radl(open(os.path.join(TESTS_PATH, "load-test.radl")).read())
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        inf = InfrastructureInfo()
+        inf.radl = radl
+        for i in range(NUM_VMS):
+            inf.add_vm(VirtualMachine(inf, str(i), cloud, radl, radl))
+        # serialize it again to get the values set in the deserialization
+        cls.data = InfrastructureInfo.deserialize(inf.serialize()).serialize()
+
+    def load(self, eager):
+        before = time.time()
+        inf = InfrastructureInfo.deserialize(self.data)
+        if eager:
+            # force the parsing of all the RADLs
+            inf.radl
+            for vm in inf.vm_list:
+                vm.info
+                vm.requested_radl
+        # what a call like GetInfrastructureState needs
+        states = [vm.state for vm in inf.vm_list]
+        self.assertEqual(len(states), NUM_VMS)
+        return inf, (time.time() - before) / NUM_VMS
+
+    def test_10_load(self):
+        """ Compare the load time per VM """
+        _, eager = self.load(True)
+        _, lazy = self.load(False)
+        sys.stdout.write("\nLoad: eager %.3f ms/VM, lazy %.3f ms/VM (x%.1f)\n" %
+                         (eager * 1000, lazy * 1000, eager / lazy))
+        self.assertLess(lazy, eager)
+
+    def test_20_reserialize(self):
+        """ Compare the serialization time per VM of a loaded infrastructure """
+        inf, _ = self.load(True)
+        before = time.time()
+        self.assertTrue(inf.serialize())
+        eager = (time.time() - before) / NUM_VMS
+
+        inf, _ = self.load(False)
+        before = time.time()
+        # the original RADL texts are maintained
+        data = inf.serialize()
+        lazy = (time.time() - before) / NUM_VMS
+        self.assertEqual([json.loads(vm_data) for vm_data in json.loads(data)['vm_list']],
+                         [json.loads(vm_data) for vm_data in json.loads(self.data)['vm_list']])
+        sys.stdout.write("\nSerialize: eager %.3f ms/VM, lazy %.3f ms/VM (x%.1f)\n" %
+                         (eager * 1000, lazy * 1000, eager / lazy))
+        self.assertLess(lazy, eager)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import sys
+import threading
+import time
+import unittest
+import requests
+from mock import patch
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+import IM.REST
+
+NUM_CLIENTS = 10
+NUM_REQUESTS = 50
+# Number of tasks of the contextualization log
+NUM_TASKS = 1000
+
+TASK_LOG = """
+TASK [grycap.slurm : Install Slurm packages (%d)] *****************************
+changed: [front] => (item=[u'slurm', u'slurm-munge', u'slurm-plugins'])
+ok: [front] => {"changed": false, "msg": "", "rc": 0, "results": ["munge-0.5.11-3.el7.x86_64 installed"]}
+"""
+CONT_MSG = "".join(TASK_LOG % i for i in range(NUM_TASKS))
+AUTH = "type = InfrastructureManager; username = user; password = pass"
+
+
+class LoadTestRESTServer(unittest.TestCase):
+    """
+    Benchmark of the REST server getting a big contextualization log (contmsg)
+    with and without HTTP keep-alive and response compression
+    """
+
+    def run_server(self, keep_alive):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with patch.object(Config, "REST_KEEP_ALIVE", keep_alive):
+            server = IM.REST.create_cherrypy_server("127.0.0.1", port, IM.REST.app)
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        while not server.ready:
+            time.sleep(0.01)
+        return server, "http://127.0.0.1:%d/infrastructures/1/contmsg" % port
+
+    def run_clients(self, url, encoding):
+        sizes = []
+        times = []
+
+        def client():
+            session = requests.Session()
+            for _ in range(NUM_REQUESTS):
+                before = time.time()
+                resp = session.get(url, headers={"AUTHORIZATION": AUTH, "Accept-Encoding": encoding})
+                times.append(time.time() - before)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(len(resp.content), len(CONT_MSG))
+                sizes.append(int(resp.headers["Content-Length"]))
+
+        threads = [threading.Thread(target=client) for _ in range(NUM_CLIENTS)]
+        before = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total = time.time() - before
+        times.sort()
+        return len(times) / total, times[int(len(times) * 0.99) - 1], sum(sizes)
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureContMsg")
+    def test_10_rest_server(self, GetInfrastructureContMsg):
+        """ Compare the throughput and the bytes sent with each configuration """
+        GetInfrastructureContMsg.return_value = CONT_MSG
+        for keep_alive in [False, True]:
+            server, url = self.run_server(keep_alive)
+            try:
+                for encoding in ["identity", "gzip"]:
+                    throughput, p99, size = self.run_clients(url, encoding)
+                    sys.stdout.write("\nkeep-alive %s, %s: %.1f req/s, p99 %.1f ms, %.1f MB sent"
+                                     " (%d clients, %d KB log)\n" %
+                                     (keep_alive, encoding, throughput, p99 * 1000, size / 1048576.0,
+                                      NUM_CLIENTS, len(CONT_MSG) / 1024))
+            finally:
+                server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,6 +20,9 @@ import os
 import json
 import unittest
 import sys
+import threading
+import bottle
+import zlib
 from mock import patch, MagicMock
 
 sys.path.append("..")
@@ -43,7 +46,13 @@ from IM.REST import (RESTDestroyInfrastructure,
                      RESTStopInfrastructure,
                      RESTStartVM,
                      RESTStopVM,
-                     RESTGeVersion)
+                     RESTGeVersion,
+                     RESTGetStatus,
+                     RESTGetInfrastructureEvents,
+                     RESTGetOperation,
+                     RESTCancelOperation,
+                     create_cherrypy_server)
+from IM.admission import AdmissionControl, ServiceUnavailableException
 
 
 def read_file_as_string(file_name):
@@ -83,6 +92,75 @@ class TestREST(unittest.TestCase):
         self.assertEqual(res, ('{"uri-list": [{"uri": "http://imserver.com/infrastructures/1"},'
                                ' {"uri": "http://imserver.com/infrastructures/2"}]}'))
 
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureList")
+    @patch("bottle.request")
+    def test_GetInfrastructureList_pages(self, bottle_request, GetInfrastructureList):
+        """Test REST GetInfrastructureList with pagination and filters."""
+        bottle_request.environ = {'HTTP_HOST': 'imserver.com'}
+        bottle_request.headers = {"AUTHORIZATION": "type = InfrastructureManager; username = user; password = pass"}
+        bottle_request.params = {"limit": "2", "state": "running", "deleted": "no"}
+        GetInfrastructureList.return_value = ["3", "2"]
+        bottle.response.bind()
+        res = RESTGetInfrastructureList()
+        self.assertEqual(res, ("http://imserver.com/infrastructures/3\n"
+                               "http://imserver.com/infrastructures/2"))
+        self.assertEqual(GetInfrastructureList.call_args[0][1:], (2, None, {"state": "running"}))
+        self.assertEqual(bottle.response.get_header("Link"),
+                         '<http://imserver.com/infrastructures?after=2&deleted=no&limit=2&state=running>; rel="next"')
+
+        # the last page
+        bottle_request.params = {"limit": "2", "after": "2", "deleted": "yes", "created_after": "2017-01-01"}
+        GetInfrastructureList.return_value = ["1"]
+        bottle.response.bind()
+        res = RESTGetInfrastructureList()
+        self.assertEqual(res, "http://imserver.com/infrastructures/1")
+        self.assertEqual(GetInfrastructureList.call_args[0][1:], (2, "2", {"deleted": True,
+                                                                          "created_after": "2017-01-01"}))
+        self.assertIsNone(bottle.response.get_header("Link"))
+
+        for params in [{"limit": "-1"}, {"limit": "a"}, {"deleted": "maybe"}]:
+            bottle_request.params = params
+            RESTGetInfrastructureList()
+            self.assertEqual(bottle.response.status_code, 400)
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructuresState")
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureList")
+    @patch("bottle.request")
+    def test_GetInfrastructureList_state(self, bottle_request, GetInfrastructureList, GetInfrastructuresState):
+        """Test REST GetInfrastructureList with the state of the infrastructures."""
+        bottle_request.environ = {'HTTP_HOST': 'imserver.com'}
+        bottle_request.headers = {"AUTHORIZATION": "type = InfrastructureManager; username = user; password = pass"}
+        bottle_request.params = {"fields": "state"}
+        GetInfrastructureList.return_value = ["2", "1"]
+        GetInfrastructuresState.return_value = {"1": {"state": "running", "vm_states": {"0": "running"},
+                                                      "stale": False},
+                                                "2": {"error": "Access to this infrastructure not granted."}}
+        res = json.loads(RESTGetInfrastructureList())
+        self.assertEqual(res, {"infrastructures": [{"uri": "http://imserver.com/infrastructures/2",
+                                                    "error": "Access to this infrastructure not granted."},
+                                                   {"uri": "http://imserver.com/infrastructures/1",
+                                                    "state": "running", "vm_states": {"0": "running"},
+                                                    "stale": False}]})
+
+        bottle_request.params = {"fields": "state", "ids": "1"}
+        GetInfrastructureList.reset_mock()
+        res = json.loads(RESTGetInfrastructureList())
+        self.assertEqual([inf["uri"] for inf in res["infrastructures"]], ["http://imserver.com/infrastructures/1"])
+        self.assertEqual(GetInfrastructuresState.call_args[0][0], ["1"])
+        self.assertEqual(GetInfrastructureList.call_count, 0)
+
+        # an empty page does not get the state of all the infrastructures
+        bottle_request.params = {"fields": "state", "state": "running"}
+        GetInfrastructureList.return_value = []
+        GetInfrastructuresState.reset_mock()
+        res = json.loads(RESTGetInfrastructureList())
+        self.assertEqual(res, {"infrastructures": []})
+        self.assertEqual(GetInfrastructuresState.call_count, 0)
+
+        bottle_request.params = {"fields": "radl"}
+        RESTGetInfrastructureList()
+        self.assertEqual(bottle.response.status_code, 400)
+
     @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureInfo")
     @patch("bottle.request")
     def test_GetInfrastructureInfo(self, bottle_request, GetInfrastructureInfo):
@@ -119,6 +197,13 @@ class TestREST(unittest.TestCase):
         res = RESTGetInfrastructureProperty("1", "contmsg")
         self.assertEqual(res, "contmsg")
 
+        bottle_request.params = {'offset': '10', 'limit': '20'}
+        res = RESTGetInfrastructureProperty("1", "contmsg")
+        self.assertEqual(GetInfrastructureContMsg.call_args[0][2:], (10, 20))
+        bottle_request.params = {'offset': 'a'}
+        res = RESTGetInfrastructureProperty("1", "contmsg")
+        self.assertEqual(res, "Incorrect value in offset or limit parameters")
+
         res = RESTGetInfrastructureProperty("1", "radl")
         self.assertEqual(res, "radl")
 
@@ -161,6 +246,90 @@ class TestREST(unittest.TestCase):
 
         CreateInfrastructure.return_value = "1"
 
+    @patch("IM.InfrastructureManager.InfrastructureManager.AddResourceAsync")
+    @patch("IM.InfrastructureManager.InfrastructureManager.CreateInfrastructureAsync")
+    @patch("bottle.request")
+    def test_CreateInfrastructure_async(self, bottle_request, CreateInfrastructureAsync, AddResourceAsync):
+        """Test REST CreateInfrastructure and AddResource in async mode."""
+        bottle_request.environ = {'HTTP_HOST': 'imserver.com'}
+        bottle_request.headers = {"AUTHORIZATION": "type = InfrastructureManager; username = user; password = pass"}
+        bottle_request.body.read.return_value = "radl"
+        bottle_request.params = {'async': 'yes'}
+        op = {"id": "op1", "inf_id": "1", "type": "CreateInfrastructure", "state": "queued", "cancelled": False}
+        CreateInfrastructureAsync.return_value = op
+
+        bottle.response.bind()
+        res = json.loads(RESTCreateInfrastructure())
+        self.assertEqual(bottle.response.status_code, 202)
+        self.assertEqual(bottle.response.get_header("Location"), "http://imserver.com/operations/op1")
+        self.assertEqual(bottle.response.get_header("InfID"), "1")
+        self.assertEqual(res["operation"]["inf_uri"], "http://imserver.com/infrastructures/1")
+        self.assertEqual(res["operation"]["state"], "queued")
+
+        AddResourceAsync.return_value = dict(op, type="AddResource")
+        bottle_request.params = {'async': '1', 'context': 'no'}
+        bottle.response.bind()
+        res = json.loads(RESTAddResource("1"))
+        self.assertEqual(bottle.response.status_code, 202)
+        self.assertEqual(res["operation"]["uri"], "http://imserver.com/operations/op1")
+        self.assertEqual(AddResourceAsync.call_args[0][3], False)
+
+        bottle_request.params = {'async': 'maybe'}
+        RESTCreateInfrastructure()
+        self.assertEqual(bottle.response.status_code, 400)
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.AddResource")
+    @patch("IM.InfrastructureManager.InfrastructureManager.CreateInfrastructure")
+    @patch("bottle.request")
+    def test_idempotency_key(self, bottle_request, CreateInfrastructure, AddResource):
+        """Test the Idempotency-Key header of REST CreateInfrastructure and AddResource."""
+        from IM.idempotency import IdempotencyKeyConflictException
+        bottle_request.environ = {'HTTP_HOST': 'imserver.com'}
+        bottle_request.headers = {"AUTHORIZATION": "type = InfrastructureManager; username = user; password = pass",
+                                  "Idempotency-Key": "key1"}
+        bottle_request.body.read.return_value = "radl"
+        bottle_request.params = {}
+        CreateInfrastructure.return_value = "1"
+
+        res = RESTCreateInfrastructure()
+        self.assertEqual(res, "http://imserver.com/infrastructures/1")
+        self.assertEqual(CreateInfrastructure.call_args[0][2], "key1")
+
+        AddResource.side_effect = IdempotencyKeyConflictException()
+        bottle.response.bind()
+        res = RESTAddResource("1")
+        self.assertEqual(bottle.response.status_code, 409)
+        self.assertEqual(res, "Error Adding resources: The idempotency key is in use.")
+        self.assertEqual(AddResource.call_args[1]['idempotency_key'], "key1")
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.CancelOperation")
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetOperation")
+    @patch("bottle.request")
+    def test_Operation(self, bottle_request, GetOperation, CancelOperation):
+        """Test REST GetOperation and CancelOperation."""
+        from IM.InfrastructureManager import IncorrectOperationException, UnauthorizedUserException
+        bottle_request.environ = {'HTTP_HOST': 'imserver.com'}
+        bottle_request.headers = {"AUTHORIZATION": "type = InfrastructureManager; username = user; password = pass"}
+        op = {"id": "op1", "inf_id": "1", "type": "CreateInfrastructure", "state": "finished",
+              "cancelled": False, "result": [0, 1]}
+        GetOperation.return_value = op
+        bottle.response.bind()
+        res = json.loads(RESTGetOperation("op1"))
+        self.assertEqual(bottle.response.status_code, 200)
+        self.assertEqual(res["operation"]["result"], [0, 1])
+        self.assertEqual(GetOperation.call_args[0][0], "op1")
+
+        CancelOperation.return_value = dict(op, state="running", cancelled=True)
+        res = json.loads(RESTCancelOperation("op1"))
+        self.assertTrue(res["operation"]["cancelled"])
+
+        GetOperation.side_effect = IncorrectOperationException()
+        RESTGetOperation("op2")
+        self.assertEqual(bottle.response.status_code, 404)
+        CancelOperation.side_effect = UnauthorizedUserException()
+        RESTCancelOperation("op1")
+        self.assertEqual(bottle.response.status_code, 403)
+
     @patch("IM.InfrastructureManager.InfrastructureManager.GetVMInfo")
     @patch("bottle.request")
     def test_GetVMInfo(self, bottle_request, GetVMInfo):
@@ -199,6 +368,10 @@ class TestREST(unittest.TestCase):
         res = RESTGetVMProperty("1", "1", "contmsg")
         self.assertEqual(res, "contmsg")
 
+        bottle_request.params = {'offset': '-100'}
+        res = RESTGetVMProperty("1", "1", "contmsg")
+        self.assertEqual(GetVMContMsg.call_args[0][3:], (-100, None))
+
     @patch("IM.InfrastructureManager.InfrastructureManager.AddResource")
     @patch("bottle.request")
     def test_AddResource(self, bottle_request, AddResource):
@@ -299,10 +472,11 @@ class TestREST(unittest.TestCase):
                                                     "id = one; type = OpenNebula; host = onedock.i3m.upv.es:2633; "
                                                     "username = user; password = pass")}
 
-        StartInfrastructure.return_value = ""
+        StartInfrastructure.side_effect = lambda inf_id, auth: threading.current_thread().name
 
+        # executed in the request pool, as the XML-RPC calls
         res = RESTStartInfrastructure("1")
-        self.assertEqual(res, "")
+        self.assertTrue(res.startswith("IM request"))
 
     @patch("IM.InfrastructureManager.InfrastructureManager.StopInfrastructure")
     @patch("bottle.request")
@@ -352,6 +526,196 @@ class TestREST(unittest.TestCase):
         res = RESTGeVersion()
         self.assertEqual(res, version)
 
+    @patch("IM.InfrastructureManager.InfrastructureManager.CreateInfrastructureAsync")
+    @patch("IM.InfrastructureManager.InfrastructureManager.CreateInfrastructure")
+    @patch("IM.REST.get_admission_control")
+    @patch("bottle.request")
+    def test_admission_control(self, bottle_request, get_admission_control, CreateInfrastructure,
+                               CreateInfrastructureAsync):
+        """Test the rejection of the REST calls when the IM is overloaded."""
+        bottle_request.headers = {"AUTHORIZATION": "type = InfrastructureManager; username = user; password = pass"}
+        bottle_request.params = {}
+        admission = AdmissionControl({"deploy": 1}, retry_after=20)
+        get_admission_control.return_value = admission
+        admission.acquire("deploy")
+
+        res = RESTCreateInfrastructure()
+        self.assertEqual(bottle.response.status_code, 503)
+        self.assertEqual(bottle.response.get_header("Retry-After"), "20")
+        self.assertIn("Service unavailable", res)
+        self.assertEqual(CreateInfrastructure.call_count, 0)
+
+        # the async calls are classified as CreateInfrastructureAsync, as in the XML-RPC API
+        bottle.response.bind()
+        bottle_request.environ = {'HTTP_HOST': 'imserver.com'}
+        bottle_request.body.read.return_value = "radl"
+        bottle_request.params = {'async': 'yes'}
+        CreateInfrastructureAsync.return_value = {"id": "op1", "inf_id": "1", "type": "CreateInfrastructure",
+                                                  "state": "queued", "cancelled": False}
+        RESTCreateInfrastructure()
+        self.assertEqual(bottle.response.status_code, 202)
+        self.assertEqual(admission.stats()["operation"]["admitted"], 1)
+
+        # the reads are not limited
+        bottle.response.status = 200
+        RESTGeVersion()
+        self.assertEqual(bottle.response.status_code, 200)
+        self.assertEqual(admission.stats()["read"]["active"], 0)
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureContMsg")
+    @patch("bottle.request")
+    def test_compression(self, bottle_request, GetInfrastructureContMsg):
+        """Test the compression of the REST responses."""
+        cont_msg = "TASK [Install packages] ***\nok: [front]\n" * 100
+        GetInfrastructureContMsg.return_value = cont_msg
+        auth = "type = InfrastructureManager; username = user; password = pass"
+
+        for accept_encoding, encoding, decompress in [("gzip, deflate", "gzip", lambda x: zlib.decompress(x, 31)),
+                                                      ("deflate;q=1, gzip;q=0", "deflate", zlib.decompress)]:
+            bottle.response.bind()
+            bottle_request.headers = {"AUTHORIZATION": auth, "Accept-Encoding": accept_encoding}
+            res = RESTGetInfrastructureProperty("1", "contmsg")
+            self.assertEqual(bottle.response.get_header("Content-Encoding"), encoding)
+            self.assertEqual(bottle.response.get_header("Vary"), "Accept-Encoding")
+            self.assertLess(len(res), len(cont_msg) / 10)
+            self.assertEqual(decompress(res), cont_msg)
+
+        bottle.response.bind()
+        bottle_request.headers = {"AUTHORIZATION": auth, "Accept-Encoding": "gzip;q=0, identity"}
+        self.assertEqual(RESTGetInfrastructureProperty("1", "contmsg"), cont_msg)
+        self.assertIsNone(bottle.response.get_header("Content-Encoding"))
+
+        # small responses are not compressed
+        GetInfrastructureContMsg.return_value = "small"
+        bottle_request.headers = {"AUTHORIZATION": auth, "Accept-Encoding": "gzip"}
+        self.assertEqual(RESTGetInfrastructureProperty("1", "contmsg"), "small")
+        self.assertIsNone(bottle.response.get_header("Content-Encoding"))
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureState")
+    @patch("IM.InfrastructureManager.InfrastructureManager.get_change_counters")
+    @patch("bottle.request")
+    def test_etag(self, bottle_request, get_change_counters, GetInfrastructureState):
+        """Test the conditional GETs with ETags."""
+        GetInfrastructureState.return_value = {'state': "running", 'vm_states': {"vm1": "running"}}
+        get_change_counters.return_value = (1, 0, (1, 0))
+        auth = "type = InfrastructureManager; username = user; password = pass"
+        bottle_request.path = "/infrastructures/1/state"
+        bottle_request.query_string = ""
+        bottle_request.headers = {"AUTHORIZATION": auth}
+
+        bottle.response.bind()
+        res = RESTGetInfrastructureProperty("1", "state")
+        self.assertEqual(json.loads(res)["state"]["state"], "running")
+        etag = bottle.response.get_header("ETag")
+        self.assertTrue(etag)
+        # the ETag is checked only with fresh states, and it is set again after updating them
+        self.assertTrue(get_change_counters.call_args_list[0][0][3])
+        self.assertFalse(get_change_counters.call_args_list[1][0][3])
+
+        bottle.response.bind()
+        bottle_request.headers = {"AUTHORIZATION": auth, "If-None-Match": "W/%s" % etag}
+        self.assertEqual(RESTGetInfrastructureProperty("1", "state"), "")
+        self.assertEqual(bottle.response.status_code, 304)
+        self.assertEqual(bottle.response.get_header("ETag"), etag)
+        self.assertEqual(GetInfrastructureState.call_count, 1)
+
+        # a change in the infrastructure (or in the representation) changes the ETag
+        get_change_counters.return_value = (1, 0, (2, 0))
+        bottle.response.bind()
+        self.assertEqual(json.loads(RESTGetInfrastructureProperty("1", "state"))["state"]["state"], "running")
+        self.assertEqual(bottle.response.status_code, 200)
+        self.assertNotEqual(bottle.response.get_header("ETag"), etag)
+
+        bottle.response.bind()
+        bottle_request.headers = {"AUTHORIZATION": auth, "If-None-Match": etag, "Accept": "application/json"}
+        self.assertNotEqual(RESTGetInfrastructureProperty("1", "state"), "")
+        self.assertEqual(bottle.response.status_code, 200)
+
+        # the states must be updated: the state is returned with the ETag after the update
+        get_change_counters.side_effect = lambda inf_id, auth, vm_id, fresh: None if fresh else (1, 0, (3, 0))
+        bottle.response.bind()
+        bottle_request.headers = {"AUTHORIZATION": auth, "If-None-Match": etag}
+        self.assertNotEqual(RESTGetInfrastructureProperty("1", "state"), "")
+        self.assertEqual(bottle.response.status_code, 200)
+        self.assertTrue(bottle.response.get_header("ETag"))
+        self.assertNotEqual(bottle.response.get_header("ETag"), etag)
+
+        # no ETag if the counters cannot be obtained
+        get_change_counters.side_effect = Exception("Invalid infrastructure ID or access not granted.")
+        bottle.response.bind()
+        RESTGetInfrastructureProperty("1", "state")
+        self.assertIsNone(bottle.response.get_header("ETag"))
+
+    @patch("IM.InfrastructureManager.InfrastructureManager.GetInfrastructureEvents")
+    @patch("IM.REST.get_admission_control")
+    @patch("bottle.request")
+    def test_GetInfrastructureEvents(self, bottle_request, get_admission_control, GetInfrastructureEvents):
+        """Test REST GetInfrastructureEvents."""
+        admission = AdmissionControl()
+        get_admission_control.return_value = admission
+        auth = "type = InfrastructureManager; username = user; password = pass"
+        bottle_request.headers = {"AUTHORIZATION": auth}
+        bottle_request.params = {"after": "10", "wait": "5"}
+        GetInfrastructureEvents.return_value = [{"id": 11, "type": "contmsg", "data": {"msg": "msg"}}]
+
+        res = RESTGetInfrastructureEvents("1")
+        self.assertEqual(json.loads(res), {"events": [{"id": 11, "type": "contmsg", "data": {"msg": "msg"}}]})
+        self.assertEqual(GetInfrastructureEvents.call_args[0][2:], (10, 5))
+
+        bottle_request.params = {"after": "a"}
+        RESTGetInfrastructureEvents("1")
+        self.assertEqual(bottle.response.status_code, 400)
+
+        # Server-sent events
+        bottle.response.bind()
+        bottle_request.params = {}
+        bottle_request.headers = {"AUTHORIZATION": auth, "Accept": "text/event-stream", "Last-Event-ID": "11"}
+        GetInfrastructureEvents.side_effect = [[],
+                                               [],
+                                               [{"id": 12, "type": "vm_state", "data": {"vm_id": "0", "state": "off"}},
+                                                {"id": 13, "type": "deleted", "data": None}]]
+        res = RESTGetInfrastructureEvents("1")
+        self.assertEqual(bottle.response.content_type, "text/event-stream")
+        # the stream is in process until it ends
+        self.assertEqual(admission.stats()["read"]["active"], 1)
+        self.assertEqual(list(res), [': keep-alive\n\n',
+                                     'id: 12\nevent: vm_state\ndata: {"state": "off", "vm_id": "0"}\n\n',
+                                     'id: 13\nevent: deleted\ndata: null\n\n'])
+        self.assertEqual([call[0][2] for call in GetInfrastructureEvents.call_args_list[-3:]], [11, 11, 11])
+        self.assertEqual(admission.stats()["read"]["active"], 0)
+
+        # too many clients waiting
+        bottle_request.headers = {"AUTHORIZATION": auth}
+        bottle_request.params = {"after": "10"}
+        GetInfrastructureEvents.side_effect = ServiceUnavailableException("Too many clients waiting", 30)
+        RESTGetInfrastructureEvents("1")
+        self.assertEqual(bottle.response.status_code, 503)
+        self.assertEqual(bottle.response.get_header("Retry-After"), "30")
+        self.assertEqual(admission.stats()["read"]["active"], 0)
+
+    @patch("IM.REST.Config")
+    def test_server_options(self, config):
+        """Test the creation of the REST server with the config options."""
+        config.REST_THREADS = 4
+        config.REST_QUEUE_SIZE = 8
+        config.REST_SOCKET_TIMEOUT = 3
+        config.REST_KEEP_ALIVE = True
+        server = create_cherrypy_server("127.0.0.1", 0, None)
+        self.assertEqual((server.requests.min, server.request_queue_size, server.timeout), (4, 8, 3))
+        self.assertFalse(server.ConnectionClass.RequestHandlerClass.close_connection)
+
+        config.REST_KEEP_ALIVE = False
+        server = create_cherrypy_server("127.0.0.1", 0, None)
+        self.assertTrue(server.ConnectionClass.RequestHandlerClass.close_connection)
+
+    def test_GetStatus(self):
+        """Test REST GetStatus."""
+        res = json.loads(RESTGetStatus())
+        self.assertIn("deploy", res["admission"])
+        self.assertIn("busy", res["requests"])
+        self.assertIn("entries", res["inf_cache"])
+        self.assertIn("hits", res["radl_cache"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -29,7 +29,7 @@ class TestServiceRequests(unittest.TestCase):
     def test_add_resource(self, inflist):
         import IM.ServiceRequests
         req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.ADD_RESOURCE,
-                                                              ("", "", "", ""))
+                                                              ("", "", "", "", None))
         req._call_function()
 
     @patch('IM.InfrastructureManager.InfrastructureManager')
@@ -43,7 +43,7 @@ class TestServiceRequests(unittest.TestCase):
     def test_create(self, inflist):
         import IM.ServiceRequests
         req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.CREATE_INFRASTRUCTURE,
-                                                              ("", ""))
+                                                              ("", "", None))
         req._call_function()
 
     @patch('IM.InfrastructureManager.InfrastructureManager')
@@ -65,7 +65,7 @@ class TestServiceRequests(unittest.TestCase):
         import IM.ServiceRequests
         req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.
                                                               IMBaseRequest.GET_INFRASTRUCTURE_CONT_MSG,
-                                                              ("", ""))
+                                                              ("", "", 0, None))
         req._call_function()
 
     @patch('IM.InfrastructureManager.InfrastructureManager')
@@ -79,7 +79,7 @@ class TestServiceRequests(unittest.TestCase):
     def test_list(self, inflist):
         import IM.ServiceRequests
         req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.GET_INFRASTRUCTURE_LIST,
-                                                              (""))
+                                                              ("", 0, None, None))
         req._call_function()
 
     @patch('IM.InfrastructureManager.InfrastructureManager')
@@ -96,11 +96,18 @@ class TestServiceRequests(unittest.TestCase):
                                                               ("", ""))
         req._call_function()
 
+    @patch('IM.InfrastructureManager.InfrastructureManager')
+    def test_getstates(self, inflist):
+        import IM.ServiceRequests
+        req = IM.ServiceRequests.IMBaseRequest.create_request(
+            IM.ServiceRequests.IMBaseRequest.GET_INFRASTRUCTURES_STATE, ([], ""))
+        req._call_function()
+
     @patch('IM.InfrastructureManager.InfrastructureManager')
     def test_vm_contmsg(self, inflist):
         import IM.ServiceRequests
         req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.GET_VM_CONT_MSG,
-                                                              ("", "", ""))
+                                                              ("", "", "", 0, None))
         req._call_function()
 
     @patch('IM.InfrastructureManager.InfrastructureManager')
@@ -166,11 +173,96 @@ class TestServiceRequests(unittest.TestCase):
                                                               ("", "", ""))
         req._call_function()
 
+    @patch('IM.InfrastructureManager.InfrastructureManager')
+    def test_operations(self, inflist):
+        import IM.ServiceRequests
+        req = IM.ServiceRequests.IMBaseRequest.create_request(
+            IM.ServiceRequests.IMBaseRequest.CREATE_INFRASTRUCTURE_ASYNC, ("", "", None))
+        req._call_function()
+        req = IM.ServiceRequests.IMBaseRequest.create_request(
+            IM.ServiceRequests.IMBaseRequest.ADD_RESOURCE_ASYNC, ("", "", "", True, None))
+        req._call_function()
+        req = IM.ServiceRequests.IMBaseRequest.create_request(
+            IM.ServiceRequests.IMBaseRequest.GET_OPERATION, ("", ""))
+        req._call_function()
+        req = IM.ServiceRequests.IMBaseRequest.create_request(
+            IM.ServiceRequests.IMBaseRequest.CANCEL_OPERATION, ("", ""))
+        req._call_function()
+        self.assertEqual(inflist.CancelOperation.call_count, 1)
+
     @patch('IM.InfrastructureManager.InfrastructureManager')
     def test_version(self, inflist):
         import IM.ServiceRequests
         req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.GET_VERSION)
         req._call_function()
 
+    @patch('IM.InfrastructureManager.InfrastructureManager')
+    def test_response_sent(self, inflist):
+        import IM.ServiceRequests
+        req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.GET_INFRASTRUCTURE_LIST,
+                                                              ("", 0, None, None))
+        req._execute()
+        self.assertEqual(inflist.response_sent.call_count, 1)
+
+    def test_priority(self):
+        import IM.ServiceRequests
+        from IM.request import Request
+        auth = [{'type': 'InfrastructureManager', 'username': 'user', 'password': 'pass'}]
+        req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.GET_INFRASTRUCTURE_INFO,
+                                                              ("", auth))
+        self.assertEqual(req.priority, Request.PRIORITY_HIGH)
+        self.assertFalse(req.long_operation)
+        self.assertEqual(req.get_user(), "user")
+        req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.DESTROY_INFRASTRUCTURE,
+                                                              ("", auth))
+        self.assertEqual(req.priority, Request.PRIORITY_LOW)
+        self.assertTrue(req.long_operation)
+        req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.ADD_RESOURCE,
+                                                              ("", "", auth, False), Request.PRIORITY_HIGH)
+        self.assertEqual(req.priority, Request.PRIORITY_HIGH)
+        self.assertTrue(req.long_operation)
+        self.assertIsNone(IM.ServiceRequests.IMBaseRequest.create_request(
+            IM.ServiceRequests.IMBaseRequest.GET_VERSION).get_user())
+
+    def test_scheduler_no_arguments(self):
+        """ Test a request without arguments (GetVersion) through the scheduler """
+        import IM.InfrastructureManager
+        import IM.ServiceRequests
+        from IM import __version__ as version
+        from IM.request import Request, RequestScheduler
+        req = IM.ServiceRequests.IMBaseRequest.create_request(IM.ServiceRequests.IMBaseRequest.GET_VERSION, None)
+        RequestScheduler(1).submit(req)
+        req.wait()
+        self.assertEqual(req.status(), Request.STATUS_PROCESSED)
+        self.assertEqual(req.get(), version)
+
+    def test_request_function(self):
+        """ Test the requests of the REST API: classified as the API function, with the exceptions raised """
+        import IM.InfrastructureManager
+        import IM.ServiceRequests
+        from IM.auth import Authentication
+        from IM.request import Request
+        from IM.InfrastructureManager import DeletedInfrastructureException
+        auth = Authentication([{'type': 'InfrastructureManager', 'username': 'user', 'password': 'pass'}])
+        req = IM.ServiceRequests.Request_Function(IM.ServiceRequests.IMBaseRequest.DESTROY_INFRASTRUCTURE,
+                                                  None, ("", auth))
+        self.assertEqual(req.priority, Request.PRIORITY_LOW)
+        self.assertTrue(req.long_operation)
+        self.assertEqual(req.get_user(), "user")
+
+        def get_state(inf_id, auth, extra=None):
+            return (inf_id, extra)
+
+        self.assertEqual(IM.ServiceRequests.Request_Function.run(
+            IM.ServiceRequests.IMBaseRequest.GET_INFRASTRUCTURE_STATE, get_state, "1", auth, extra=2), ("1", 2))
+
+        def deleted(inf_id, auth):
+            raise DeletedInfrastructureException()
+
+        with self.assertRaises(DeletedInfrastructureException):
+            IM.ServiceRequests.Request_Function.run(IM.ServiceRequests.IMBaseRequest.GET_INFRASTRUCTURE_STATE,
+                                                    deleted, "1", auth)
+
+
 if __name__ == '__main__':
     unittest.main()
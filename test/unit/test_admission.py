@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.admission import AdmissionControl, ServiceUnavailableException, _parse_limits
+from IM.config import Config
+
+
+class TestAdmission(unittest.TestCase):
+    """
+    Class to test the admission control of the API calls
+    """
+
+    def test_limits(self):
+        """ Test the rejection of the calls over the limits """
+        admission = AdmissionControl({"deploy": 1}, {"deploy": 1}, queue_timeout=5, retry_after=10)
+        self.assertEqual(admission.get_api_class("CreateInfrastructure"), AdmissionControl.DEPLOY)
+        self.assertEqual(admission.get_api_class("GetVMInfo"), AdmissionControl.READ)
+
+        admission.acquire("deploy")
+        admitted = threading.Event()
+
+        def queued_call():
+            admission.acquire(admission.get_api_class("AddResource"))
+            admitted.set()
+            admission.release("deploy")
+
+        thread = threading.Thread(target=queued_call)
+        thread.start()
+        while admission.stats()["deploy"]["queued"] == 0:
+            time.sleep(0.01)
+
+        # the queue is full
+        with self.assertRaises(ServiceUnavailableException) as cm:
+            admission.acquire("deploy")
+        self.assertEqual(cm.exception.retry_after, 10)
+        # the other classes are not affected
+        admission.acquire(admission.get_api_class("GetVMInfo"))
+        admission.acquire(admission.get_api_class("StopVM"))
+        admission.release("operation")
+        admission.release("read")
+
+        self.assertFalse(admitted.is_set())
+        admission.release("deploy")
+        thread.join()
+        self.assertTrue(admitted.is_set())
+
+        stats = admission.stats()
+        self.assertEqual(stats["deploy"], {"active": 0, "queued": 0, "admitted": 2, "rejected": 1,
+                                           "max_active": 1, "max_queued": 1})
+        self.assertEqual(stats["read"]["admitted"], 1)
+        self.assertEqual(stats["operation"]["max_active"], 0)
+
+    def test_queue_timeout(self):
+        """ Test the rejection of the calls that wait too much """
+        admission = AdmissionControl({"operation": 1}, {"operation": 1}, queue_timeout=0.1)
+        admission.acquire("operation")
+        with self.assertRaises(ServiceUnavailableException):
+            admission.acquire("operation")
+        stats = admission.stats()["operation"]
+        self.assertEqual((stats["active"], stats["queued"], stats["rejected"]), (1, 0, 1))
+
+        # no queue: rejected directly
+        admission = AdmissionControl({"operation": 1})
+        admission.acquire("operation")
+        with self.assertRaises(ServiceUnavailableException):
+            admission.acquire("operation")
+
+    def test_default_limits(self):
+        """ Test that the default configuration does not reject any call """
+        admission = AdmissionControl(_parse_limits(Config.ADMISSION_MAX_ACTIVE),
+                                     _parse_limits(Config.ADMISSION_MAX_QUEUED), queue_timeout=0.1)
+        for function in ["CreateInfrastructure", "DestroyInfrastructure", "AlterVM", "Reconfigure"] * 10:
+            admission.acquire(admission.get_api_class(function))
+        stats = admission.stats()
+        self.assertEqual(stats["deploy"]["active"], 30)
+        self.assertEqual(stats["operation"]["active"], 10)
+        self.assertEqual(sum(stats[api_class]["rejected"] for api_class in stats), 0)
+
+    def test_parse_limits(self):
+        self.assertEqual(_parse_limits(["deploy:4", " operation:2", ""]), {"deploy": 4, "operation": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sys
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM import codec
+from IM.codec import BlobCodec, ZlibCodec
+
+DATA = json.dumps({'id': 'inf1', 'cont_out': 'Task 1: ok\n' * 100, 'vm_list': [0, 1, 2]})
+
+
+class ReverseCodec(BlobCodec):
+    """ Test codec """
+    name = "reverse"
+    format_id = "r1"
+
+    def encode(self, data):
+        return BlobCodec.MAGIC + self.format_id + data[::-1]
+
+    def decode(self, data):
+        return data[::-1]
+
+
+class TestCodec(unittest.TestCase):
+    """
+    Class to test the codecs of the data stored in the DB
+    """
+
+    def test_zlib(self):
+        """ Test the zlib codec """
+        data = codec.encode(DATA, "zlib")
+        self.assertTrue(data.startswith(BlobCodec.MAGIC + ZlibCodec.format_id))
+        self.assertLess(len(data), len(DATA))
+        self.assertIs(codec.get_format(data), codec.codecs["zlib"])
+        self.assertEqual(codec.decode(data), DATA)
+        # as returned by sqlite
+        self.assertEqual(codec.decode(buffer(data)), DATA)
+
+    def test_plain(self):
+        """ Test the data without codec (stored by previous versions) """
+        self.assertEqual(codec.encode(DATA, "none"), DATA)
+        self.assertIs(codec.get_format(DATA), codec.codecs["none"])
+        self.assertEqual(codec.decode(DATA), DATA)
+        self.assertEqual(codec.decode(unicode(DATA)), DATA)
+        # it is the default one, readable by previous versions
+        self.assertEqual(codec.encode(DATA), DATA)
+
+    def test_unknown(self):
+        """ Test unknown codecs and formats """
+        self.assertIs(codec.get_codec("unknown"), codec.codecs["zlib"])
+        with self.assertRaises(ValueError):
+            codec.decode(BlobCodec.MAGIC + "x1" + DATA)
+
+    def test_register(self):
+        """ Test adding new codecs """
+        codec.register_codec(ReverseCodec())
+        self.addCleanup(codec.codecs.pop, "reverse")
+        data = codec.encode(DATA, "reverse")
+        self.assertEqual(data, BlobCodec.MAGIC + "r1" + DATA[::-1])
+        self.assertEqual(codec.decode(data), DATA)
+
+
+if __name__ == '__main__':
+    unittest.main()
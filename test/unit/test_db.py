@@ -0,0 +1,329 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import sqlite3
+from mock import MagicMock, patch
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+from IM.db import DataBase, ConnectionPool, SchemaManager
+
+
+class TestDataBase(unittest.TestCase):
+    """
+    Class to test the DB module
+    """
+
+    def setUp(self):
+        (fd, self.db_file) = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.db_url = "sqlite://" + self.db_file
+        DataBase.close_pools()
+
+    def tearDown(self):
+        DataBase.close_pools()
+        os.unlink(self.db_file)
+        if os.path.exists(self.db_file + ".lock"):
+            os.unlink(self.db_file + ".lock")
+
+    def test_pool_reuse(self):
+        """ Test that the connections are reused """
+        db = DataBase(self.db_url)
+        self.assertTrue(db.connect())
+        db.execute("create table test(id INTEGER)")
+        connection = db.connection
+        db.close()
+
+        db = DataBase(self.db_url)
+        self.assertTrue(db.connect())
+        self.assertIs(db.connection, connection)
+        db.execute("insert into test values (%s)", (1,))
+        self.assertEqual(db.select("select * from test"), [(1,)])
+        db.close()
+
+        stats = DataBase.get_pool(self.db_url).stats()
+        self.assertEqual(stats, {'size': 1, 'idle': 1})
+
+    def test_pool_threads(self):
+        """ Test the use of pooled connections in different threads """
+        db = DataBase(self.db_url)
+        db.connect()
+        db.execute("create table test(id INTEGER)")
+        db.close()
+
+        errors = []
+
+        def insert(i):
+            try:
+                db = DataBase(self.db_url)
+                db.connect()
+                db.execute("insert into test values (%s)", (i,))
+                db.close()
+            except Exception, ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=insert, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertEqual(len(db.select("select * from test")), 20)
+        db.close()
+        self.assertLessEqual(DataBase.get_pool(self.db_url).stats()['size'], Config.DB_POOL_MAX_SIZE)
+
+    def test_pool_max_size(self):
+        """ Test that the pool does not open more than max_size connections """
+        pool = ConnectionPool(self.db_url, min_size=0, max_size=1, timeout=0.1)
+        conn1 = pool.acquire()
+        self.assertIsNotNone(conn1)
+        self.assertIsNone(pool.acquire())
+        pool.release(conn1)
+        conn2 = pool.acquire()
+        self.assertIs(conn1, conn2)
+        pool.release(conn2, discard=True)
+        self.assertEqual(pool.stats(), {'size': 0, 'idle': 0})
+        pool.close()
+
+    def test_pool_idle_and_check(self):
+        """ Test the idle eviction and the health check of the connections """
+        pool = ConnectionPool(self.db_url, min_size=1, max_size=3, idle_timeout=0, check_interval=0)
+        self.assertEqual(pool.stats(), {'size': 1, 'idle': 1})
+        conn1 = pool.acquire()
+        conn2 = pool.acquire()
+        pool.release(conn1)
+        time.sleep(0.01)
+        pool.release(conn2)
+        # connections over min_size must be closed
+        self.assertEqual(pool.stats(), {'size': 1, 'idle': 1})
+
+        # A broken connection must be replaced
+        conn = pool.acquire()
+        pool.release(conn, discard=True)
+        broken = MagicMock()
+        broken.cursor.side_effect = Exception("Broken connection")
+        pool._size += 1
+        pool.release(broken)
+        new_conn = pool.acquire()
+        self.assertIsNot(new_conn, broken)
+        self.assertEqual(broken.close.call_count, 1)
+        self.assertEqual(new_conn.cursor().execute("select 1").fetchall(), [(1,)])
+        pool.release(new_conn)
+        pool.close()
+
+    def test_discard_on_error(self):
+        """ Test that connections with errors are not returned to the pool """
+        db = DataBase(self.db_url)
+        db.connect()
+        db.connection = MagicMock()
+        db.connection.cursor.side_effect = Exception("Lost connection")
+        self.assertRaises(Exception, db.select, "select 1")
+        db.close()
+        self.assertEqual(DataBase.get_pool(self.db_url).stats(), {'size': 0, 'idle': 0})
+
+    def test_no_pool(self):
+        """ Test the DB access without pool """
+        old_size = Config.DB_POOL_MAX_SIZE
+        Config.DB_POOL_MAX_SIZE = 0
+        try:
+            db = DataBase(self.db_url)
+            self.assertTrue(db.connect())
+            self.assertEqual(db.select("select 1"), [(1,)])
+            db.close()
+            self.assertEqual(DataBase.pools, {})
+        finally:
+            Config.DB_POOL_MAX_SIZE = old_size
+
+    def test_sqlite_options(self):
+        """ Test the SQLite options set in the URL """
+        # By default the journal mode of the DB is not changed
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertEqual(db.select("PRAGMA journal_mode"), [("delete",)])
+        self.assertEqual(db.select("PRAGMA synchronous"), [(2,)])
+        db.close()
+
+        db = DataBase(self.db_url + "?journal_mode=delete&busy_timeout=100&synchronous=FULL&cache_size=-4000")
+        db.connect()
+        self.assertEqual(db.select("PRAGMA journal_mode"), [("delete",)])
+        self.assertEqual(db.select("PRAGMA busy_timeout"), [(100,)])
+        self.assertEqual(db.select("PRAGMA synchronous"), [(2,)])
+        self.assertEqual(db.select("PRAGMA cache_size"), [(-4000,)])
+        db.close()
+
+        for query in ["unknown=1", "journal_mode=bad", "busy_timeout=1s", "cache_size=-1 drop"]:
+            db = DataBase(self.db_url + "?" + query)
+            self.assertRaises(ValueError, db.connect)
+
+        db = DataBase(self.db_url + "?journal_mode=wal&synchronous=normal")
+        db.connect()
+        self.assertEqual(db.select("PRAGMA journal_mode"), [("wal",)])
+        self.assertEqual(db.select("PRAGMA synchronous"), [(1,)])
+        db.close()
+        # WAL is stored in the DB
+        DataBase.close_pools()
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertEqual(db.select("PRAGMA journal_mode"), [("wal",)])
+        db.close()
+
+    @staticmethod
+    def patch_sleep():
+        """ Patch time.sleep registering only the calls of this thread (other tests may leave threads running) """
+        sleep = time.sleep
+        thread = threading.current_thread()
+        calls = []
+
+        def fake_sleep(secs):
+            if threading.current_thread() is thread:
+                calls.append(secs)
+            else:
+                sleep(secs)
+        return patch('time.sleep', side_effect=fake_sleep), calls
+
+    def test_locked_retry(self):
+        """ Test the retries of the operations in a locked DB """
+        db = DataBase(self.db_url)
+        db.connect()
+        connection = db.connection
+        db.connection = MagicMock()
+        db.connection.cursor.return_value.execute.side_effect = [sqlite3.OperationalError("database is locked"),
+                                                                 sqlite3.OperationalError("database is locked"),
+                                                                 None]
+        sleep_patch, sleeps = self.patch_sleep()
+        with sleep_patch:
+            self.assertTrue(db.execute("create table test(id INTEGER)"))
+        # the transaction is retried in the same connection with increasing waits
+        self.assertEqual(db.connection.rollback.call_count, 2)
+        self.assertEqual(db.connection.commit.call_count, 1)
+        self.assertEqual(len(sleeps), 2)
+        self.assertLessEqual(sleeps[0], DataBase.RETRY_BASE_SLEEP * 2)
+        self.assertLessEqual(sleeps[1], DataBase.RETRY_BASE_SLEEP * 4)
+
+        db.connection.cursor.return_value.execute.side_effect = sqlite3.OperationalError("database is locked")
+        sleep_patch, sleeps = self.patch_sleep()
+        with sleep_patch:
+            self.assertRaises(sqlite3.OperationalError, db.execute, "create table test(id INTEGER)")
+        self.assertEqual(len(sleeps), DataBase.MAX_RETRIES - 1)
+        self.assertTrue(all(secs <= DataBase.RETRY_SLEEP for secs in sleeps))
+        db.connection = connection
+        db.close()
+
+    def test_select_iter(self):
+        """ Test the iteration over the results in chunks """
+        db = DataBase(self.db_url)
+        db.connect()
+        db.execute("create table test(id INTEGER)")
+        db.execute_batch([("insert into test values (%s)", (i,)) for i in range(25)])
+        rows = db.select_iter("select id from test where id >= %s order by id", (5,), chunk_size=10)
+        self.assertEqual([row[0] for row in rows], range(5, 25))
+        # The connection can be used after the iteration
+        self.assertEqual(db.select("select count(*) from test"), [(25,)])
+        db.close()
+
+    def test_schema_manager(self):
+        """ Test that the migrations are applied only once and in order """
+        applied = []
+
+        def create(db):
+            applied.append(1)
+            db.execute("create table test(id INTEGER)")
+
+        def add_data(db):
+            applied.append(2)
+            db.execute("insert into test values (%s)", (1,))
+
+        self.assertEqual(SchemaManager(self.db_url, [(1, create)]).upgrade(), 1)
+        self.assertEqual(SchemaManager(self.db_url, [(1, create), (2, add_data)]).upgrade(), 2)
+        self.assertEqual(SchemaManager(self.db_url, [(1, create), (2, add_data)]).upgrade(), 2)
+        self.assertEqual(applied, [1, 2])
+
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertEqual(db.select("select * from test"), [(1,)])
+        self.assertEqual(SchemaManager(self.db_url, []).get_version(db), 2)
+        db.close()
+
+    def test_schema_manager_failure(self):
+        """ Test that a failed migration is rolled back with its version, so it is applied again """
+        fail = [True]
+
+        def create(db):
+            db.execute("create table test(id INTEGER)")
+            db.execute("create index test_id on test (id)")
+            db.execute("insert into test values (%s)", (1,))
+            if fail:
+                raise Exception("Migration error")
+
+        self.assertRaises(Exception, SchemaManager(self.db_url, [(1, create)]).upgrade)
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertFalse(db.table_exists("test"))
+        self.assertEqual(SchemaManager(self.db_url, []).get_version(db), 0)
+        db.close()
+
+        fail.pop()
+        self.assertEqual(SchemaManager(self.db_url, [(1, create)]).upgrade(), 1)
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertEqual(db.select("select * from test"), [(1,)])
+        self.assertTrue(db.column_exists("test", "id"))
+        self.assertFalse(db.column_exists("test", "name"))
+        self.assertTrue(db.index_exists("test", "test_id"))
+        self.assertFalse(db.index_exists("test", "test_name"))
+        db.close()
+
+    def test_schema_manager_concurrent(self):
+        """ Test that the IM instances that upgrade the DB at the same time apply each migration once """
+        applied = []
+
+        def add_column(db):
+            applied.append(1)
+            time.sleep(0.2)
+            # it fails if it is applied twice
+            db.execute("alter table test add column name VARCHAR(255)")
+
+        db = DataBase(self.db_url)
+        db.connect()
+        db.execute("create table test(id INTEGER)")
+        db.close()
+        results = []
+        migrations = [(1, add_column)]
+        threads = [threading.Thread(target=lambda: results.append(SchemaManager(self.db_url, migrations).upgrade()))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1, 1, 1])
+        self.assertEqual(applied, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.admission import ServiceUnavailableException
+from IM.events import EventBus
+
+
+class TestEvents(unittest.TestCase):
+    """
+    Class to test the event bus of the infrastructures
+    """
+
+    def test_events(self):
+        """ Test the publication and the wait of the events """
+        bus = EventBus(buffer_size=10)
+        # the events of the infrastructures not watched are not stored
+        bus.publish("1", "contmsg", {"msg": "not stored"})
+        after = bus.watch("1")
+        self.assertEqual(bus.get_events("1", after), [])
+
+        bus.publish("1", "vm_state", {"vm_id": "0", "state": "running"})
+        bus.publish("2", "vm_state", {"vm_id": "0", "state": "running"})
+        events = bus.get_events("1", after)
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]["type"], events[0]["data"]), ("vm_state", {"vm_id": "0", "state": "running"}))
+        self.assertGreater(events[0]["id"], after)
+        after = events[0]["id"]
+
+        threading.Timer(0.1, bus.publish, ["1", "configured", {"configured": True}]).start()
+        before = time.time()
+        events = bus.get_events("1", after, timeout=10)
+        self.assertLess(time.time() - before, 5)
+        self.assertEqual([event["type"] for event in events], ["configured"])
+        self.assertEqual(bus.stats(), {"watched": 1, "waiting": 0})
+
+        # timeout without events
+        before = time.time()
+        self.assertEqual(bus.get_events("1", events[0]["id"], timeout=0.1), [])
+        self.assertGreaterEqual(time.time() - before, 0.1)
+
+    def test_lost_events(self):
+        """ Test the events lost by the clients """
+        bus = EventBus(buffer_size=2)
+        after = bus.watch("1")
+        for i in range(3):
+            bus.publish("1", "contmsg", {"msg": str(i)})
+        events = bus.get_events("1", after, timeout=10)
+        self.assertEqual([event["type"] for event in events], [EventBus.RESET, "contmsg", "contmsg"])
+        self.assertEqual(events[-1]["data"], {"msg": "2"})
+        self.assertEqual(bus.get_events("1", events[1]["id"]), events[2:])
+
+        # the events are not stored after the retention time without clients
+        bus.retention = 0
+        time.sleep(0.01)
+        bus.watch("2")
+        self.assertEqual(bus.stats()["watched"], 1)
+        bus.publish("1", "contmsg", {"msg": "lost"})
+        events = bus.get_events("1", events[-1]["id"])
+        self.assertEqual([event["type"] for event in events], [EventBus.RESET])
+
+    def test_max_waiting(self):
+        """ Test the limit of clients waiting at the same time """
+        bus = EventBus(max_waiting=1)
+        after = bus.watch("1")
+        waiter = threading.Thread(target=bus.get_events, args=("1", after, 10))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(bus.stats()["waiting"], 1)
+        self.assertRaises(ServiceUnavailableException, bus.get_events, "2", bus.watch("2"), 10)
+        # the calls that do not wait are not limited
+        self.assertEqual(bus.get_events("2", after), [])
+
+        bus.publish("1", "contmsg", {"msg": "msg"})
+        waiter.join(5)
+        self.assertEqual(bus.stats()["waiting"], 0)
+        self.assertEqual(bus.get_events("2", bus.watch("2"), 0.01), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,10 +17,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import json
 import time
+import threading
 import logging
 import unittest
 import sys
+from datetime import datetime, timedelta
 from mock import Mock, patch, MagicMock
 
 sys.path.append("..")
@@ -33,6 +36,8 @@ Config.MAX_SIMULTANEOUS_LAUNCHES = 2
 from IM.VirtualMachine import VirtualMachine
 from IM.InfrastructureManager import InfrastructureManager as IM
 from IM.InfrastructureList import InfrastructureList
+from IM.InfrastructureArchive import InfrastructureArchive
+from IM.idempotency import IdempotencyKeys, IdempotencyKeyConflictException
 from IM.auth import Authentication
 from radl.radl import RADL, system, deploy, Feature, SoftFeatures
 from radl.radl_parse import parse_radl
@@ -40,6 +45,9 @@ from IM.CloudInfo import CloudInfo
 from IM.connectors.CloudConnector import CloudConnector
 from IM.SSH import SSH
 from IM.InfrastructureInfo import InfrastructureInfo
+from IM.db import DataBase
+from IM.lazyradl import LazyRADL
+from IM import codec
 
 
 def read_file_as_string(file_name):
@@ -234,6 +242,169 @@ class TestIM(unittest.TestCase):
 
         IM.DestroyInfrastructure(infId, auth0)
 
+    def wait_operation(self, op_id, auth, timeout=10):
+        deadline = time.time() + timeout
+        op = IM.GetOperation(op_id, auth)
+        while op['state'] in ['queued', 'running'] and time.time() < deadline:
+            time.sleep(0.05)
+            op = IM.GetOperation(op_id, auth)
+        return op
+
+    def test_inf_creation_async(self):
+        """Create infrastructures and add resources asynchronously."""
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er"),
+                               Feature("disk.0.os.credentials.username", "=", "user"),
+                               Feature("disk.0.os.credentials.password", "=", "pass")]))
+        radl.add(deploy("s0", 1))
+
+        auth0 = self.getAuth([0], [], [("Dummy", 0)])
+        op = IM.CreateInfrastructureAsync(str(radl), auth0)
+        self.assertIn(op['state'], ['queued', 'running'])
+        op = self.wait_operation(op['id'], auth0)
+        self.assertEqual((op['state'], op['type'], op['result']), ('finished', 'CreateInfrastructure', [0]))
+        self.assertEqual(len(IM.GetInfrastructureInfo(op['inf_id'], auth0)), 1)
+
+        with self.assertRaises(Exception) as ex:
+            IM.GetOperation(op['id'], self.getAuth([1]))
+        self.assertEqual(str(ex.exception), "Access to this infrastructure not granted.")
+        with self.assertRaises(Exception) as ex:
+            IM.GetOperation("none", auth0)
+        self.assertEqual(str(ex.exception), "Invalid operation ID or operation expired.")
+        # the RADL errors are returned in the call
+        self.assertRaises(Exception, IM.AddResourceAsync, op['inf_id'], "system s0 (", auth0)
+
+        radl.get_system_by_name("s0").delValue("disk.0.image.url")
+        op = IM.AddResourceAsync(op['inf_id'], str(radl), auth0)
+        op = self.wait_operation(op['id'], auth0)
+        self.assertEqual(op['state'], 'failed')
+        self.assertEqual(op['error'], "No correct VMRC auth data provided nor image URL")
+
+        IM.DestroyInfrastructure(op['inf_id'], auth0)
+
+    def test_inf_creation_async_cancel(self):
+        """Cancel the asynchronous creation of an infrastructure."""
+        radl = RADL()
+        for name in ["s0", "s1"]:
+            radl.add(system(name, [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er"),
+                                   Feature("disk.0.os.credentials.username", "=", "user"),
+                                   Feature("disk.0.os.credentials.password", "=", "pass")]))
+            radl.add(deploy(name, 1))
+        launching, release = threading.Event(), threading.Event()
+
+        def launch(*args):
+            launching.set()
+            release.wait(10)
+            return self.gen_launch_res(*args)
+
+        cloud = self.get_cloud_connector_mock()
+        cloud.launch = Mock(side_effect=launch)
+        self.register_cloudconnector("Mock", cloud)
+        auth0 = self.getAuth([0], [], [("Mock", 0)])
+        old_launches = Config.MAX_SIMULTANEOUS_LAUNCHES
+        Config.MAX_SIMULTANEOUS_LAUNCHES = 1
+        self.addCleanup(setattr, Config, "MAX_SIMULTANEOUS_LAUNCHES", old_launches)
+
+        op = IM.CreateInfrastructureAsync(str(radl), auth0)
+        self.assertTrue(launching.wait(10))
+        self.assertTrue(IM.CancelOperation(op['id'], auth0)['cancelled'])
+        release.set()
+        op = self.wait_operation(op['id'], auth0)
+        self.assertEqual(op['state'], 'cancelled')
+        # the launches in progress end, but no more VMs are launched
+        self.assertEqual(cloud.launch.call_count, 1)
+        self.assertRaises(Exception, IM.GetInfrastructureInfo, op['inf_id'], auth0)
+
+    def test_idempotency_keys(self):
+        """Retry the calls that create resources with idempotency keys."""
+        db_file = "/tmp/ind_idem.dat"
+        if os.path.exists(db_file):
+            os.unlink(db_file)
+        Config.DATA_DB = "sqlite://" + db_file
+        self.assertTrue(InfrastructureList.init_table())
+        self.addCleanup(os.unlink, db_file)
+        self.addCleanup(DataBase.close_pools)
+
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er"),
+                               Feature("disk.0.os.credentials.username", "=", "user"),
+                               Feature("disk.0.os.credentials.password", "=", "pass")]))
+        radl.add(deploy("s0", 1))
+        cloud = self.get_cloud_connector_mock()
+        self.register_cloudconnector("Mock", cloud)
+        auth0 = self.getAuth([0], [], [("Mock", 0)])
+
+        inf_id = IM.CreateInfrastructure(str(radl), auth0, "key1")
+        self.assertEqual(IM.CreateInfrastructure(str(radl), auth0, "key1"), inf_id)
+        self.assertEqual(cloud.launch.call_count, 1)
+        # the keys of other users are independent
+        other_inf_id = IM.CreateInfrastructure(str(radl), self.getAuth([1], [], [("Mock", 0)]), "key1")
+        self.assertNotEqual(other_inf_id, inf_id)
+        self.assertEqual(cloud.launch.call_count, 2)
+
+        self.assertEqual(IM.AddResource(inf_id, str(radl), auth0, idempotency_key="key2"), [1])
+        self.assertEqual(IM.AddResource(inf_id, str(radl), auth0, idempotency_key="key2"), [1])
+        self.assertEqual(len(IM.GetInfrastructureInfo(inf_id, auth0)), 2)
+        with self.assertRaises(IdempotencyKeyConflictException):
+            IM.AddResource(inf_id, str(radl), auth0, idempotency_key="key1")
+
+        # the failed calls can be retried
+        cloud.launch.side_effect = Exception("Cloud error")
+        self.assertRaises(Exception, IM.AddResource, inf_id, str(radl), auth0, idempotency_key="key3")
+        cloud.launch.side_effect = self.gen_launch_res
+        self.assertEqual(IM.AddResource(inf_id, str(radl), auth0, idempotency_key="key3"), [2])
+
+        # the retries of a call in progress do not wait for it
+        owner = InfrastructureList._get_owner(auth0)
+        self.assertIsNone(IdempotencyKeys._acquire(owner, "key4", "CreateInfrastructure", "holder"))
+        before = time.time()
+        with self.assertRaises(IdempotencyKeyConflictException):
+            IM.CreateInfrastructure(str(radl), auth0, "key4")
+        self.assertLess(time.time() - before, 1)
+        IdempotencyKeys._set_result(owner, "key4", "holder", "infid")
+        self.assertEqual(IM.CreateInfrastructure(str(radl), auth0, "key4"), "infid")
+
+        # the key of an interrupted call is taken over when its lease expires
+        old_lease = Config.IDEMPOTENCY_LEASE
+        self.addCleanup(setattr, Config, "IDEMPOTENCY_LEASE", old_lease)
+        Config.IDEMPOTENCY_LEASE = -1
+        self.assertIsNone(IdempotencyKeys._acquire(owner, "key6", "CreateInfrastructure", "stopped"))
+        Config.IDEMPOTENCY_LEASE = old_lease
+        launches = cloud.launch.call_count
+        inf_id6 = IM.CreateInfrastructure(str(radl), auth0, "key6")
+        self.assertEqual(cloud.launch.call_count, launches + 1)
+        # and the interrupted call cannot store its result
+        IdempotencyKeys._set_result(owner, "key6", "stopped", "infid")
+        self.assertEqual(IM.CreateInfrastructure(str(radl), auth0, "key6"), inf_id6)
+
+        # the retries of an async call return the unknown state if the operation is not available anymore
+        op = IM.CreateInfrastructureAsync(str(radl), auth0, "key8")
+        self.assertIn(op['state'], ['queued', 'running'])
+        self.wait_operation(op['id'], auth0)
+        self.assertEqual(IM.CreateInfrastructureAsync(str(radl), auth0, "key8")['state'], 'finished')
+        with patch('IM.operations.OperationManager.get', return_value=None):
+            retry = IM.CreateInfrastructureAsync(str(radl), auth0, "key8")
+        self.assertEqual((retry['id'], retry['state']), (op['id'], 'unknown'))
+        self.assertIn("not available", retry['error'])
+
+        # the leases are renewed while the call is in progress
+        Config.IDEMPOTENCY_LEASE = 0.3
+        renewed = []
+
+        def slow_call():
+            time.sleep(1.1)
+            renewed.append(IdempotencyKeys._acquire(owner, "key7", "Slow", "other"))
+            return "res"
+        self.assertEqual(IdempotencyKeys.call(owner, "key7", "Slow", slow_call), "res")
+        self.assertEqual(renewed, [("Slow", None)])
+
+        # the keys expire after the TTL
+        old_ttl = Config.IDEMPOTENCY_KEY_TTL
+        Config.IDEMPOTENCY_KEY_TTL = -1
+        self.addCleanup(setattr, Config, "IDEMPOTENCY_KEY_TTL", old_ttl)
+        self.assertNotEqual(IM.CreateInfrastructure(str(radl), auth0, "key5"),
+                            IM.CreateInfrastructure(str(radl), auth0, "key5"))
+
     def test_inf_addresources1(self):
         """Deploy n independent virtual machines."""
 
@@ -362,7 +533,16 @@ class TestIM(unittest.TestCase):
         infId = IM.CreateInfrastructure("", auth0)
         inf_ids = IM.GetInfrastructureList(auth0)
         self.assertEqual(inf_ids, [infId])
+
+        auth1 = self.getAuth([1])
+        infId1 = IM.CreateInfrastructure("", auth1)
+        self.assertEqual(IM.GetInfrastructureList(auth1), [infId1])
+        self.assertEqual(IM.GetInfrastructureList(auth0), [infId])
+
         IM.DestroyInfrastructure(infId, auth0)
+        self.assertEqual(IM.GetInfrastructureList(auth0), [])
+        self.assertEqual(IM.GetInfrastructureList(auth1), [infId1])
+        IM.DestroyInfrastructure(infId1, auth1)
 
     def test_reconfigure(self):
         """Reconfigure."""
@@ -497,6 +677,100 @@ class TestIM(unittest.TestCase):
         state = IM.GetInfrastructureState("1", auth0)
         self.assertEqual(state["state"], "running")
 
+    @patch('IM.InfrastructureList.InfrastructureList.get_inf_ids')
+    def test_get_infs_state(self, get_inf_ids):
+        """
+        Test GetInfrastructuresState.
+        """
+        auth0 = self.getAuth([0], [], [("Dummy", 0)])
+
+        infs = {}
+        for inf_id in ["1", "2"]:
+            inf = MagicMock()
+            inf.id = inf_id
+            inf.auth = auth0
+            inf.deleted = False
+            inf.has_expired.return_value = False
+            infs[inf_id] = inf
+        InfrastructureList.infrastructure_list = infs
+        get_inf_ids.return_value = ["2", "1"]
+
+        vm1 = MagicMock()
+        vm1.im_id = 0
+        vm1.state = VirtualMachine.PENDING
+        vm2 = MagicMock()
+        vm2.im_id = 1
+        vm2.state = VirtualMachine.CONFIGURED
+        infs["1"].get_vm_list.return_value = [vm1, vm2]
+        vm3 = MagicMock()
+        vm3.im_id = 0
+        vm3.state = VirtualMachine.PENDING
+        infs["2"].get_vm_list.return_value = [vm3]
+
+        def update_status(auth):
+            vm1.state = VirtualMachine.RUNNING
+        vm1.update_status.side_effect = update_status
+        # this cloud is too slow
+        vm3.update_status.side_effect = lambda auth: time.sleep(2)
+
+        with patch.object(Config, "INF_STATE_TIMEOUT", 0.5):
+            before = time.time()
+            res = IM.GetInfrastructuresState(None, auth0)
+            self.assertLess(time.time() - before, 2)
+        self.assertEqual(res, {"1": {"state": VirtualMachine.RUNNING, "stale": False,
+                                     "vm_states": {"0": VirtualMachine.RUNNING, "1": VirtualMachine.CONFIGURED}},
+                               "2": {"state": VirtualMachine.PENDING, "stale": True,
+                                     "vm_states": {"0": VirtualMachine.PENDING}}})
+
+        res = IM.GetInfrastructuresState(["1", "3"], auth0)
+        self.assertEqual(res["1"]["state"], VirtualMachine.RUNNING)
+        self.assertEqual(res["3"], {"error": "Invalid infrastructure ID or access not granted."})
+
+        # an empty list is not all the infrastructures
+        get_inf_ids.reset_mock()
+        self.assertEqual(IM.GetInfrastructuresState([], auth0), {})
+        self.assertEqual(get_inf_ids.call_count, 0)
+
+    @patch('IM.InfrastructureList.InfrastructureList.get_inf_ids')
+    def test_get_inf_events(self, get_inf_ids):
+        """
+        Test GetInfrastructureEvents.
+        """
+        auth0 = self.getAuth([0], [], [("Dummy", 0)])
+
+        inf = InfrastructureInfo()
+        inf.auth = auth0
+        get_inf_ids.return_value = [inf.id]
+        InfrastructureList.infrastructure_list = {inf.id: inf}
+        vm = MagicMock()
+        vm.im_id = 0
+        vm.destroy = False
+        vm.state = VirtualMachine.RUNNING
+        inf.vm_list = [vm]
+
+        events = IM.GetInfrastructureEvents(inf.id, auth0)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["type"], "state")
+        self.assertEqual(events[0]["data"]["state"], VirtualMachine.RUNNING)
+        after = events[0]["id"]
+        self.assertEqual(IM.GetInfrastructureEvents(inf.id, auth0, after), [])
+
+        # the waiting clients are woken up by the new events
+        threading.Timer(0.1, inf.add_cont_msg, ["Wait master VM to boot"]).start()
+        update_count = vm.update_status.call_count
+        before = time.time()
+        events = IM.GetInfrastructureEvents(inf.id, auth0, after, 10)
+        self.assertLess(time.time() - before, 5)
+        self.assertEqual(events[0]["type"], "contmsg")
+        self.assertIn("Wait master VM to boot", events[0]["data"]["msg"])
+        # the cloud providers are not polled while waiting
+        self.assertEqual(vm.update_status.call_count, update_count)
+
+        inf.set_configured(True)
+        inf.set_configured(True)
+        events = IM.GetInfrastructureEvents(inf.id, auth0, events[-1]["id"])
+        self.assertEqual([(event["type"], event["data"]) for event in events], [("configured", {"configured": True})])
+
     def test_altervm(self):
         """Test AlterVM"""
         radl = RADL()
@@ -652,5 +926,653 @@ class TestIM(unittest.TestCase):
         self.assertEqual(res['1'].vm_master.info.systems[0].getValue("disk.0.image.url"), "mock0://linux.for.ev.er")
         self.assertTrue(res['1'].auth.compare(inf.auth, "InfrastructureManager"))
 
+    def test_inf_cache_eviction(self):
+        """ Test the eviction of the infrastructures from memory """
+        old_value = Config.INF_CACHE_MAX_ENTRIES
+        Config.INF_CACHE_MAX_ENTRIES = 2
+        self.addCleanup(setattr, Config, "INF_CACHE_MAX_ENTRIES", old_value)
+
+        auth0 = self.getAuth([0])
+        inf_ids = []
+        for _ in range(3):
+            inf_ids.append(IM.CreateInfrastructure("", auth0))
+            time.sleep(0.01)
+
+        stats = InfrastructureList.get_cache_stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertGreater(stats['bytes'], 0)
+        self.assertNotIn(inf_ids[0], InfrastructureList.infrastructure_list)
+
+        # It must be loaded again when requested
+        self.assertEqual(IM.GetInfrastructureState(inf_ids[0], auth0)['state'], "unknown")
+        self.assertIn(inf_ids[0], InfrastructureList.infrastructure_list)
+        self.assertEqual(InfrastructureList.get_cache_stats()['evictions'], 2)
+
+        # Infrastructures being contextualized are never evicted
+        ctxt_inf = InfrastructureList.infrastructure_list[inf_ids[2]]
+        ctxt_inf.last_access = ctxt_inf.last_access.replace(year=2000)
+        ctxt_inf.cm = MagicMock()
+        ctxt_inf.cm.isAlive.return_value = True
+        used_inf = InfrastructureList.infrastructure_list[inf_ids[0]]
+        inf_ids.append(IM.CreateInfrastructure("", auth0))
+        self.assertIn(inf_ids[2], InfrastructureList.infrastructure_list)
+        self.assertNotIn(inf_ids[0], InfrastructureList.infrastructure_list)
+
+        # An evicted infrastructure still referenced must be the same object
+        self.assertIs(InfrastructureList.get_infrastructure(inf_ids[0]), used_inf)
+
+        ctxt_inf.cm = None
+        for inf_id in inf_ids:
+            IM.DestroyInfrastructure(inf_id, auth0)
+
+    def test_inf_warm_up(self):
+        """ Test the warm-up of the infrastructures after a restart """
+        auth0 = self.getAuth([0])
+        inf_ids = [IM.CreateInfrastructure("", auth0) for _ in range(3)]
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        num_vms = {}
+        for num, inf_id in enumerate(inf_ids):
+            inf = InfrastructureList.infrastructure_list[inf_id]
+            inf.vm_list = [VirtualMachine(inf, str(i), cloud, None, None, im_id=i) for i in range(num)]
+            InfrastructureList.save_data(inf_id)
+            num_vms[inf_id] = num
+
+        # Saved in the same day, in different seconds
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        self.assertTrue(db.index_exists("inf_list", "inf_list_date"))
+        for num, inf_id in enumerate(inf_ids):
+            db.execute("update inf_list set date = %s where id = %s", ("2020-01-01 10:00:0%d" % num, inf_id))
+
+        # Simulate a restart of the IM
+        IM.set_start_time()
+        InfrastructureList.infrastructure_list = {}
+        InfrastructureList._saved_digests = {}
+        old_values = Config.INF_CACHE_MAX_ENTRIES, Config.DB_FETCH_SIZE
+        Config.INF_CACHE_MAX_ENTRIES, Config.DB_FETCH_SIZE = 2, 1
+        self.addCleanup(setattr, Config, "INF_CACHE_MAX_ENTRIES", old_values[0])
+        self.addCleanup(setattr, Config, "DB_FETCH_SIZE", old_values[1])
+
+        infs_data = list(InfrastructureList._iter_data_from_db(db))
+        db.close()
+        self.assertEqual([elem[0] for elem in infs_data], inf_ids[::-1])
+        self.assertEqual([len(elem[2]) for elem in infs_data], [2, 1, 0])
+
+        InfrastructureList.warm_up().join()
+        self.assertEqual(sorted(InfrastructureList.infrastructure_list), sorted(inf_ids[1:]))
+        for inf in InfrastructureList.infrastructure_list.values():
+            self.assertEqual(len(inf.vm_list), num_vms[inf.id])
+            self.assertIn((Config.DATA_DB, inf.id), InfrastructureList._saved_digests)
+
+        self.assertIsNone(IM.first_response_time)
+        IM.response_sent()
+        first_response_time = IM.first_response_time
+        self.assertGreater(first_response_time, 0)
+        IM.response_sent()
+        self.assertEqual(IM.first_response_time, first_response_time)
+
+        Config.INF_CACHE_MAX_ENTRIES = 0
+        for inf_id in inf_ids:
+            IM.DestroyInfrastructure(inf_id, auth0)
+
+    def test_inf_warm_up_codec(self):
+        """ Test the warm-up of the infrastructures stored with other codec """
+        auth0 = self.getAuth([0])
+        old_codec = Config.DATA_DB_CODEC
+        Config.DATA_DB_CODEC = "none"
+        self.addCleanup(setattr, Config, "DATA_DB_CODEC", old_codec)
+        inf_id = IM.CreateInfrastructure("", auth0)
+        Config.DATA_DB_CODEC = "zlib"
+
+        # Simulate a restart of the IM
+        InfrastructureList.infrastructure_list = {}
+        InfrastructureList._saved_digests = {}
+        InfrastructureList.warm_up().join()
+        self.assertIn(inf_id, InfrastructureList.infrastructure_list)
+        # the data is converted to the new codec in the next save
+        self.assertNotIn(None, InfrastructureList._saved_digests[(Config.DATA_DB, inf_id)])
+        InfrastructureList.save_data(inf_id)
+        self.assertIn(None, InfrastructureList._saved_digests[(Config.DATA_DB, inf_id)])
+
+        IM.DestroyInfrastructure(inf_id, auth0)
+
+    def test_lazy_radl(self):
+        """ Test that the RADLs are parsed when they are accessed """
+        inf = InfrastructureInfo()
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        radl.add(deploy("s0", 1))
+        inf.radl = radl
+        inf.vm_list = [VirtualMachine(inf, "1", cloud, radl, radl)]
+        data = inf.serialize()
+
+        new_inf = InfrastructureInfo.deserialize(data)
+        vm = new_inf.vm_list[0]
+        self.assertFalse(LazyRADL.is_parsed(new_inf, 'radl'))
+        self.assertFalse(LazyRADL.is_parsed(vm, 'info'))
+        self.assertEqual(json.loads(vm.serialize())['info'], str(inf.vm_list[0].info))
+
+        self.assertEqual(vm.info.systems[0].getValue("disk.0.image.url"), "mock0://linux.for.ev.er")
+        self.assertTrue(LazyRADL.is_parsed(vm, 'info'))
+        self.assertFalse(LazyRADL.is_parsed(vm, 'requested_radl'))
+        vm.info.systems[0].setValue("disk.0.image.url", "mock0://other")
+        self.assertIn("mock0://other", json.loads(vm.serialize())['info'])
+        self.assertEqual(new_inf.radl.systems[0].name, "s0")
+
+    def test_lazy_radl_concurrent(self):
+        """ Test that the lazy parsing of a RADL does not block the parsing of other objects """
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        inf = InfrastructureInfo()
+        inf.radl = radl
+        data = inf.serialize()
+        slow_inf = InfrastructureInfo.deserialize(data)
+        fast_inf = InfrastructureInfo.deserialize(data)
+
+        slow_radl = slow_inf.__dict__['radl']
+        parsing = threading.Event()
+        release = threading.Event()
+
+        def parse_radl(text):
+            if text is slow_radl:
+                parsing.set()
+                release.wait(5)
+            return radl.clone()
+
+        with patch('IM.lazyradl.parse_radl', side_effect=parse_radl) as parse:
+            thread = threading.Thread(target=lambda: slow_inf.radl)
+            thread.start()
+            parsing.wait(5)
+            # the slow parse does not block other objects
+            self.assertEqual(fast_inf.radl.systems[0].name, "s0")
+            self.assertFalse(LazyRADL.is_parsed(slow_inf, 'radl'))
+            # a value set while parsing is not overwritten
+            new_radl = RADL()
+            slow_inf.radl = new_radl
+            release.set()
+            thread.join()
+            self.assertIs(slow_inf.radl, new_radl)
+            self.assertEqual(parse.call_count, 2)
+
+    def test_db_dirty_vms(self):
+        """ Test that only the changed VMs are written to the DB """
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        radl.add(deploy("s0", 1))
+        inf.vm_list = [VirtualMachine(inf, str(i), cloud, radl, radl, im_id=i) for i in range(5)]
+        inf.vm_master = inf.vm_list[0]
+        db_file = "/tmp/ind_dirty.dat"
+        if os.path.exists(db_file):
+            os.unlink(db_file)
+        Config.DATA_DB = "sqlite://" + db_file
+        self.assertTrue(InfrastructureList.init_table())
+        self.addCleanup(os.unlink, db_file)
+        self.addCleanup(DataBase.close_pools)
+
+        with patch('IM.db.DataBase.execute_batch', autospec=True,
+                   side_effect=DataBase.execute_batch) as execute_batch:
+            self.assertTrue(InfrastructureList._save_data_to_db(Config.DATA_DB, {inf.id: inf}))
+            # 5 VMs, the inf header and the owner (update or insert)
+            self.assertEqual(len(execute_batch.call_args_list[0][0][1]), 8)
+
+            inf.vm_list[3].state = VirtualMachine.RUNNING
+            self.assertTrue(InfrastructureList._save_data_to_db(Config.DATA_DB, {inf.id: inf}))
+            sentences = execute_batch.call_args_list[1][0][1]
+            # the VM and the increment of the inf version
+            self.assertEqual(len(sentences), 2)
+            self.assertEqual(sentences[0][1][:2], (inf.id, 3))
+
+            self.assertTrue(InfrastructureList._save_data_to_db(Config.DATA_DB, {inf.id: inf}))
+            self.assertEqual(execute_batch.call_args_list[2][0][1], [])
+
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf.id)
+        self.assertEqual(len(res[inf.id].vm_list), 5)
+        self.assertEqual(res[inf.id].vm_list[3].state, VirtualMachine.RUNNING)
+        self.assertEqual(res[inf.id].vm_master.im_id, 0)
+
+    def test_ctxt_log(self):
+        """ Test the storage of the contextualization logs in chunks """
+        old_tail_size = Config.CTXT_LOG_TAIL_SIZE
+        Config.CTXT_LOG_TAIL_SIZE = 10
+        self.addCleanup(setattr, Config, "CTXT_LOG_TAIL_SIZE", old_tail_size)
+
+        auth0 = self.getAuth([0], [], [("Dummy", 0)])
+        inf = InfrastructureInfo()
+        inf.auth = auth0
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        vm = VirtualMachine(inf, "0", cloud, radl, radl, im_id=0)
+        inf.vm_list = [vm]
+        InfrastructureList.add_infrastructure(inf)
+        inf_id = inf.id
+        vm.cont_out = "Task 1: ok\n"
+        inf.cont_out = "Inf log\n"
+        InfrastructureList.save_data(inf_id)
+
+        with patch('IM.db.DataBase.execute_batch', autospec=True,
+                   side_effect=DataBase.execute_batch) as execute_batch:
+            vm.cont_log.append("Task 2: ok\n")
+            InfrastructureList.save_data(inf_id)
+            # Only the new chunk and the inf version are written
+            sentences = execute_batch.call_args_list[0][0][1]
+            self.assertEqual(len(sentences), 2)
+            self.assertEqual(sentences[0][1][:4], (inf_id, vm.im_id, 11, 11))
+        # Only the tail is in memory
+        self.assertEqual(vm.cont_log.tail, "Task 2: ok\n"[-10:])
+        self.assertEqual(vm.cont_out, "Task 1: ok\nTask 2: ok\n")
+        self.assertEqual(IM.GetVMContMsg(inf_id, "0", auth0, 5, 10), "1: ok\nTask")
+        self.assertEqual(IM.GetVMContMsg(inf_id, "0", auth0, -6), "2: ok\n")
+
+        contmsg = IM.GetInfrastructureContMsg(inf_id, auth0)
+        self.assertEqual(contmsg, "Inf log\nVM 0:\nTask 1: ok\nTask 2: ok\n\n" + "*" * 75 + "\n")
+        self.assertEqual(IM.GetInfrastructureContMsg(inf_id, auth0, 5, 20), contmsg[5:25])
+        self.assertEqual(IM.GetInfrastructureContMsg(inf_id, auth0, -80, 5), contmsg[-80:-75])
+
+        # The export includes the logs
+        exported = json.loads(IM.ExportInfrastructure(inf_id, False, auth0))
+        self.assertEqual(exported['cont_out'], "Inf log\n")
+        self.assertEqual(json.loads(exported['vm_list'][0])['cont_out'], "Task 1: ok\nTask 2: ok\n")
+
+        # Load it from the DB
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf_id)
+        new_vm = res[inf_id].vm_list[0]
+        self.assertIsNone(new_vm.cont_log.stored)
+        self.assertEqual(new_vm.get_cont_msg(-6), "2: ok\n")
+        new_vm.cont_log.append("Task 3: ok\n")
+        self.assertEqual(new_vm.cont_out, "Task 1: ok\nTask 2: ok\nTask 3: ok\n")
+        self.assertEqual(res[inf_id].cont_out, "Inf log\n")
+
+        # A new contextualization resets the log
+        new_vm.cont_out = ""
+        InfrastructureList._save_data_to_db(Config.DATA_DB, res)
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf_id)
+        self.assertEqual(res[inf_id].vm_list[0].cont_out, "")
+
+    def test_check_ctxt_process(self):
+        """ Test that the ctxt output is set before the ctxt process log """
+        old_check = Config.CHECK_CTXT_PROCESS_INTERVAL
+        old_update = Config.UPDATE_CTXT_LOG_INTERVAL
+        Config.CHECK_CTXT_PROCESS_INTERVAL = 0.01
+        Config.UPDATE_CTXT_LOG_INTERVAL = 0.005
+        self.addCleanup(setattr, Config, "CHECK_CTXT_PROCESS_INTERVAL", old_check)
+        self.addCleanup(setattr, Config, "UPDATE_CTXT_LOG_INTERVAL", old_update)
+
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        vm = VirtualMachine(inf, "0", cloud, radl, radl, im_id=0)
+        inf.vm_list = [vm]
+        InfrastructureList.add_infrastructure(inf)
+        vm.state = VirtualMachine.RUNNING
+        vm.ctxt_pid = "1"
+        vm.cont_out = "Initial\n"
+
+        ssh = MagicMock()
+        # Running in the first two checks, finished in the third one
+        ssh.execute.side_effect = [("", "", 0), ("", "", 0), ("", "", 1)]
+        vm.get_ssh_ansible_master = Mock(return_value=ssh)
+        vm.getPublicIP = Mock(return_value="8.8.8.8")
+        vm.getRemoteAccessPort = Mock(return_value=22)
+        vm.get_ctxt_log = Mock(side_effect=["Task 1: ok\n", "Task 1: ok\nTask 2: ok\n"])
+        vm.get_ctxt_output = Mock(return_value="Contextualization output\n")
+
+        with patch.object(vm.cont_log, "reset") as reset:
+            self.assertIsNone(vm.check_ctxt_process())
+            # the log is not rewritten
+            self.assertEqual(reset.call_count, 0)
+        self.assertEqual(vm.get_ctxt_log.call_count, 2)
+        self.assertEqual(vm.cont_out, "Initial\nContextualization output\nTask 1: ok\nTask 2: ok\n")
+
+        # Without a partial log the output is also set before the log
+        vm.ctxt_pid = "1"
+        vm.cont_out = "Initial\n"
+        ssh.execute.side_effect = [("", "", 1)]
+        vm.get_ctxt_log = Mock(return_value="Task 1: ok\n")
+        self.assertIsNone(vm.check_ctxt_process())
+        self.assertEqual(vm.cont_out, "Initial\nContextualization output\nTask 1: ok\n")
+
+    def test_change_counters(self):
+        """ Test the change counters used in the ETags, that do not update the VMs """
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er"),
+                               Feature("disk.0.os.credentials.username", "=", "user"),
+                               Feature("disk.0.os.credentials.password", "=", "pass")]))
+        radl.add(deploy("s0", 1))
+        auth0 = self.getAuth([0], [], [("Dummy", 0)])
+        infId = IM.CreateInfrastructure("", auth0)
+        vm_id = IM.AddResource(infId, str(radl), auth0)[0]
+        inf = IM.get_infrastructure(infId, auth0)
+        vm = inf.vm_list[0]
+
+        with patch.object(VirtualMachine, "update_status") as update_status:
+            vm.last_update = int(time.time())
+            counters = IM.get_change_counters(infId, auth0, fresh=True)
+            self.assertEqual(counters, IM.get_change_counters(infId, auth0))
+            self.assertEqual(IM.get_change_counters(infId, auth0, vm_id), (vm.version, vm.cont_log.changes))
+            vm.changed()
+            self.assertNotEqual(IM.get_change_counters(infId, auth0), counters)
+            # the state must be updated from the cloud
+            vm.last_update = 0
+            self.assertIsNone(IM.get_change_counters(infId, auth0, fresh=True))
+            self.assertIsNone(IM.get_change_counters(infId, auth0, vm_id, fresh=True))
+            self.assertIsNotNone(IM.get_change_counters(infId, auth0, vm_id))
+            self.assertEqual(update_status.call_count, 0)
+
+        IM.DestroyInfrastructure(infId, auth0)
+
+    def test_ctxt_log_truncate(self):
+        """ Test the truncation of the contextualization logs stored in chunks """
+        old_tail_size = Config.CTXT_LOG_TAIL_SIZE
+        Config.CTXT_LOG_TAIL_SIZE = 4
+        self.addCleanup(setattr, Config, "CTXT_LOG_TAIL_SIZE", old_tail_size)
+
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        vm = VirtualMachine(inf, "0", cloud, radl, radl, im_id=0)
+        inf.vm_list = [vm]
+        InfrastructureList.add_infrastructure(inf)
+        inf_id = inf.id
+
+        with patch.object(vm.cont_log, "CHUNK_SIZE", 10):
+            vm.cont_out = "0123456789abcdefghij"
+            InfrastructureList.save_data(inf_id)
+            vm.cont_log.append("KLMNO")
+
+            # The data not saved is removed in memory
+            vm.cont_log.truncate(inf_id, vm.im_id, 22)
+            self.assertEqual(vm.cont_out, "0123456789abcdefghijKL")
+            # The stored chunks after the position are deleted, rewriting the one containing it
+            vm.cont_log.truncate(inf_id, vm.im_id, 15)
+            self.assertEqual(vm.cont_out, "0123456789abcde")
+            vm.cont_log.append("XYZ")
+            with patch('IM.db.DataBase.execute_batch', autospec=True,
+                       side_effect=DataBase.execute_batch) as execute_batch:
+                InfrastructureList.save_data(inf_id)
+                sentences = execute_batch.call_args_list[0][0][1]
+                self.assertEqual(sentences[0], ("delete from ctxt_log where inf_id = %s and vm_id = %s and pos >= %s",
+                                                (inf_id, vm.im_id, 10)))
+                self.assertEqual(sentences[1][1][:4], (inf_id, vm.im_id, 10, 8))
+
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf_id)
+        self.assertEqual(res[inf_id].vm_list[0].cont_out, "0123456789abcdeXYZ")
+
+    def test_inf_archive(self):
+        """ Test the archive and purge of the deleted infrastructures """
+        auth0 = self.getAuth([0], [], [("Dummy", 0)])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        infs = []
+        for days in [400, 100, 0]:
+            inf = InfrastructureInfo()
+            inf.auth = auth0
+            inf.vm_list = [VirtualMachine(inf, "0", cloud, radl, radl, im_id=0)]
+            inf.vm_list[0].cont_out = "Task 1: ok\n"
+            inf.cont_out = "Inf log\n"
+            inf.deleted = True
+            InfrastructureList.add_infrastructure(inf)
+            InfrastructureList.save_data(inf.id)
+            InfrastructureList.remove_inf(inf)
+            infs.append(inf.id)
+            db = DataBase(Config.DATA_DB)
+            db.connect()
+            date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+            db.execute("update inf_list set date = %s where id = %s", (date, inf.id))
+            db.close()
+
+        # The oldest one is purged, the second one archived and the new one is not modified
+        with patch('IM.db.DataBase.execute_batch', autospec=True,
+                   side_effect=DataBase.execute_batch) as execute_batch:
+            self.assertEqual(InfrastructureArchive.archive(Config.DATA_DB, 30, 365, 1), 2)
+            self.assertEqual(execute_batch.call_count, 3)
+
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        self.assertEqual(db.select("select id from inf_list"), [(infs[2],)])
+        for table in ["vm_list", "ctxt_log"]:
+            self.assertEqual(db.select("select distinct inf_id from " + table), [(infs[2],)])
+        self.assertEqual(db.select("select id from inf_archive"), [(infs[1],)])
+        db.close()
+
+        # The archive has the format of the export
+        exported = json.loads(InfrastructureArchive.get_archived(Config.DATA_DB, infs[1]))
+        self.assertEqual(exported['cont_out'], "Inf log\n")
+        self.assertEqual(json.loads(exported['vm_list'][0])['cont_out'], "Task 1: ok\n")
+        new_inf = InfrastructureInfo.deserialize(json.dumps(exported))
+        self.assertEqual(new_inf.vm_list[0].cont_out, "Task 1: ok\n")
+
+        self.assertEqual(InfrastructureArchive.purge(Config.DATA_DB, 30), 1)
+        self.assertIsNone(InfrastructureArchive.get_archived(Config.DATA_DB, infs[1]))
+
+    def test_inf_version(self):
+        """ Test the revalidation of the infrastructures in memory using their version in the DB """
+        old_cache_time = Config.INF_CACHE_TIME
+        Config.INF_CACHE_TIME = 60
+        self.addCleanup(setattr, Config, "INF_CACHE_TIME", old_cache_time)
+
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        InfrastructureList.add_infrastructure(inf)
+        InfrastructureList.save_data(inf.id)
+        self.assertEqual(InfrastructureList._saved_digests[(Config.DATA_DB, inf.id)]['version'], 1)
+        # saves without changes do not increment the version
+        InfrastructureList.save_data(inf.id)
+        self.assertEqual(InfrastructureList._saved_digests[(Config.DATA_DB, inf.id)]['version'], 1)
+
+        # Expired but not modified: the same object is returned without loading it
+        inf.last_access = datetime.now() - timedelta(seconds=120)
+        with patch('IM.InfrastructureList.InfrastructureList._get_data_from_db',
+                   side_effect=InfrastructureList._get_data_from_db) as get_data:
+            self.assertIs(InfrastructureList.get_infrastructure(inf.id), inf)
+            self.assertEqual(get_data.call_count, 0)
+        self.assertEqual(InfrastructureList.get_cache_stats()['revalidations'], 1)
+
+        # Other IM instance modifies it
+        other_inf = InfrastructureInfo.deserialize(inf.serialize_header(), {})
+        other_inf.ansible_configured = True
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        db.execute("update inf_list set data = %s, version = version + 1 where id = %s",
+                   (other_inf.serialize_header(), inf.id))
+        db.close()
+
+        # Not expired: the data in memory is used
+        self.assertIs(InfrastructureList.get_infrastructure(inf.id), inf)
+        # Expired: the new version is loaded
+        inf.last_access = datetime.now() - timedelta(seconds=120)
+        new_inf = InfrastructureList.get_infrastructure(inf.id)
+        self.assertIsNot(new_inf, inf)
+        self.assertTrue(new_inf.ansible_configured)
+        self.assertEqual(InfrastructureList._saved_digests[(Config.DATA_DB, inf.id)]['version'], 2)
+
+    def test_db_write_behind(self):
+        """ Test the write-behind mode of the saves """
+        old_values = Config.DB_WRITE_BEHIND, Config.DB_WRITE_BEHIND_DELAY
+        Config.DB_WRITE_BEHIND, Config.DB_WRITE_BEHIND_DELAY = True, 60
+        self.addCleanup(setattr, Config, "DB_WRITE_BEHIND", old_values[0])
+        self.addCleanup(setattr, Config, "DB_WRITE_BEHIND_DELAY", old_values[1])
+
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        InfrastructureList.add_infrastructure(inf)
+
+        with patch('IM.db.DataBase.execute_batch', autospec=True,
+                   side_effect=DataBase.execute_batch) as execute_batch:
+            # background saves are merged and delayed
+            for _ in range(3):
+                InfrastructureList.save_data(inf.id, wait=False)
+            self.assertEqual(len(InfrastructureList._save_queue), 1)
+            self.assertEqual(InfrastructureList._get_data_from_db(Config.DATA_DB, inf.id), {})
+            # and written with the first save that must wait
+            InfrastructureList.save_data(inf.id)
+            self.assertEqual(execute_batch.call_count, 1)
+            self.assertIn(inf.id, InfrastructureList._get_data_from_db(Config.DATA_DB, inf.id))
+
+            inf.cont_out = "Some ctxt output"
+            InfrastructureList.save_data(inf.id, wait=False)
+            InfrastructureList.stop()
+            self.assertEqual(execute_batch.call_count, 2)
+            self.assertIsNone(InfrastructureList._writer)
+
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf.id)
+        self.assertEqual(res[inf.id].cont_out, "Some ctxt output")
+
+    def test_db_write_behind_retry(self):
+        """ Test that the failed write-behind saves are retried """
+        old_values = Config.DB_WRITE_BEHIND, Config.DB_WRITE_BEHIND_DELAY
+        Config.DB_WRITE_BEHIND, Config.DB_WRITE_BEHIND_DELAY = True, 0.1
+        self.addCleanup(setattr, Config, "DB_WRITE_BEHIND", old_values[0])
+        self.addCleanup(setattr, Config, "DB_WRITE_BEHIND_DELAY", old_values[1])
+
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        InfrastructureList.add_infrastructure(inf)
+
+        with patch('IM.InfrastructureList.InfrastructureList._save_data_to_db',
+                   side_effect=[False, Exception("DB error"), True]) as save_data_to_db:
+            InfrastructureList.save_data(inf.id)
+            self.assertEqual(save_data_to_db.call_count, 3)
+            self.assertEqual(InfrastructureList._save_queue, {})
+
+        # the saves discarded after DB_WRITE_BEHIND_RETRIES do not block the waiting threads
+        with patch('IM.InfrastructureList.InfrastructureList._save_data_to_db',
+                   return_value=False) as save_data_to_db:
+            InfrastructureList.save_data(inf.id)
+            self.assertEqual(save_data_to_db.call_count, Config.DB_WRITE_BEHIND_RETRIES + 1)
+        InfrastructureList.stop()
+
+    def test_get_inf_ids_filters(self):
+        """ Test the pagination and filters of the lists of infrastructures """
+        db_file = "/tmp/ind_list.dat"
+        if os.path.exists(db_file):
+            os.unlink(db_file)
+        Config.DATA_DB = "sqlite://" + db_file
+        self.assertTrue(InfrastructureList.init_table())
+        self.addCleanup(os.unlink, db_file)
+        self.addCleanup(DataBase.close_pools)
+
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        infs = {}
+        for i in range(5):
+            inf = InfrastructureInfo()
+            inf.id = "inf%d" % i
+            inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+            inf.creation_date = time.mktime((2017, 1, i + 1, 0, 0, 0, 0, 0, -1))
+            if i % 2:
+                inf.vm_list = [VirtualMachine(inf, "0", cloud, radl, radl, im_id=0)]
+                inf.vm_list[0].state = VirtualMachine.RUNNING
+            infs[inf.id] = inf
+        infs["inf4"].deleted = True
+        self.assertTrue(InfrastructureList._save_data_to_db(Config.DATA_DB, infs))
+
+        auth = self.getAuth([0])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth), ["inf3", "inf2", "inf1", "inf0"])
+        self.assertEqual(InfrastructureList.get_inf_ids(self.getAuth([1])), [])
+        # Pagination
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, 3), ["inf3", "inf2", "inf1"])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, 3, "inf1"), ["inf0"])
+        # Filters
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'state': VirtualMachine.RUNNING}),
+                         ["inf3", "inf1"])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'cloud': "Dummy"}), ["inf3", "inf1"])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'cloud': "Dumm"}), [])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, 1, "inf3", {'created_after': "2017-01-02",
+                                                                          'created_before': "2017-01-04"}),
+                         ["inf2"])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'deleted': True}), ["inf4"])
+        self.assertRaises(Exception, InfrastructureList.get_inf_ids, auth, filters={'owner': "user"})
+        # also without auth data
+        self.assertEqual(InfrastructureList.get_inf_ids(filters={'state': VirtualMachine.RUNNING}), ["inf3", "inf1"])
+        self.assertEqual(InfrastructureList.get_inf_ids(limit=1, filters={'deleted': True}), ["inf4"])
+
+        # The fields are updated in the next saves, keeping the creation date
+        infs["inf1"].vm_list[0].state = VirtualMachine.STOPPED
+        infs["inf2"].deleted = True
+        self.assertTrue(InfrastructureList._save_data_to_db(Config.DATA_DB, infs))
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'state': VirtualMachine.RUNNING}), ["inf3"])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'deleted': True}), ["inf4", "inf2"])
+        self.assertEqual(InfrastructureList.get_inf_ids(auth, filters={'created_before': "2017-01-03"}),
+                         ["inf1", "inf0"])
+
+    def test_db_migration(self):
+        """ Test the migration of the VMs data stored inside the infrastructure data """
+        inf = InfrastructureInfo()
+        inf.auth = self.getAuth([0], [], [("Dummy", 0)])
+        cloud = CloudInfo()
+        cloud.type = "Dummy"
+        radl = RADL()
+        radl.add(system("s0", [Feature("disk.0.image.url", "=", "mock0://linux.for.ev.er")]))
+        inf.vm_list = [VirtualMachine(inf, str(i), cloud, radl, radl, im_id=i) for i in range(2)]
+        inf.vm_master = inf.vm_list[1]
+
+        db_file = "/tmp/ind_migration.dat"
+        if os.path.exists(db_file):
+            os.unlink(db_file)
+        Config.DATA_DB = "sqlite://" + db_file
+        # Create a DB with the format of the version 2 of the schema
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        db.execute("CREATE TABLE inf_list(id VARCHAR(255) PRIMARY KEY, deleted INTEGER,"
+                   " date TIMESTAMP, data LONGBLOB)")
+        db.execute("CREATE TABLE schema_version(version INTEGER PRIMARY KEY, date TIMESTAMP)")
+        db.execute("insert into schema_version (version, date) values (2, date('now'))")
+        db.execute("insert into inf_list (id, deleted, data, date) values (%s, 0, %s, now())",
+                   (inf.id, inf.serialize()))
+        db.close()
+        self.addCleanup(os.unlink, db_file)
+        self.addCleanup(DataBase.close_pools)
+
+        self.assertTrue(InfrastructureList.init_table())
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        self.assertEqual(len(db.select("select * from vm_list")), 2)
+        self.assertEqual(db.select("select version from inf_list"), [(0,)])
+        db.close()
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf.id)
+        self.assertEqual([vm.id for vm in res[inf.id].vm_list], ["0", "1"])
+        self.assertEqual(res[inf.id].vm_master.im_id, 1)
+        # The owners table must be filled
+        self.assertEqual(InfrastructureList.get_inf_ids(self.getAuth([0])), [inf.id])
+        self.assertEqual(InfrastructureList.get_inf_ids(self.getAuth([1])), [])
+        # with the creation date of the last save
+        self.assertEqual(InfrastructureList.get_inf_ids(self.getAuth([0]), filters={'created_after': "2000-01-01"}),
+                         [inf.id])
+
+        # The data stored without codec is converted to the DATA_DB_CODEC one in the next save
+        old_codec = Config.DATA_DB_CODEC
+        Config.DATA_DB_CODEC = "zlib"
+        self.addCleanup(setattr, Config, "DATA_DB_CODEC", old_codec)
+        self.assertTrue(InfrastructureList._save_data_to_db(Config.DATA_DB, res))
+        db = DataBase(Config.DATA_DB)
+        db.connect()
+        rows = db.select("select data from inf_list union all select data from vm_list")
+        db.close()
+        self.assertEqual(len(rows), 3)
+        for (data,) in rows:
+            self.assertIs(codec.get_format(data), codec.codecs["zlib"])
+        res = InfrastructureList._get_data_from_db(Config.DATA_DB, inf.id)
+        self.assertEqual([vm.id for vm in res[inf.id].vm_list], ["0", "1"])
+
 if __name__ == "__main__":
     unittest.main()
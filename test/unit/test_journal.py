@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+from IM.db import DataBase
+from IM.journal import JournalStore
+from IM.InfrastructureInfo import InfrastructureInfo
+from IM.InfrastructureList import InfrastructureList
+from IM.auth import Authentication
+
+
+class TestJournal(unittest.TestCase):
+    """
+    Class to test the journal DB store
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "inf.jdb")
+        self.db_url = "journal://" + self.path
+        DataBase.close_pools()
+
+    def tearDown(self):
+        DataBase.close_pools()
+        JournalStore.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def crash(self):
+        """ Close the store as if the process had died (without writing a snapshot) """
+        JournalStore.stores.pop(self.path).close(snapshot=False)
+        DataBase.close_pools()
+
+    def execute(self, sql, args=None):
+        db = DataBase(self.db_url)
+        self.assertTrue(db.connect())
+        db.execute(sql, args)
+        db.close()
+
+    def select(self, sql, args=None):
+        db = DataBase(self.db_url)
+        self.assertTrue(db.connect())
+        res = db.select(sql, args)
+        db.close()
+        return res
+
+    def test_journal(self):
+        """ Test the basic operations and the recovery from the journal """
+        self.execute("create table test(id INTEGER PRIMARY KEY, value INTEGER, data LONGBLOB, date TIMESTAMP)")
+        db = DataBase(self.db_url)
+        db.connect()
+        self.assertTrue(db.table_exists("test"))
+        db.execute_batch([("insert into test values (%s, %s, %s, now())", (i, 0, db.blob("\x00data%d" % i)))
+                          for i in range(3)])
+        db.close()
+        self.execute("update test set value = value + 1 where id = %s", (1,))
+        expected = self.select("select * from test order by id")
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(str(expected[1][2]), "\x00data1")
+
+        self.crash()
+        self.assertFalse(os.path.exists(self.path + ".snap"))
+        self.assertEqual(self.select("select * from test order by id"), expected)
+
+        # A clean close writes a snapshot and empties the journal
+        JournalStore.close_all()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(self.select("select * from test order by id"), expected)
+
+    def test_torn_record(self):
+        """ Test the recovery of a journal with an incomplete record at the end """
+        self.execute("create table test(id INTEGER PRIMARY KEY, value INTEGER)")
+        self.execute("insert into test values (%s, %s)", (1, 1))
+        size = os.path.getsize(self.path)
+        self.execute("insert into test values (%s, %s)", (2, 2))
+        self.crash()
+
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual(self.select("select * from test"), [(1, 1)])
+        # the incomplete record is removed and the new ones are appended correctly
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.execute("insert into test values (%s, %s)", (3, 3))
+        self.crash()
+        self.assertEqual(self.select("select * from test order by id"), [(1, 1), (3, 3)])
+
+        # garbage at the end
+        self.crash()
+        with open(self.path, "ab") as f:
+            f.write("\x10\x00\x00\x00garbage")
+        self.assertEqual(self.select("select * from test order by id"), [(1, 1), (3, 3)])
+
+    def test_snapshot_crash(self):
+        """ Test a crash after writing the snapshot but before emptying the journal """
+        self.execute("create table test(id INTEGER PRIMARY KEY, value INTEGER)")
+        self.execute("insert into test values (%s, %s)", (1, 0))
+        self.execute("update test set value = value + 1")
+
+        store = JournalStore.get(self.path)
+        with patch.object(store, "_file") as journal_file:
+            journal_file.truncate.side_effect = IOError("crash")
+            with self.assertRaises(IOError):
+                store.snapshot()
+        self.assertTrue(os.path.exists(self.path + ".snap"))
+        self.assertGreater(os.path.getsize(self.path), 0)
+        self.crash()
+
+        # the records included in the snapshot are not applied again
+        self.assertEqual(self.select("select * from test"), [(1, 1)])
+        self.execute("update test set value = value + 1")
+        self.crash()
+        self.assertEqual(self.select("select * from test"), [(1, 2)])
+
+    def test_snapshot_concurrent(self):
+        """ Test the changes committed while the snapshot is written """
+        self.execute("create table test(id INTEGER PRIMARY KEY, value INTEGER)")
+        self.execute("insert into test values (%s, %s)", (1, 1))
+
+        rename = os.rename
+
+        def commit_and_rename(src, dst):
+            if dst.endswith(".snap"):
+                # the store is not locked while the snapshot is written
+                self.execute("insert into test values (%s, %s)", (2, 2))
+                self.assertEqual(self.select("select count(*) from test"), [(2,)])
+            rename(src, dst)
+
+        store = JournalStore.get(self.path)
+        with patch('os.rename', side_effect=commit_and_rename):
+            store.snapshot()
+        self.assertFalse(os.path.exists(self.path + ".snap.db"))
+        # the journal only keeps the record written during the snapshot
+        self.assertGreater(os.path.getsize(self.path), 0)
+        self.execute("insert into test values (%s, %s)", (3, 3))
+        self.crash()
+        self.assertEqual(self.select("select * from test order by id"), [(1, 1), (2, 2), (3, 3)])
+
+        # the new journal file is also locked
+        with self.assertRaises(Exception):
+            JournalStore(self.path)
+
+    def test_snapshot_size(self):
+        """ Test the snapshots when the journal reaches the size limit """
+        old_size = Config.DB_JOURNAL_SNAPSHOT_SIZE
+        Config.DB_JOURNAL_SNAPSHOT_SIZE = 1024
+        self.addCleanup(setattr, Config, "DB_JOURNAL_SNAPSHOT_SIZE", old_size)
+
+        self.execute("create table test(id INTEGER PRIMARY KEY, data TEXT)")
+        for i in range(20):
+            self.execute("insert into test values (%s, %s)", (i, "x" * 100))
+        # wait the writer thread to finish the snapshot
+        self.crash()
+        self.assertTrue(os.path.exists(self.path + ".snap"))
+        self.assertLess(os.path.getsize(self.path), 1024)
+        self.assertEqual(self.select("select count(*) from test"), [(20,)])
+
+    def test_group_commit(self):
+        """ Test that concurrent transactions are written with the same fsync """
+        self.execute("create table test(id INTEGER)")
+        fsync = os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(0.05)
+            fsync(fd)
+
+        with patch('os.fsync', side_effect=slow_fsync) as fsync_mock:
+            threads = [threading.Thread(target=self.execute, args=("insert into test values (%s)", (i,)))
+                       for i in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertLess(fsync_mock.call_count, 10)
+        self.crash()
+        self.assertEqual(self.select("select count(*) from test"), [(10,)])
+
+    def test_errors(self):
+        """ Test that failed transactions are not written """
+        self.execute("create table test(id INTEGER PRIMARY KEY)")
+        db = DataBase(self.db_url)
+        db.connect()
+        with self.assertRaises(Exception):
+            db.execute_batch([("insert into test values (%s)", (1,)), ("insert into test values (%s)", (1,))])
+        db.close()
+        self.crash()
+        self.assertEqual(self.select("select * from test"), [])
+
+        # the journal can only be used by one store
+        with self.assertRaises(Exception):
+            JournalStore(self.path)
+
+    def test_inf_list(self):
+        """ Test the storage of the infrastructures in a journal """
+        old_db = Config.DATA_DB
+        Config.DATA_DB = self.db_url
+        self.addCleanup(setattr, Config, "DATA_DB", old_db)
+        self.assertTrue(InfrastructureList.init_table())
+
+        inf = InfrastructureInfo()
+        inf.auth = Authentication([{'type': 'InfrastructureManager', 'username': 'user', 'password': 'pass'}])
+        inf.cont_out = "Inf log\n"
+        InfrastructureList._save_data_to_db(self.db_url, {inf.id: inf})
+        self.crash()
+        res = InfrastructureList._get_data_from_db(self.db_url, inf.id)
+        self.assertEqual(res[inf.id].cont_out, "Inf log\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
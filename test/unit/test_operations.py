@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from mock import MagicMock
+from IM.operations import Operation, OperationManager
+
+
+class TestOperations(unittest.TestCase):
+    """
+    Class to test the asynchronous operations
+    """
+
+    @staticmethod
+    def wait_finished(op, timeout=10):
+        deadline = time.time() + timeout
+        while not op.is_finished() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_operations(self):
+        """ Test the execution of the operations and their results """
+        manager = OperationManager(max_running=1)
+        inf = MagicMock()
+        inf.id = "1"
+        release = threading.Event()
+
+        def deploy(res, operation=None):
+            release.wait(10)
+            operation.set_progress("Launching the VMs")
+            if res is None:
+                raise Exception("No cloud provider available")
+            return res
+
+        op1 = manager.start(inf, "CreateInfrastructure", deploy, [0, 1])
+        op2 = manager.start(inf, "AddResource", deploy, None)
+        self.assertIs(manager.get(op1.id), op1)
+        self.assertIsNone(manager.get("none"))
+        # only one operation is executed at the same time
+        time.sleep(0.1)
+        self.assertEqual((op1.state, op2.state), (Operation.RUNNING, Operation.QUEUED))
+        self.assertEqual(manager.stats()['operations'], {Operation.RUNNING: 1, Operation.QUEUED: 1})
+
+        release.set()
+        self.wait_finished(op2)
+        self.assertEqual(op1.state, Operation.FINISHED)
+        self.assertEqual(op1.to_dict()['result'], [0, 1])
+        self.assertEqual(op2.state, Operation.FAILED)
+        self.assertEqual(op2.to_dict()['error'], "No cloud provider available")
+        self.assertNotIn('result', op2.to_dict())
+        self.assertEqual(manager.stats()['processed'], 2)
+
+        # the finished operations are removed after the retention time
+        manager.retention = 0
+        time.sleep(0.01)
+        manager.start(inf, "AddResource", deploy, [2])
+        self.assertIsNone(manager.get(op1.id))
+
+    def test_cancel(self):
+        """ Test the cancellation of the operations """
+        manager = OperationManager(max_running=1)
+        inf = MagicMock()
+        inf.id = "1"
+        started = threading.Event()
+
+        def deploy(operation=None):
+            operation.check_cancelled()
+            started.set()
+            # wait for the cancellation as the launch threads
+            while not operation.cancel_deployment:
+                time.sleep(0.01)
+            raise Exception("Some deploys did not proceed successfully: %s" % operation.cancel_deployment[0])
+
+        op1 = manager.start(inf, "CreateInfrastructure", deploy)
+        op2 = manager.start(inf, "CreateInfrastructure", deploy)
+        started.wait(10)
+        # cancel the queued and the running operations
+        self.assertTrue(op2.cancel())
+        self.assertTrue(op1.cancel())
+        self.wait_finished(op2)
+        self.assertEqual((op1.state, op2.state), (Operation.CANCELLED, Operation.CANCELLED))
+        self.assertEqual(op2.error, "Operation cancelled by the user.")
+        self.assertTrue(op1.to_dict()['cancelled'])
+        self.assertFalse(op1.cancel())
+
+    def test_cancel_running(self):
+        """ Test the cancellation of a running operation after it cannot take effect """
+        manager = OperationManager(max_running=1)
+        inf = MagicMock()
+        inf.id = "1"
+        committed = threading.Event()
+        release = threading.Event()
+
+        def deploy(operation=None):
+            operation.disable_cancel()
+            committed.set()
+            release.wait(10)
+            if operation.cancel_deployment:
+                raise Exception("Some deploys did not proceed successfully")
+            return [0]
+
+        op = manager.start(inf, "AddResource", deploy)
+        committed.wait(10)
+        self.assertEqual(op.state, Operation.RUNNING)
+        # the client is not told that it has been cancelled
+        self.assertFalse(op.cancel())
+        self.assertFalse(op.to_dict()['cancelled'])
+        release.set()
+        self.wait_finished(op)
+        self.assertEqual(op.state, Operation.FINISHED)
+        self.assertEqual(op.result, [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
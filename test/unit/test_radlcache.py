@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import unittest
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.radlcache import RADLCache
+from radl.radl_json import parse_radl as parse_radl_json, dump_radl as dump_radl_json
+
+RADL_TEMPLATE = """
+system %s (
+cpu.count >= 1 and
+disk.0.image.url = 'one://server.com/1'
+)
+"""
+
+
+class TestRADLCache(unittest.TestCase):
+    """
+    Class to test the cache of parsed RADLs
+    """
+
+    def test_hits_and_clones(self):
+        """ Test that the documents are parsed once and that clones are returned """
+        cache = RADLCache(10000)
+        radl1 = cache.parse(RADL_TEMPLATE % "s0")
+        radl2 = cache.parse(RADL_TEMPLATE % "s0")
+        self.assertEqual(cache.stats(), {'entries': 1, 'size': len(RADL_TEMPLATE % "s0"), 'hits': 1, 'misses': 1})
+        self.assertIsNot(radl1, radl2)
+        radl1.systems[0].setValue("cpu.count", 4)
+        self.assertEqual(cache.parse(RADL_TEMPLATE % "s0").systems[0].getValue("cpu.count"), 1)
+
+    def test_max_size(self):
+        """ Test the LRU eviction when the cache is full """
+        size = len(RADL_TEMPLATE % "s0")
+        cache = RADLCache(size * 2)
+        cache.parse(RADL_TEMPLATE % "s0")
+        cache.parse(RADL_TEMPLATE % "s1")
+        # s0 is the most recently used
+        cache.parse(RADL_TEMPLATE % "s0")
+        cache.parse(RADL_TEMPLATE % "s2")
+        self.assertEqual(cache.stats(), {'entries': 2, 'size': size * 2, 'hits': 1, 'misses': 3})
+        cache.parse(RADL_TEMPLATE % "s0")
+        cache.parse(RADL_TEMPLATE % "s1")
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+        # Documents bigger than the cache are not stored
+        radl = cache.parse(RADL_TEMPLATE % ("s" * size * 2))
+        self.assertEqual(radl.systems[0].name, "s" * size * 2)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+        cache.clear()
+        self.assertEqual(cache.stats(), {'entries': 0, 'size': 0, 'hits': 0, 'misses': 0})
+
+    def test_json(self):
+        """ Test that the same text parsed with different parsers is cached independently """
+        cache = RADLCache(10000)
+        radl = cache.parse(RADL_TEMPLATE % "s0")
+        radl_json = dump_radl_json(radl)
+        self.assertEqual(cache.parse(radl_json, parse_radl_json).systems[0].name, "s0")
+        self.assertEqual(cache.parse(radl_json, parse_radl_json).systems[0].name, "s0")
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
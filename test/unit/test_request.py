@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+#
+# IM - Infrastructure Manager
+# Copyright (C) 2011 - GRyCAP - Universitat Politecnica de Valencia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+import unittest
+import xmlrpclib
+
+sys.path.append("..")
+sys.path.append(".")
+
+from IM.config import Config
+from IM.request import (WorkerPool, Request, AsyncRequest, AsyncXMLRPCServer, RequestScheduler, RequestQueue,
+                        get_request_pool)
+
+
+class TestRequest(Request):
+    """ Request that registers its execution and waits for an event """
+
+    def __init__(self, name, user, order, priority=Request.PRIORITY_NORMAL, long_operation=False, event=None):
+        Request.__init__(self, (), priority)
+        self.name = name
+        self.user = user
+        self.order = order
+        self.long_operation = long_operation
+        self.event = event
+
+    def get_user(self):
+        return self.user
+
+    def _execute(self):
+        self.order.append(self.name)
+        if self.event:
+            self.event.wait(5)
+        return True
+
+
+class TestRequestPools(unittest.TestCase):
+    """
+    Class to test the pools of threads of the requests
+    """
+
+    @staticmethod
+    def wait_all(requests):
+        for request in requests:
+            request.wait()
+
+    def test_worker_pool(self):
+        """ Test the number of functions executed at the same time and the gauges """
+        pool = WorkerPool(2, name="test")
+        lock = threading.Lock()
+        running = [0, 0]
+        done = threading.Event()
+
+        def work():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+                if pool.stats()['processed'] == 5:
+                    done.set()
+
+        for _ in range(6):
+            pool.submit(work)
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertGreaterEqual(stats['queued'], 3)
+        done.wait(5)
+        time.sleep(0.1)
+
+        stats = pool.stats()
+        self.assertEqual(running[1], 2)
+        self.assertEqual(stats['processed'], 6)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['busy'], 0)
+        # the last ones waited for two rounds
+        self.assertGreaterEqual(stats['wait_time_max'], 0.09)
+        self.assertLess(stats['wait_time_avg'], stats['wait_time_max'])
+
+        # errors do not stop the threads
+        pool.submit(lambda: 1 / 0)
+        pool.submit(done.clear)
+        time.sleep(0.1)
+        self.assertFalse(done.is_set())
+        self.assertEqual(len(pool._threads), 2)
+
+    def test_worker_pool_released(self):
+        """ Test that the functions waiting with the slot released do not block the pool """
+        pool = WorkerPool(1, name="test")
+        event = threading.Event()
+        done = []
+
+        def wait():
+            with WorkerPool.released():
+                event.wait(5)
+            done.append("wait")
+
+        pool.submit(wait)
+        pool.submit(done.append, "next")
+        for _ in range(50):
+            if done:
+                break
+            time.sleep(0.01)
+        self.assertEqual(done, ["next"])
+        self.assertEqual(pool.stats()['busy'], 0)
+
+        event.set()
+        for _ in range(50):
+            if len(done) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(done, ["next", "wait"])
+        # the pool gets back to its size
+        time.sleep(0.05)
+        self.assertEqual(len(pool._threads), 1)
+        # outside a pool it does nothing
+        with WorkerPool.released():
+            pass
+
+    def test_async_request(self):
+        """ Test that the async requests are executed in the pool """
+
+        class ThreadRequest(AsyncRequest):
+            def _execute(self):
+                self.set(threading.current_thread().name)
+                return True
+
+        request = ThreadRequest()
+        request.process()
+        request.wait()
+        self.assertTrue(request.get().startswith("IM request"))
+        self.assertEqual(get_request_pool().size, Config.MAX_SIMULTANEOUS_REQUESTS)
+
+    def test_scheduler_priority(self):
+        """ Test the order of the requests with different priorities and users """
+        scheduler = RequestScheduler(1)
+        order = []
+        gate = threading.Event()
+        # occupy the thread to queue the rest
+        requests = [TestRequest("gate", "a", order, event=gate)]
+        scheduler.submit(requests[0])
+        time.sleep(0.05)
+        requests.append(TestRequest("low", "c", order, Request.PRIORITY_LOW))
+        requests.extend(TestRequest("a%d" % i, "a", order) for i in range(4))
+        requests.append(TestRequest("b0", "b", order))
+        requests.append(TestRequest("high", "a", order, Request.PRIORITY_HIGH))
+        for request in requests[1:]:
+            scheduler.submit(request)
+        self.assertEqual(scheduler.stats()['queued'], 7)
+        gate.set()
+        self.wait_all(requests)
+
+        self.assertEqual(order[:2], ["gate", "high"])
+        # the request of b is not delayed by the ones of a
+        self.assertIn("b0", order[2:4])
+        self.assertEqual(order[-1], "low")
+        self.assertEqual([name for name in order if name.startswith("a")], ["a0", "a1", "a2", "a3"])
+
+    def test_scheduler_weights(self):
+        """ Test the weighted fair queuing of the users """
+        scheduler = RequestScheduler(1, weights={"a": 2})
+        order = []
+        gate = threading.Event()
+        requests = [TestRequest("gate", None, order, event=gate)]
+        scheduler.submit(requests[0])
+        time.sleep(0.05)
+        for i in range(4):
+            requests.append(TestRequest("a", "a", order))
+            requests.append(TestRequest("b", "b", order))
+        for request in requests[1:]:
+            scheduler.submit(request)
+        gate.set()
+        self.wait_all(requests)
+        self.assertEqual(order[1:7].count("a"), 4)
+
+    def test_scheduler_long_operations(self):
+        """ Test the limit of long operations in execution per user """
+        scheduler = RequestScheduler(3, max_user_long=1)
+        order = []
+        event = threading.Event()
+        long1 = TestRequest("long1", "a", order, long_operation=True, event=event)
+        long2 = TestRequest("long2", "a", order, long_operation=True)
+        read = TestRequest("read", "a", order, Request.PRIORITY_HIGH)
+        other = TestRequest("other", "b", order, long_operation=True)
+        for request in [long1, long2, read, other]:
+            scheduler.submit(request)
+        self.wait_all([read, other])
+        self.assertEqual(sorted(order), ["long1", "other", "read"])
+        self.assertEqual(scheduler.stats()['queued'], 1)
+        event.set()
+        long2.wait()
+        self.assertEqual(order[-1], "long2")
+
+    def test_process_requests_error(self):
+        """ Test that an erroneous request does not stop the processing of the queue """
+
+        class ErrorRequest(Request):
+            def process(self):
+                raise Exception("Error submitting the request")
+
+        queue = RequestQueue()
+        order = []
+        error = ErrorRequest()
+        request = TestRequest("ok", None, order)
+        queue.put((Request.PRIORITY_NORMAL, error))
+        queue.put((Request.PRIORITY_NORMAL, request))
+        self.assertEqual(queue.process_requests(0), 2)
+        self.assertEqual(order, ["ok"])
+        error.wait()
+        self.assertEqual(error.status(), Request.STATUS_ERROR)
+        self.assertEqual(error.get(), "Error submitting the request")
+
+    def test_xmlrpc_pool(self):
+        """ Test that the XML-RPC connections are handled by the pool """
+        old_threads = Config.XMLRCP_MAX_THREADS
+        Config.XMLRCP_MAX_THREADS = 5
+        self.addCleanup(setattr, Config, "XMLRCP_MAX_THREADS", old_threads)
+        server = AsyncXMLRPCServer(("127.0.0.1", 0), logRequests=False)
+        server.register_function(lambda: threading.current_thread().name, "thread_name")
+        server.serve_forever_in_thread()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        proxy = xmlrpclib.ServerProxy("http://127.0.0.1:%d" % server.server_address[1])
+        names = set(proxy.thread_name() for _ in range(Config.XMLRCP_MAX_THREADS * 2))
+        self.assertTrue(all(name.startswith("IM XML-RPC handler") for name in names))
+        # the response is sent before the connection is finished
+        for _ in range(10):
+            if server.handler_pool.stats()['processed'] == Config.XMLRCP_MAX_THREADS * 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(server.handler_pool.stats()['processed'], Config.XMLRCP_MAX_THREADS * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()